@@ -19,15 +19,25 @@
 """ A modified implementation of Yang et. al.'s ScSPM image descriptor [1]. """
 
 
+import os
 import math
 import time
+import shutil
 import numpy as np
-from hashlib import md5
-from spams import omp, trainDL
-from imdescrip.utils import patch as pch, siftwrap as sw
+from imdescrip.utils import patch as pch, siftwrap as sw, modelio
+from imdescrip.utils import encode as enc, memprofile
+from imdescrip.utils.compress import IncrementalPCA, feature_batches
+from imdescrip.utils.siftcache import SiftCache
+from imdescrip.utils.threads import get_threads
+from imdescrip.utils.workspace import Workspace
+from imdescrip.utils.image import open_windows, imresize, video_frames
 from descriptor import Descriptor
 
 
+# Pyramid pooling functions, see the pooling argument of ScSPM
+POOLINGS = {'max': pch.p_max, 'maxabs': pch.p_maxabs, 'mean': pch.p_mean}
+
+
 class ScSPM (Descriptor):
     """ A modified sparse coding spatial pyramid matching image descriptor.
 
@@ -38,17 +48,32 @@ class ScSPM (Descriptor):
         encoding. Some classification performance is lost when using OMP, but it
         is far more scalable to a large number of images. The excellent SPAMs
         library used for [2] is used for the sparse coding and OMP in this
-        module. 
+        module. The SPAMs library is only imported when it is needed (encoding
+        or learning), so merely importing this module is cheap.
         
         In addition to this scalability modification, there is an option to save
         compressed ScSPM descriptors instead of the original large-dimensional
-        descriptors. Compression is done using random projection, see [2] for
-        more details.
+        descriptors. Compression is done using random projection, see [3] for
+        more details, or with a PCA projection learned from (uncompressed)
+        extracted descriptors with learn_compression(), which needs far fewer
+        dimensions for the same accuracy.
 
         Before using the extract() method, a dictionary must be learned using
-        the learn_dictionary() method. I use pickle to save this object once a
-        dictionary has been learned, so then I can apply it to multiple
-        datasets.
+        the learn_dictionary() method. Use the save() method to save this
+        object once a dictionary has been learned, and ScSPM.load() to load it
+        again, so then it can be applied to multiple datasets. Loaded
+        dictionaries (and projection matrices) are memory mapped, and so are
+        shared between processes (and are not copied when this object is
+        pickled for multiprocessing).
+
+        The dense SIFT descriptors of images can be kept in an on-disk cache
+        (see use_sift_cache()), then learning (another) dictionary, or
+        re-encoding the images with a retrained one, doesn't decode and SIFT
+        the images again.
+
+        The peak memory of the stages of extract() (decode, sift, encode,
+        pool and project) and learn_dictionary() (patches, with the decode and
+        sift of each image, and learn) can be profiled, see utils.memprofile.
 
         Arguments:
             maxdim: int (default 320), the maximum dimension the images should 
@@ -63,12 +88,46 @@ class ScSPM (Descriptor):
             compress_dim: int (default None), the dimension of the random
                 projection matrix to use for compressing the descriptors. None
                 means the descriptors are not compressed.
+            encoder: str (default 'omp'), the patch encoding method to use,
+                one of ScSPM.ENCODERS:
+                    'omp': orthogonal matching pursuit (SPAMs) with active
+                        non-zero codes -- the most accurate.
+                    'bomp': batch orthogonal matching pursuit, the same codes
+                        as 'omp', but uses a cached dictionary Gram matrix 
+                        (see gram()), and so is much faster for large
+                        dictionaries.
+                    'aomp': approximate batch orthogonal matching pursuit,
+                        atoms are only selected from a shortlist of atoms
+                        from an index of the dictionary (see build_index()),
+                        which is much faster for very large dictionaries.
+                    'llc': locality-constrained linear coding with the active
+                        nearest atoms.
+                    'soft': soft thresholding at alpha -- the fastest.
+                    'topk': hard assignment of the active largest atom
+                        responses.
+                See the utils.encode module for more details.
+            alpha: float (default 0.25), the threshold of the 'soft' encoder.
+            pooling: str (default 'max'), the pyramid pooling function, 'max',
+                'maxabs' (max absolute value [1]) or 'mean'.
+            probes: int (default 4), the number of atom clusters the 'aomp'
+                encoder shortlists atoms from. More is slower, but closer to
+                'bomp', see scripts/benchmark_index.py.
+            flat_threshold: float (default None), patches with a SIFT gradient
+                norm (contrast) below this are flat (e.g. sand or water), and
+                are not encoded, their codes are zero. Since pooling is max
+                based, they barely change the descriptors, and skipping them
+                saves a lot of encoding time on featureless images. None means
+                all patches are encoded. The number of patches skipped in the
+                last image is in last_stats, and scripts/validate_flat.py
+                helps choose a threshold.
 
         Note:
             When using compression, keep the dimensionality quite large. I.e. a
             dictionary size of 1024 will lead to images descriptors of 21,504
             dimensions. To preseve classification accuracy you may want to not
-            set compress_dim less than 3000 dimensions.
+            set compress_dim less than 3000 dimensions. A learned (PCA)
+            compression, see learn_compression(), keeps similar accuracy with
+            256-1024 dimensions.
 
         References:
 
@@ -87,8 +146,21 @@ class ScSPM (Descriptor):
         
     """
 
+    ENCODERS = ('omp', 'bomp', 'aomp', 'llc', 'soft', 'topk')
+    _arrays = ('dic', 'rmat', 'dicA', 'dicB', 'atomcentres', 'atommembers',
+               'pcamean', 'pcacomp')
+    _caches = ('_gram', '_gramhash', '_gramdic', 'last_stats') # Not pickled
+
     def __init__ (self, maxdim=320, psize=16, pstride=8, active=10, dsize=1024,
-                    levels=(1,2,4), compress_dim=None):
+                    levels=(1,2,4), compress_dim=None, encoder='omp', 
+                    alpha=0.25, flat_threshold=None, probes=4, pooling='max'):
+
+        if encoder not in self.ENCODERS:
+            raise ValueError('Unknown encoder {0}, it must be one of {1}.'
+                             .format(encoder, self.ENCODERS))
+        if pooling not in POOLINGS:
+            raise ValueError('Unknown pooling {0}, it must be one of {1}.'
+                             .format(pooling, sorted(POOLINGS)))
 
         self.maxdim = maxdim
         self.psize = psize
@@ -97,7 +169,22 @@ class ScSPM (Descriptor):
         self.levels = levels
         self.dsize = dsize
         self.compress_dim = compress_dim
+        self.encoder = encoder
+        self.alpha = alpha
+        self.probes = probes
+        self.pooling = pooling
+        self.flat_threshold = flat_threshold
         self.dic = None       # Sparse code dictionary (D)
+        self.dicA = None      # Online dictionary learning statistics (A, B)
+        self.dicB = None
+        self.dicniter = 0     # Dictionary learning iterations so far
+        self.dichistory = []  # Held-out objectives, see learn_dictionary()
+        self.atomcentres = None # Atom index, see build_index()
+        self.atommembers = None
+        self.pcamean = None   # Learned compression, see learn_compression()
+        self.pcacomp = None
+        self.siftcache = None # SIFT descriptor cache, see use_sift_cache()
+        self._clear_caches()
         
         if self.compress_dim is not None:
             D = np.sum(np.array(levels)**2) * self.dsize
@@ -107,7 +194,7 @@ class ScSPM (Descriptor):
             self.rmat = None
 
 
-    def extract (self, impath):
+    def extract (self, impath, workspace=None, out=None):
         """ Extract a ScSPM descriptor for an image.
        
         This method will return an ScSPM descriptor for an image.
@@ -116,77 +203,853 @@ class ScSPM (Descriptor):
         
         Arguments:
             impath: str, the path to an image
+            workspace: a Workspace object (default None), see workspace(). If
+                given, the SIFT, code and pooling arrays are made in its
+                buffers, which are re-used between calls.
+            out: array (default None) to write the descriptor into, it must be
+                the size of the descriptor (see Returns).
 
         Returns:
             a ScSPM descriptor (array) for the image. This array either has
                 self.dsize*sum(self.levels**2) elements, or self.compress_dim if
-                not None.
+                not None. This is out if it is given.
 
         """
 
         if self.dic is None:
             raise ValueError('No dictionary has been learned!')
 
-        # Get and resize image 
-        img = pch.imread_resize(impath, self.maxdim) 
+        # The stages are measured if memory profiling is on, see
+        # utils.memprofile
+        if self.siftcache is not None:
 
-        # Extract SIFT patches
-        patches, cx, cy = sw.DSIFT_patches(img, self.psize, self.pstride)
+            # Read the SIFT patches from the cache (computed if not there)
+            with memprofile.stage('sift'):
+                patches, cx, cy, norms, imshape = self.siftcache.sift(impath)
+            if self.flat_threshold is None:
+                norms = None
 
-        # Get OMP codes 
-        scpatch = np.transpose(omp(np.asfortranarray(patches.T, np.float64), 
-                                self.dic, self.active, eps=np.spacing(1), 
-                                numThreads=1).todense())
+        else:
 
-        # Pyramid pooling and normalisation
-        fea = pch.pyramid_pooling(scpatch, cx, cy, img.shape, self.levels)
-        fea = fea / math.sqrt((fea**2).sum() + 1e-10)
+            # Get and resize image, then extract SIFT patches
+            with memprofile.stage('decode'):
+                img = pch.imread_resize(impath, self.maxdim) 
+            imshape = img.shape
+            with memprofile.stage('sift'):
+                imbuf = None if workspace is None else \
+                        workspace.get('image', img.shape[:2], np.float32)
+                patches, cx, cy, norms = self.__sift(img, imbuf)
+
+        if workspace is None:
+
+            # Get sparse codes 
+            with memprofile.stage('encode'):
+                scpatch = self.encode(patches, norms=norms)
+
+            # Pyramid pooling
+            with memprofile.stage('pool'):
+                fea = pch.pyramid_pooling(scpatch, cx, cy, imshape, 
+                                          self.levels, 
+                                          pfun=POOLINGS[self.pooling])
 
-        if self.compress_dim is not None:
-            return np.dot(fea, self.rmat)
         else:
-            return fea
+
+            # The same, but into the workspace buffers
+            with memprofile.stage('encode'):
+                X = workspace.get('patches', patches.shape)
+                X[:] = patches
+                scpatch = self.encode(X, out=workspace.get('codes', 
+                                      (X.shape[0], self.dsize)), norms=norms)
+            with memprofile.stage('pool'):
+                D = np.sum(np.array(self.levels)**2) * self.dsize
+                fea = pch.pyramid_pooling(scpatch, cx, cy, imshape, 
+                                          self.levels, 
+                                          pfun=POOLINGS[self.pooling],
+                                          out=workspace.get('pooled', (D,)))
+
+        with memprofile.stage('project'):
+            return self._normalise(fea, out, scratch=(workspace is not None))
         
 
-    def learn_dictionary (self, images, npatches=50000, niter=1000, njobs=-1):
+    def extract_tiled (self, image, tilesize=2048):
+        """ Extract a ScSPM descriptor for a very large image, tile by tile.
+
+        This gives the same descriptor as extract() (when the image is not
+        resized), but the image is read, SIFT'd and encoded in overlapping
+        tiles, and the codes are max-pooled into the pyramid bins incrementally.
+        So the memory used is bounded by the tile size, not the image size,
+        when the image can be read in windows (see image.open_windows()).
+
+        The tiles are placed on the SIFT patch grid (at multiples of pstride),
+        and overlap by enough that each patch is computed, whole, in exactly
+        one tile -- the one whose (non-overlapping) core contains the patch
+        centre.
+
+        Only 'max' and 'maxabs' pooling can be done incrementally like this.
+
+        Arguments:
+            image: str, the path to an image (e.g. a ".npy" file or a GeoTIFF),
+                or an array of an image, see image.open_windows().
+            tilesize: int (default 2048), the (core) size of the tiles in
+                pixels, this is rounded up to a multiple of pstride.
+
+        Returns:
+            a ScSPM descriptor (array) for the image, see extract().
+
+        """
+
+        if self.dic is None:
+            raise ValueError('No dictionary has been learned!')
+
+        windows = open_windows(image)
+        try:
+            rows, cols = windows.shape
+            if (self.maxdim is not None) and (max(rows, cols) > self.maxdim):
+                raise ValueError('Tiled extraction does not resize images, '
+                                 'maxdim needs to be None or >= {0}.'
+                                 .format(max(rows, cols)))
+
+            # Tile cores and margins on the patch grid
+            step = self.pstride
+            tile = int(math.ceil(float(tilesize) / step)) * step
+            margin = int(math.ceil(2. * self.psize / step)) * step
+
+            pool = pch.PyramidPool(self.dsize, (rows, cols), self.levels,
+                                   POOLINGS[self.pooling])
+            stats = {'patches': 0, 'skipped': 0}
+            for r in range(0, rows, tile):
+                for c in range(0, cols, tile):
+                    r0, c0 = max(0, r - margin), max(0, c - margin)
+                    img = windows.read(r0, min(rows, r + tile + margin), c0,
+                                       min(cols, c + tile + margin))
+                    patches, cx, cy, norms = self.__sift(img)
+
+                    # Keep only the patches centred in this tile's core
+                    cx, cy = cx + c0, cy + r0
+                    core = (cy >= r) & (cy < r + tile) & (cx >= c) \
+                                & (cx < c + tile)
+                    if core.any() == False:
+                        continue
+
+                    pool.update(self.encode(patches[core], norms=None if norms
+                                is None else norms[core]), cx[core], cy[core])
+                    for k in stats:
+                        stats[k] += self.last_stats[k]
+        finally:
+            windows.close()
+
+        self.last_stats = stats
+        return self._normalise(pool.result())
+
+
+    def extract_stream (self, frames, every=1):
+        """ Extract ScSPM descriptors for a stream of frames, e.g. a video.
+
+        This is a generator, which yields a descriptor for each frame as soon
+        as it has been processed. Since the frames of a stream are all the same
+        size, the video decoding buffers, the SIFT, code and pooling buffers
+        (see workspace()) and the pyramid bins of the patches are only made
+        once, and re-used for all frames.
+
+        Arguments:
+            frames: str, the path to a video (read with OpenCV), or an iterable
+                of (height, width[, channels]) arrays of frames.
+            every: int (default 1), only process every k-th frame, e.g. to
+                keep up with a real-time stream. Skipped video frames are not
+                decoded.
+
+        Yields:
+            frameno: int, the number of the frame in the stream (from 0).
+            descriptor: a ScSPM descriptor (array) for the frame, see
+                extract().
+
+        """
+
+        if self.dic is None:
+            raise ValueError('No dictionary has been learned!')
+
+        if isinstance(frames, basestring):
+            stream = video_frames(frames, self.maxdim, every, gray=True)
+        else:
+            stream = ((i, imresize(f, self.maxdim)) for i, f in
+                      enumerate(frames) if i % every == 0)
+
+        workspace = self.workspace()
+        D = np.sum(np.array(self.levels)**2) * self.dsize
+        shape, bins = None, None
+        for frameno, img in stream:
+
+            # Extract SIFT patches, and get sparse codes
+            patches, cx, cy, norms = self.__sift(img, workspace.get('image',
+                                                 img.shape[:2], np.float32))
+            X = workspace.get('patches', patches.shape)
+            X[:] = patches
+            scpatch = self.encode(X, out=workspace.get('codes', (X.shape[0],
+                                  self.dsize)), norms=norms)
+
+            # Pyramid pooling (with cached bins) and normalisation
+            if img.shape[:2] != shape:
+                shape = img.shape[:2]
+                bins = pch.pyramid_bins(cx, cy, shape, self.levels)
+            pooled = pch.pyramid_pooling(scpatch, cx, cy, shape, self.levels,
+                                         pfun=POOLINGS[self.pooling], bins=bins,
+                                         out=workspace.get('pooled', (D,)))
+            yield frameno, self._normalise(pooled, scratch=True)
+
+
+    def extract_windows (self, impath, boxes):
+        """ Extract ScSPM descriptors for many sub-windows of an image.
+
+        This is for object localisation, e.g. sliding windows or region
+        proposals. The SIFT patches and sparse codes of the image are only
+        computed once, and the descriptor of each window is pyramid pooled
+        from those of the patches with centres in it (with the pyramid over
+        the window), using a block maximum structure (see
+        utils.patch.WindowPool). So each window costs a few lookups per
+        pyramid bin, rather than an extraction.
+
+        This is not quite the same as extract() of the cropped window, the
+        patches at the edges of a window see some pixels outside it, and the
+        window is not resized to maxdim.
+
+        Arguments:
+            impath: str, the path to an image (or a decoded image array).
+            boxes: (nboxes, 4) array (or list) of (x0, y0, x1, y1) windows, in
+                the pixel coordinates of the image resized to maxdim. I.e.
+                multiply the coordinates in the original image by maxdim /
+                max(height, width) if the image is larger than maxdim.
+
+        Returns:
+            (nboxes, dims) array of a ScSPM descriptor for each window, see
+                extract().
+
+        """
+
+        if self.dic is None:
+            raise ValueError('No dictionary has been learned!')
+
+        if self.siftcache is not None:
+            patches, cx, cy, norms, imshape = self.siftcache.sift(impath)
+            if self.flat_threshold is None:
+                norms = None
+        else:
+            img = pch.imread_resize(impath, self.maxdim) 
+            patches, cx, cy, norms = self.__sift(img)
+
+        # Build the block maxima of the codes once for all of the windows
+        pool = pch.WindowPool(self.encode(patches, norms=norms), cx, cy,
+                              pfun=POOLINGS[self.pooling])
+
+        D = np.sum(np.array(self.levels)**2) * self.dsize
+        if self.pcacomp is not None:
+            descs = np.empty((len(boxes), self.pcacomp.shape[1]))
+        elif self.compress_dim is not None:
+            descs = np.empty((len(boxes), self.compress_dim))
+        else:
+            descs = np.empty((len(boxes), D))
+
+        pooled = np.empty(D)
+        for i, box in enumerate(boxes):
+            pool.pool(box, self.levels, out=pooled)
+            self._normalise(pooled, out=descs[i], scratch=True)
+
+        return descs
+
+
+    def use_sift_cache (self, path):
+        """ Read (and write) SIFT descriptors from an on-disk cache.
+
+        extract(), learn_dictionary() and update_dictionary() then get the
+        SIFT descriptors of images from the cache, and only compute them for
+        images that are not in it yet. The cache setting is not saved with the
+        model (see save()), but it is pickled with this object, so parallel
+        extraction uses it too.
+
+        Arguments:
+            path: str, the cache directory (see utils.siftcache), or None to
+                stop using a cache.
+
+        """
+
+        if path is None:
+            self.siftcache = None
+        else:
+            self.siftcache = SiftCache(path, self.maxdim, self.psize,
+                                       self.pstride)
+
+
+    def workspace (self):
+        """ Make a workspace of buffers to re-use between extract() calls.
+
+        Returns:
+            an (empty) utils.workspace.Workspace object, its buffers grow to
+            fit the largest image extracted with it.
+
+        """
+
+        return Workspace()
+
+
+    def __sift (self, img, imbuf=None):
+        """ Dense SIFT, with the patch norms if flat patches are skipped. """
+
+        if self.flat_threshold is None:
+            return sw.DSIFT_patches(img, self.psize, self.pstride, imbuf) \
+                    + (None,)
+        return sw.DSIFT_patches(img, self.psize, self.pstride, imbuf, 
+                                norms=True)
+
+
+    def _normalise (self, fea, out=None, scratch=False):
+        """ Normalise (in place), and optionally compress, a pooled descriptor.
+
+        If scratch is True, fea is a re-used buffer that can't be returned.
+        """
+
+        fea /= math.sqrt(np.dot(fea, fea) + 1e-10)
+
+        if self.pcacomp is not None:
+            fea -= self.pcamean
+            if out is None:
+                return np.dot(fea, self.pcacomp)
+            return np.dot(fea, self.pcacomp, out=out)
+
+        if self.compress_dim is not None:
+            if out is None:
+                return np.dot(fea, self.rmat)
+            return np.dot(fea, self.rmat, out=out)
+
+        if out is None:
+            return fea.copy() if scratch == True else fea
+        out[:] = fea
+        return out
+
+
+    def encode (self, patches, out=None, norms=None):
+        """ Encode patches with this object's dictionary and encoder.
+
+        Arguments:
+            patches: (npatches, 128) array of SIFT patches.
+            out: (npatches, dsize) array (default None) to write the codes into.
+            norms: (npatches,) array (default None) of the SIFT gradient norms
+                of the patches. If this and flat_threshold are not None, flat
+                patches are not encoded (their codes are zero).
+
+        Returns:
+            (npatches, dsize) array of patch codes.
+
+        """
+
+        if self.dic is None:
+            raise ValueError('No dictionary has been learned!')
+
+        self.last_stats = {'patches': patches.shape[0], 'skipped': 0}
+
+        # Only encode the patches that aren't flat
+        if (norms is not None) and (self.flat_threshold is not None):
+            keep = norms >= self.flat_threshold
+            self.last_stats['skipped'] = int(patches.shape[0] - keep.sum())
+            if self.last_stats['skipped'] > 0:
+                if out is None:
+                    codes = np.zeros((patches.shape[0], self.dsize))
+                else:
+                    codes = out
+                    codes[~keep] = 0
+                if keep.any() == True:
+                    codes[keep] = self.__encode(patches[keep])
+                return codes
+
+        return self.__encode(patches, out)
+
+
+    def __encode (self, patches, out=None):
+        """ Encode patches with the chosen encoder. """
+
+        if self.encoder == 'omp':
+            return enc.omp(patches, self.dic, self.active, get_threads(1), 
+                           out=out)
+        elif self.encoder == 'bomp':
+            return enc.batch_omp(patches, self.dic, self.active, 
+                                 gram=self.gram(), out=out)
+        elif self.encoder == 'aomp':
+            if self.atomcentres is None:
+                raise ValueError('No atom index, run build_index() first!')
+            return enc.batch_omp(patches, self.dic, self.active,
+                                 gram=self.gram(), out=out, probes=self.probes,
+                                 index=enc.AtomIndex(self.atomcentres, 
+                                                     self.atommembers))
+        elif self.encoder == 'llc':
+            return enc.llc(patches, self.dic, self.active, out=out)
+        elif self.encoder == 'soft':
+            return enc.soft_threshold(patches, self.dic, self.alpha, out=out)
+        elif self.encoder == 'topk':
+            return enc.hard_topk(patches, self.dic, self.active, out=out)
+        else:
+            raise ValueError('Unknown encoder {0}!'.format(self.encoder))
+
+
+    def gram (self):
+        """ Get the Gram matrix of the dictionary, D^T D.
+
+        The Gram matrix is computed once, and cached against the hash of the
+        dictionary. It is only recomputed if a different dictionary is
+        assigned to this object (in-place changes to the dictionary array are
+        not detected).
+
+        Returns:
+            (dsize, dsize) array, the dictionary Gram matrix.
+
+        """
+
+        if self.dic is None:
+            raise ValueError('No dictionary has been learned!')
+
+        # Only hash the dictionary if it is a new object
+        if self._gramdic is not self.dic:
+            dichash = modelio.array_hash(self.dic)
+            if dichash != self._gramhash:
+                self._gram = np.dot(self.dic.T, self.dic)
+                self._gramhash = dichash
+            self._gramdic = self.dic
+
+        return self._gram
+
+
+    def memory_estimate (self, imsize):
+        """ Estimate the peak memory (bytes) needed by extract() for an image.
+
+        This accounts for the decoded and resized image, the grey float32
+        image, the SIFT patches (and their float64 copy), the dense codes and
+        the pooling buffers.
+
+        Arguments:
+            imsize: tuple (height, width) of the (original) image size.
+
+        Returns:
+            int, the estimated number of bytes.
+
+        """
+
+        h, w = imsize
+        scale = 1.
+        if (self.maxdim is not None) and (max(h, w) > self.maxdim):
+            scale = float(self.maxdim) / max(h, w)
+        rh, rw = h * scale, w * scale
+
+        npatches = max(0, int((rh - self.psize) // self.pstride) + 1) \
+                    * max(0, int((rw - self.psize) // self.pstride) + 1)
+        tbins = np.sum(np.array(self.levels)**2)
+
+        nbytes = 3 * h * w                      # Decoded image
+        nbytes += 3 * rh * rw + 5 * rh * rw     # Resized, grey float32
+        nbytes += npatches * 128 * (4 + 8)      # SIFT, float64 copy
+        nbytes += 2 * npatches * self.dsize * 8 # Codes, and a copy
+        nbytes += 2 * tbins * self.dsize * 8    # Pooling and normalisation
+        return int(nbytes)
+
+
+    def learn_dictionary (self, images, npatches=50000, niter=1000, njobs=None,
+                            sampling='grid', segment=None, checkpoint=None,
+                            holdout=0.05, tol=1e-3, patience=2, 
+                            patchfile=None):
         """ Learn a Sparse Code dictionary for this ScSPM.
 
         This method trains a sparse codes dictionary for the ScSPM descriptor
         object. This only needs to be run once before multiple calls to the
         extract() method can be made.
 
+        The dictionary can be learned in segments of iterations. After each
+        segment the objective (reconstruction error) of some held-out patches
+        is measured, and learning stops early once it stops improving. If a
+        checkpoint is given, this object is also saved to it after each
+        segment, and learning resumes from it if it already exists (e.g. after
+        the job was killed).
+
         Arguments:
             images: list, a list of paths to images to use for training.
             npatches: int (default 50000) number of SIFT patches to extract from
                 the images to use for training the dictionary.
             niter: int (default 1000), the number of iterations of dictionary
                 learning (Lasso) to perform.
-            njobs: int (default -1), the number of threads to use. -1 means the
-                number of threads will be equal to the number of cores.
+            njobs: int (default None), the number of threads to use. None
+                means the thread budget (see utils.threads), or the number of
+                cores if there is no budget.
+            sampling: str (default 'grid'), how to sample the training patches
+                from the images, 'grid' or 'diverse'. 'diverse' needs fewer
+                patches (and iterations) for the same dictionary quality, see
+                utils.siftwrap.training_patches().
+            segment: int (default None), the number of iterations in each
+                segment. None means all niter iterations in one go, unless a
+                checkpoint is given, then it means niter / 10.
+            checkpoint: str (default None), a model directory to save this
+                object to after each segment, and to resume from.
+            holdout: float (default 0.05), the fraction of the patches held
+                out to measure the objective on, when learning in segments.
+            tol: float (default 1e-3), stop once the held-out objective has
+                improved by less than this fraction for patience segments in
+                a row. None means never stop early.
+            patience: int (default 2), see tol.
+            patchfile: str (default None), a (temporary) file to memory map
+                the training patch matrix to, for more patches than fit in
+                memory. It is deleted once the dictionary is learned. None
+                means the patch matrix is in memory.
+
+        Returns:
+            list, of dicts of the held-out objective and sparsity after each
+                segment, see utils.encode.dictionary_objective(). This is also
+                kept in dichistory. It is empty if not learning in segments.
 
         """
 
-        # Get SIFT training patches 
+        from spams import trainDL
+
+        if njobs is None:
+            njobs = get_threads(-1)
+
+        # Get normalised SIFT training patches, in trainDL's layout
         print('Getting training patches...')
-        patches = sw.training_patches(images, npatches, self.psize, self.maxdim,
-                                        verbose=True)
-        patches = pch.norm_patches(patches)
+        with memprofile.stage('patches'):
+            X = sw.training_matrix(images, npatches, self.psize, self.maxdim,
+                                   verbose=True, sampling=sampling,
+                                   cache=self.siftcache, mmap=patchfile)
         print('{0} patches requested, {1} patches found.'.format(npatches,
-                patches.shape[0]))
+                X.shape[1]))
         time.sleep(3) # Give people a chance to see this message
+
+        # Any atom index is of the old dictionary, so it is rebuilt after
+        indexed = (self.atomcentres is not None) or (self.encoder == 'aomp')
+        self.atomcentres, self.atommembers = None, None
           
         # Learn dictionary
-        print('Learning dictionary...')
-        self.dic = trainDL(np.asfortranarray(patches.T, np.float64), mode=0,
-                       K=self.dsize, lambda1=0.15, iter=niter, numThreads=njobs)
+        try:
+            with memprofile.stage('learn'):
+                if (segment is None) and (checkpoint is None):
+                    print('Learning dictionary...')
+                    self.dic, model = trainDL(X, mode=0, K=self.dsize, 
+                                              lambda1=0.15, iter=niter, 
+                                              numThreads=njobs, 
+                                              return_model=True)
+                    self.__set_model(model)
+                    self.dichistory = []
+                else:
+                    self.__learn_segments(X, niter, njobs, segment, 
+                                          checkpoint, holdout, tol, patience)
+        finally:
+            del X
+            if patchfile is not None:
+                os.remove(patchfile)
+
+        if indexed == True:
+            self.build_index()
+        if checkpoint is not None:
+            self.__save_checkpoint(checkpoint)
         print('done.')
 
+        return self.dichistory
+
+
+    def __learn_segments (self, patches, niter, njobs, segment, checkpoint,
+                          holdout, tol, patience):
+        """ Learn the dictionary in checkpointed segments, see
+            learn_dictionary(). patches is the (128, npatches) matrix from
+            utils.siftwrap.training_matrix().
+        """
+
+        from spams import trainDL
+
+        if segment is None:
+            segment = max(1, niter // 10)
+
+        # Hold out some patches, the same ones each time for the same patches.
+        # They are swapped to the last columns, so X and held are views.
+        npat = patches.shape[1]
+        nhold = int(round(holdout * npat))
+        hold = np.zeros(npat, bool)
+        hold[np.random.RandomState(0).permutation(npat)[:nhold]] = True
+        src = np.nonzero(hold[:npat - nhold])[0]
+        dst = npat - nhold + np.nonzero(~hold[npat - nhold:])[0]
+        swap = patches[:, src]
+        patches[:, src] = patches[:, dst]
+        patches[:, dst] = swap
+        X = patches[:, :npat - nhold]
+        held = patches[:, npat - nhold:].T
+
+        self.dic, self.dicA, self.dicB = None, None, None
+        self.dicniter, self.dichistory = 0, []
+        if checkpoint is not None:
+            self.__resume(checkpoint)
+
+        while (self.dicniter < niter) and \
+                (self.__plateaued(tol, patience) == False):
+
+            nit = min(segment, niter - self.dicniter)
+            print('Learning dictionary, iterations {0} to {1} of {2}...'
+                  .format(self.dicniter + 1, self.dicniter + nit, niter))
+
+            # Warm start from the last segment
+            D, model = None, None
+            if self.dic is not None:
+                D = np.array(self.dic, dtype=np.float64, order='F')
+            if (self.dicA is not None) and (self.dicB is not None):
+                model = {
+                    'A': np.array(self.dicA, dtype=np.float64, order='F'),
+                    'B': np.array(self.dicB, dtype=np.float64, order='F'),
+                    'iter': self.dicniter
+                    }
+
+            start = self.dicniter
+            self.dic, model = trainDL(X, D=D, model=model, mode=0, K=self.dsize,
+                                      lambda1=0.15, iter=nit, numThreads=njobs,
+                                      return_model=True)
+            self.__set_model(model)
+            self.dicniter = start + nit
+            self._clear_caches()
+
+            if nhold > 0:
+                obj = enc.dictionary_objective(held, self.dic, 0.15, njobs)
+                obj['iter'] = self.dicniter
+                self.dichistory.append(obj)
+                print('Held-out objective {0:.5f}, sparsity {1:.1f}.'
+                      .format(obj['objective'], obj['sparsity']))
+
+            if checkpoint is not None:
+                self.__save_checkpoint(checkpoint)
+
+        if self.dicniter < niter:
+            print('The held-out objective has stopped improving, stopped after'
+                  ' {0} iterations.'.format(self.dicniter))
+
+
+    def __plateaued (self, tol, patience):
+        """ Has the held-out objective stopped improving? """
+
+        objs = [h['objective'] for h in self.dichistory]
+        if (tol is None) or (len(objs) <= patience):
+            return False
+
+        return all(old - new < tol * abs(old) for old, new in 
+                   zip(objs[-patience-1:-1], objs[-patience:]))
+
+
+    def __save_checkpoint (self, path):
+        """ Save this object to a checkpoint, replacing the last one safely.
+
+        The new checkpoint is saved next to the old one, which is then
+        swapped out, so there is always a complete checkpoint (path, or
+        path.old during the swap).
+        """
+
+        # If the last swap was interrupted, path.old is the only checkpoint
+        if (os.path.exists(path) == False) and os.path.exists(path + '.old'):
+            os.rename(path + '.old', path)
+
+        for p in (path + '.tmp', path + '.old'):
+            if os.path.exists(p):
+                shutil.rmtree(p)
+
+        self.save(path + '.tmp')
+        if os.path.exists(path):
+            os.rename(path, path + '.old')
+        os.rename(path + '.tmp', path)
+        if os.path.exists(path + '.old'):
+            shutil.rmtree(path + '.old')
+
+
+    def __resume (self, path):
+        """ Resume dictionary learning from a checkpoint, if it exists. """
+
+        for p in (path, path + '.old'):
+            if os.path.exists(os.path.join(p, modelio.HEADER)):
+                break
+        else:
+            return
+
+        ckpt = self.load(p, mmap=False)
+        if (ckpt.dsize, ckpt.psize) != (self.dsize, self.psize):
+            raise ValueError('The checkpoint {0} is for a different dictionary'
+                             ' size or patch size!'.format(p))
+
+        self.dic = ckpt.dic
+        self.dicA, self.dicB = ckpt.dicA, ckpt.dicB
+        self.dicniter, self.dichistory = ckpt.dicniter, ckpt.dichistory
+        print('Resuming from {0}, after {1} iterations.'
+              .format(p, self.dicniter))
+
+
+    def update_dictionary (self, images, npatches=10000, niter=100, njobs=None,
+                            threshold=0.95, sampling='grid'):
+        """ Update (warm-start) the dictionary of this ScSPM with new images.
+
+        This continues the online dictionary learning [2] from the current
+        dictionary, and the learning statistics saved by learn_dictionary() (if
+        they are available, e.g. not for objects from older versions), with
+        patches from new images. So only a few iterations are needed, compared
+        with learning a dictionary from scratch.
+
+        Descriptors extracted with the old dictionary may not be comparable
+        with those extracted with the updated dictionary, the returned drift
+        report can be used to decide if they need to be re-extracted.
+
+        Arguments:
+            images: list, a list of paths to new images to use for training.
+            npatches: int (default 10000) number of SIFT patches to extract
+                from the images to use for training the dictionary.
+            niter: int (default 100), the number of iterations of dictionary
+                learning to perform.
+            njobs: int (default None), the number of threads to use. None
+                means the thread budget (see utils.threads), or the number of
+                cores if there is no budget.
+            threshold: float (default 0.95), atoms with a cosine similarity to
+                their old selves below this are counted as changed.
+            sampling: str (default 'grid'), how to sample the training patches
+                from the images, see learn_dictionary().
+
+        Returns:
+            dict, a report of how much the atoms have drifted, see
+                utils.encode.dictionary_drift().
+
+        """
+
+        from spams import trainDL
+
+        if njobs is None:
+            njobs = get_threads(-1)
+
+        if self.dic is None:
+            raise ValueError('No dictionary has been learned!')
+
+        # Get normalised SIFT training patches, in trainDL's layout
+        print('Getting training patches...')
+        with memprofile.stage('patches'):
+            X = sw.training_matrix(images, npatches, self.psize, self.maxdim,
+                                   verbose=True, sampling=sampling,
+                                   cache=self.siftcache)
+        print('{0} patches requested, {1} patches found.'.format(npatches,
+                X.shape[1]))
+
+        # Warm start from the current dictionary and learning statistics
+        olddic = np.array(self.dic, dtype=np.float64, order='F')
+        if (self.dicA is not None) and (self.dicB is not None):
+            model = {
+                'A': np.array(self.dicA, dtype=np.float64, order='F'),
+                'B': np.array(self.dicB, dtype=np.float64, order='F'),
+                'iter': self.dicniter
+                }
+        else:
+            model = None
+
+        print('Updating dictionary...')
+        with memprofile.stage('learn'):
+            dic, model = trainDL(X, D=olddic.copy(order='F'), model=model, 
+                                 mode=0, K=self.dsize, lambda1=0.15, 
+                                 iter=niter, numThreads=njobs, 
+                                 return_model=True)
+        self.dic = dic
+        self.__set_model(model)
+        self._clear_caches()
+        if (self.atomcentres is not None) or (self.encoder == 'aomp'):
+            self.build_index()
+
+        drift = enc.dictionary_drift(olddic, self.dic, threshold)
+        print('done. {0} of {1} atoms changed (cosine < {2}), mean cosine '
+              '{3:.3f}.'.format(drift['changed'], self.dsize, threshold,
+                      drift['mean_cosine']))
+
+        return drift
+
+
+    def build_index (self, nclusters=None, niter=10):
+        """ Build an index of the dictionary atoms for the 'aomp' encoder.
+
+        This only needs to be run once per dictionary, the index is saved with
+        the dictionary by save(). It is built by learn_dictionary() and
+        update_dictionary() if the encoder is 'aomp', or if there already is
+        an index (of the old dictionary).
+
+        Arguments:
+            nclusters: int (default None), the number of clusters of atoms,
+                None means sqrt(dsize).
+            niter: int (default 10), the number of k-means iterations.
+
+        """
+
+        if self.dic is None:
+            raise ValueError('No dictionary has been learned!')
+
+        # Seeded, so the same dictionary always gets the same index
+        index = enc.build_index(self.dic, nclusters, niter, 
+                                np.random.RandomState(0))
+        self.atomcentres = index.centres
+        self.atommembers = index.members
+
+
+    def learn_compression (self, feadir, ncomponents=512, batchsize=1000,
+                           whiten=False, maxfiles=None):
+        """ Learn a PCA compression of the descriptors of this ScSPM.
+
+        The PCA is fitted incrementally to (uncompressed) descriptors streamed
+        from an extraction output directory, so only batchsize descriptors are
+        in memory at once, see utils.compress. Once learned, extract() (and
+        the other extraction methods) return the PCA projections of the
+        descriptors, instead of the random projections or uncompressed
+        descriptors. The projection is saved with the dictionary by save().
+
+        Arguments:
+            feadir: str, a directory of descriptors extracted with this object
+                (before any compression), e.g. by extractor.extract_smp().
+            ncomponents: int (default 512), the number of dimensions to
+                compress the descriptors to.
+            batchsize: int (default 1000), the number of descriptors to fit
+                at once, at least ncomponents is best.
+            whiten: bool (default False), scale the projections to unit
+                variance.
+            maxfiles: int (default None), only use this many descriptors, None
+                means all of them.
+
+        Returns:
+            float, the fraction of the descriptor variance kept.
+
+        """
+
+        D = np.sum(np.array(self.levels)**2) * self.dsize
+        pca = IncrementalPCA(ncomponents)
+        for X in feature_batches(feadir, batchsize, maxfiles):
+            if X.shape[1] != D:
+                raise ValueError('The descriptors in {0} have {1} dimensions, '
+                                 'uncompressed descriptors with {2} are needed!'
+                                 .format(feadir, X.shape[1], D))
+            pca.partial_fit(X)
+
+        if pca.nsamples < ncomponents:
+            raise ValueError('At least {0} descriptors are needed, {1} found!'
+                             .format(ncomponents, pca.nsamples))
+
+        comp = pca.components.T
+        if whiten == True:
+            comp = comp / np.sqrt(pca.explained_variance() + 1e-10)
+
+        self.pcamean = pca.mean
+        self.pcacomp = np.ascontiguousarray(comp)
+        self.compress_dim = ncomponents
+        self.rmat = None
+
+        return float(pca.explained_variance_ratio().sum())
+
+
+    def __set_model (self, model):
+        """ Keep the online dictionary learning statistics from trainDL. """
+
+        self.dicA = np.asfortranarray(model['A'])
+        self.dicB = np.asfortranarray(model['B'])
+        self.dicniter = int(model['iter'])
+
 
     def get_hash (self):
         """ Get a hash (md5) of the dictionary and random matrix.
 
         This function returns an md5 hash for this object's dictionary, and a
-        seperate hash for the for the random projection matrix if it exists. 
+        seperate hash for the for the random (or learned) projection matrix if
+        it exists. 
 
         Returns:
             string dicionary md5 hash.
@@ -198,12 +1061,246 @@ class ScSPM (Descriptor):
             raise ValueError('No dictionary has been learned!')
 
         # Just calculating these hashes here because md5 is so fast
-        diccode = md5() 
-        diccode.update(self.dic)
-            
-        if self.rmat is None:
-            return diccode.hexdigest()
+        if self.pcacomp is not None:
+            return modelio.array_hash(self.dic), \
+                    modelio.array_hash(self.pcacomp)
+        elif self.rmat is None:
+            return modelio.array_hash(self.dic)
         else:
-            rmatcode = md5() 
-            rmatcode.update(self.rmat)
-            return diccode.hexdigest(), rmatcode.hexdigest() 
+            return modelio.array_hash(self.dic), modelio.array_hash(self.rmat)
+
+
+    def save (self, path):
+        """ Save this object to a (versioned, memory-mappable) model directory.
+
+        The parameters of this object are saved to a JSON header, and the
+        dictionary and random projection matrix are saved as raw numpy arrays.
+        See the modelio module for more details. Use ScSPM.load() to load the
+        saved object.
+
+        Arguments:
+            path: str, the model directory to save to.
+
+        """
+
+        if self.dic is None:
+            raise ValueError('No dictionary has been learned!')
+
+        modelio.save_model(path, self.__class__.__name__, self._params(), 
+                            dict((a, getattr(self, a)) for a in self._arrays))
+
+
+    @classmethod
+    def load (cls, path, mmap=True, verify=False):
+        """ Load a ScSPM object saved with the save() method.
+
+        Arguments:
+            path: str, the model directory to load from.
+            mmap: bool (default True), memory map the dictionary and projection
+                matrix (read only) instead of reading them into memory.
+            verify: bool (default False), check the hashes of the saved arrays.
+
+        Returns:
+            a ScSPM object.
+
+        """
+
+        header, arrays = modelio.load_model(path, mmap=mmap, verify=verify)
+        if header['class'] != cls.__name__:
+            raise ValueError('{0} is a {1} model, not a {2} model!'
+                             .format(path, header['class'], cls.__name__))
+
+        # Don't make a new random matrix, it is loaded
+        params = header['params']
+        compress_dim = params.pop('compress_dim')
+        dicniter = params.pop('dicniter', 0)
+        dichistory = params.pop('dichistory', [])
+        params['levels'] = tuple(params['levels'])
+        obj = cls(**params)
+        obj.compress_dim = compress_dim
+        obj.dicniter = dicniter
+        obj.dichistory = dichistory
+        
+        for a in cls._arrays:
+            setattr(obj, a, arrays.get(a))
+
+        return obj
+
+
+    def _params (self):
+        """ Get the (JSON-able) parameters of this object for saving. """
+
+        return {
+            'maxdim': self.maxdim,
+            'psize': self.psize,
+            'pstride': self.pstride,
+            'active': self.active,
+            'dsize': self.dsize,
+            'levels': list(self.levels),
+            'compress_dim': self.compress_dim,
+            'encoder': self.encoder,
+            'alpha': self.alpha,
+            'pooling': self.pooling,
+            'probes': self.probes,
+            'flat_threshold': self.flat_threshold,
+            'dicniter': self.dicniter,
+            'dichistory': self.dichistory
+            }
+
+
+    def _clear_caches (self):
+        """ Reset the (per-process) cached values, e.g. the Gram matrix. """
+
+        for c in self._caches:
+            setattr(self, c, None)
+
+
+    def __getstate__ (self):
+        """ Pickle memory mapped arrays by file name, not by value. """
+
+        state = self.__dict__.copy()
+        state['_mapped'] = {}
+
+        for c in self._caches:
+            state.pop(c, None)
+
+        for a in self._arrays:
+            if isinstance(state.get(a), np.memmap):
+                state['_mapped'][a] = state[a].filename
+                state[a] = None
+
+        return state
+
+
+    def __setstate__ (self, state):
+        """ Re-map arrays pickled by __getstate__, and set missing defaults. """
+
+        mapped = state.pop('_mapped', {})
+
+        # Objects pickled by older versions may not have newer attributes
+        state.setdefault('encoder', 'omp')
+        state.setdefault('alpha', 0.25)
+        state.setdefault('probes', 4)
+        state.setdefault('pooling', 'max')
+        state.setdefault('atomcentres', None)
+        state.setdefault('atommembers', None)
+        state.setdefault('flat_threshold', None)
+        state.setdefault('dicA', None)
+        state.setdefault('dicB', None)
+        state.setdefault('dicniter', 0)
+        state.setdefault('dichistory', [])
+        state.setdefault('pcamean', None)
+        state.setdefault('pcacomp', None)
+        state.setdefault('siftcache', None)
+        self.__dict__.update(state)
+        self._clear_caches()
+
+        for a, fname in mapped.items():
+            setattr(self, a, np.load(fname, mmap_mode='r'))
+
+
+class ScSPMSweep ():
+    """ Extract descriptors for many ScSPM configurations at once.
+
+    This is for parameter sweeps, e.g. over levels, compress_dim, active or
+    pooling. Each image is decoded and SIFT'd once for all configurations,
+    encoded once per (dictionary, encoder, active, ...) and pooled once per
+    (levels, pooling) of those, and only normalised and projected once per
+    configuration. So a sweep costs not much more than its most expensive
+    configuration, rather than the sum of them.
+
+    The way this class is typically used is
+
+        sweep = ScSPMSweep([ScSPM.load(m) for m in models])
+        extractor.extract_sweep(filelist, savedirs, sweep)
+
+    Arguments:
+        descs: list, of ScSPM objects (with dictionaries), which must all have
+            the same maxdim, psize and pstride. The SIFT cache of the first
+            (see ScSPM.use_sift_cache()), if any, is used for all of them.
+
+    """
+
+    def __init__ (self, descs):
+
+        if len(descs) == 0:
+            raise ValueError('No configurations to sweep!')
+        if len(set((d.maxdim, d.psize, d.pstride) for d in descs)) > 1:
+            raise ValueError('All of the configurations need the same maxdim,'
+                             ' psize and pstride!')
+        if any(d.dic is None for d in descs):
+            raise ValueError('No dictionary has been learned!')
+
+        self.descs = descs
+        self.maxdim = descs[0].maxdim
+        self.psize = descs[0].psize
+        self.pstride = descs[0].pstride
+        self.norms = any(d.flat_threshold is not None for d in descs)
+        self.siftcache = descs[0].siftcache # Use the first's SIFT cache, if any
+
+        # Group the configurations by their encoding, then their pooling
+        self.groups = []    # [(encoding ScSPM, [((levels, pooling), [i])])]
+        ekeys, pkeys = [], []
+        for i, d in enumerate(descs):
+            ekey = (modelio.array_hash(d.dic), d.encoder, d.active, d.alpha,
+                    d.probes, d.flat_threshold)
+            if ekey not in ekeys:
+                ekeys.append(ekey)
+                pkeys.append([])
+                self.groups.append((d, []))
+            e = ekeys.index(ekey)
+
+            pkey = (tuple(d.levels), d.pooling)
+            if pkey not in pkeys[e]:
+                pkeys[e].append(pkey)
+                self.groups[e][1].append((pkey, []))
+            self.groups[e][1][pkeys[e].index(pkey)][1].append(i)
+
+
+    def __len__ (self):
+
+        return len(self.descs)
+
+
+    def extract (self, impath):
+        """ Extract the descriptors of all of the configurations for an image.
+
+        Arguments:
+            impath: str, the path to an image (or a decoded image array).
+
+        Returns:
+            list, of the descriptor (array) of each configuration, in order.
+
+        """
+
+        if self.siftcache is not None:
+            patches, cx, cy, norms, imshape = self.siftcache.sift(impath)
+        elif self.norms == True:
+            img = pch.imread_resize(impath, self.maxdim)
+            imshape = img.shape
+            patches, cx, cy, norms = sw.DSIFT_patches(img, self.psize,
+                                                      self.pstride, norms=True)
+        else:
+            img = pch.imread_resize(impath, self.maxdim)
+            imshape = img.shape
+            patches, cx, cy = sw.DSIFT_patches(img, self.psize, self.pstride)
+            norms = None
+
+        feas = [None] * len(self.descs)
+        bins = {}
+        for encdesc, pools in self.groups:
+            codes = encdesc.encode(patches, norms=norms)
+
+            for (levels, pooling), idxs in pools:
+                if levels not in bins:
+                    bins[levels] = pch.pyramid_bins(cx, cy, imshape, levels)
+                pooled = pch.pyramid_pooling(codes, cx, cy, imshape, levels,
+                                             pfun=POOLINGS[pooling],
+                                             bins=bins[levels])
+
+                # Normalisation is in place, so all but the last need a copy
+                for n, i in enumerate(idxs):
+                    fea = pooled if n == len(idxs) - 1 else pooled.copy()
+                    feas[i] = self.descs[i]._normalise(fea)
+
+        return feas
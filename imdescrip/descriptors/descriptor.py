@@ -39,3 +39,30 @@ class Descriptor:
         pass
 
 
+    def memory_estimate (self, imsize):
+        """ Estimate the peak memory (bytes) needed to extract from an image.
+
+            This method is optional, it is used by the batch extractors to
+            only run as many extractions at once as fit in a memory budget.
+
+            Arguments:
+                imsize: tuple (height, width) of the (original) image size.
+
+            Returns:
+                int, the estimated number of bytes, or None if unknown.
+        """
+        return None
+
+
+    def workspace (self):
+        """ Make a workspace of buffers to re-use between extractions.
+
+            This method is optional. If it returns a workspace object, the
+            batch extractors make one per worker, and pass it to every call of
+            extract(image, workspace=workspace), so buffers do not need to be
+            allocated for every image.
+
+            Returns:
+                a workspace object, or None if not supported.
+        """
+        return None
@@ -19,12 +19,32 @@
 """ Module for image descriptor extraction. """
 
 
-import os, itertools, cPickle, time
+import os, time, signal, json, shutil, cPickle
 import multiprocessing as mp
+from multiprocessing.queues import SimpleQueue
 from utils.progress import Progress
+from utils.schedule import Scheduler, image_info, load_balance
+from utils.memory import parse_size, peak_rss, reset_peak_rss, MemoryStats
+from utils.journal import Journal, JOURNAL, worker_journal, merge_journals
+from utils.threads import thread_budget, set_threads, get_threads, pin_cores
+from utils.threads import claim_slot
+from utils.dedup import image_hash, find_duplicates, write_duplicates
+from utils.telemetry import make_telemetry
+from utils.shards import read_shard, member_key
+from utils.image import imdecode_resize
+from utils import memprofile
 
 
-def extract (imfile, savedir, descobj):
+MEMLOG = 'memory.jsonl'
+
+
+class ExtractTimeout (Exception):
+    """ Raised when the extraction of an image takes too long. """
+    pass
+
+
+def extract (imfile, savedir, descobj, journal=None, workspace=None,
+             info=None):
     """ Extract features/descriptors from a single image.
 
     This function calls an image descripor object on a single image in order to
@@ -41,6 +61,12 @@ def extract (imfile, savedir, descobj):
         decobj:   An image descriptor object which does the actual extraction
                   work. the method called is descobj.extract(image). See
                   descriptors.Descriptor for an abstract base class. 
+        journal:  utils.journal.Journal, where to record errors. By default
+                  this is "errors.log" in savedir.
+        workspace: a workspace object from descobj.workspace() (default None),
+                  which is passed to descobj.extract() to re-use its buffers.
+        info:     dict (default None), if given the number of bytes written is
+                  recorded in it (as 'nbytes').
     
     Returns:
         False if there were no errors encountered, true if otherwise. See
@@ -48,8 +74,7 @@ def extract (imfile, savedir, descobj):
 
     """
     
-    imname = os.path.splitext(os.path.split(imfile)[1])[0] # get image name
-    feafile = os.path.join(savedir, imname + ".p")
+    feafile = __feafile(imfile, savedir)
 
     # Check to see if feature file already exists, continue if so
     if os.path.exists(feafile) == True:
@@ -57,25 +82,37 @@ def extract (imfile, savedir, descobj):
 
     # Extract image descriptors
     try:
-        fea = descobj.extract(imfile) # extract image descriptor
+        fea = __describe(descobj, imfile, workspace)
+    except ExtractTimeout:
+        raise
     except Exception as e:
-        with open(os.path.join(savedir, 'errors.log'), 'a') as l:
-            l.write('{0} : {1}\n'.format(imfile, e))
+        if journal is None:
+            journal = Journal(os.path.join(savedir, JOURNAL))
+        journal.write(imfile, e)
         return True
 
-    # Write pickled feature
-    with open(feafile, 'wb') as f:
-        cPickle.dump(fea, f, protocol=2)
-
+    with memprofile.stage('serialise'):
+        __write_feature(fea, feafile, info)
     return False
 
 
-def extract_batch (filelist, savedir, descobj, verbose=False):
+def extract_batch (filelist, savedir, descobj, verbose=False, threads=None,
+                   dedup=None, dedup_mode='copy', telemetry=None,
+                   profile_memory=False):
     """ Extract features/descriptors from a batch of images. Single-threaded. 
 
     This function calls an image descripor object on a batch of images in order
     to extract the images descripor. If a feature/descriptor file already exists
-    for the image, it is skipped. This is a single-threaded pipeline.
+    for the image, it is skipped. This is a single-process pipeline.
+
+    Setting threads gives a low-latency mode, where each image is processed by
+    one process using many threads (in BLAS and SPAMs), so each descriptor is
+    ready as soon as possible. extract_smp() has a higher throughput.
+
+    Setting dedup skips the extraction of near-duplicate images, setting
+    telemetry writes periodic throughput snapshots, and setting profile_memory
+    measures the memory of each stage of each image, see extract_smp(). The
+    memory profile is written to the run report, "report.json" in savedir.
 
     Arguments:
         filelist: A list of files of image names including their paths of images
@@ -88,12 +125,26 @@ def extract_batch (filelist, savedir, descobj, verbose=False):
                   work. the method called is descobj.extract(image). See
                   descriptors.Descriptor for an abstract base class. 
         verbose:  bool, display progress?
+        threads:  int, the number of threads the native libraries (BLAS,
+                  SPAMs) can use for each image, see utils.threads. None
+                  (default) leaves the thread budget as it is.
+        dedup:    float, the similarity (fraction of equal perceptual hash
+                  bits, e.g. 0.9) above which images are near-duplicates, see
+                  extract_smp(). None (default) means no duplicate detection.
+        dedup_mode: str (default 'copy'), 'copy' to use the descriptor of the
+                  first of a set of near-duplicate images for the others, or
+                  'skip' to not write descriptors for the duplicates at all.
+        telemetry: str or utils.telemetry.RunTelemetry, where to write
+                  throughput telemetry, see extract_smp(). None (default)
+                  means no telemetry.
+        profile_memory: bool (default False), profile the peak memory of
+                  each stage of each image, see extract_smp().
 
     Returns:
         True if there we any errors extracting image features. False otherwise. 
         If there is a problem extracting any image descriptors, a file
-        "errors.log" is created in the savedir directory with a list of file
-        names, error number and messages.
+        "errors.log" is created in the savedir directory with a (JSON lines)
+        list of file names, error types and messages.
 
     """
 
@@ -101,24 +152,75 @@ def extract_batch (filelist, savedir, descobj, verbose=False):
     if not os.path.exists(savedir):
         os.mkdir(savedir)
 
+    if threads is not None:
+        oldthreads = get_threads(None)
+        set_threads(threads)
+
     errflag = False
+    journal = Journal(os.path.join(savedir, JOURNAL))
+    workspace = __workspace(descobj)
+
+    # Leave out near-duplicate images
+    if dedup is not None:
+        duplicates = __find_duplicates(filelist, map(image_hash, filelist),
+                                       savedir, dedup, dedup_mode)
+        filelist = [f for f in filelist if f not in duplicates]
 
     # Set up progess updates
     nfiles = len(filelist)
     progbar = Progress(nfiles, title='Extracting descriptors', verbose=verbose)
+    tel = make_telemetry(telemetry)
+    tel.start(nfiles)
+    pid = os.getpid()
+
+    # Profile memory, unless the caller already is
+    profiler, ownprofiler = memprofile.active(), False
+    if (profile_memory == True) and (profiler is None):
+        profiler, ownprofiler = memprofile.enable(), True
 
     # Iterate through all of the images in filelist and extract features
-    for i, impath in enumerate(filelist):
-        errflag |= extract(impath, savedir, descobj) 
-        progbar.update(i)
+    try:
+        for i, impath in enumerate(filelist):
+            start, info = time.time(), {}
+            with memprofile.image(impath) as stages:
+                err = extract(impath, savedir, descobj, journal, workspace, 
+                              info)
+            if profile_memory == True:
+                __log_memory(savedir, impath, stages)
+            errflag |= err
+            progbar.update(i)
+            tel.record(pid, time.time() - start, err, info.get('nbytes', 0))
+            tel.queue(nfiles - i - 1)
+            tel.tick()
+    finally:
+        if threads is not None:
+            set_threads(oldthreads)
+        if ownprofiler == True:
+            memprofile.disable()
 
     progbar.finished()
+    tel.finish()
+
+    if profile_memory == True:
+        __write_report(savedir, {
+            'nimages': nfiles,
+            'memory': {'stages': profiler.summary()}
+            })
+
+    if dedup is not None:
+        __resolve_duplicates(savedir, duplicates, dedup_mode)
     
     if errflag == True:
         print('Done with errors. See the "errors.log" file in ' + savedir)
 
+    return errflag
 
-def extract_smp (filelist, savedir, descobj, njobs=None, verbose=False):
+
+def extract_smp (filelist, savedir, descobj, njobs=None, verbose=False,
+                 timeout=None, retries=1, retry_errors=False,
+                 maxtasksperchild=None, schedule='cost', chunktime=2.,
+                 membudget=None, threads=None, pin=False, dedup=None,
+                 dedup_mode='copy', telemetry=None, profile_memory=False):
     """ Extract features/descriptors from a batch of images. Multi-threaded. 
 
     This function calls an image descripor object on a batch of images in order
@@ -126,6 +228,61 @@ def extract_smp (filelist, savedir, descobj, njobs=None, verbose=False):
     for the image, it is skipped. This is a multi-threaded (SMP) pipeline
     suitable for running on a single computer.
 
+    By default images are scheduled largest first (the size is read from the
+    image headers), and are handed to workers in chunks that adapt to the
+    observed throughput, so all workers finish at about the same time. See
+    utils.schedule for more details. The achieved load balance is written to
+    the run report, "report.json" in savedir.
+
+    If membudget is set, only as many images are processed at once as fit in
+    this much memory. The memory each image needs is estimated from its size
+    (from its header) by descobj.memory_estimate(), see
+    descriptors.Descriptor. A chunk's memory is counted from when it starts
+    until it finishes. Chunks are only handed to the workers when one is
+    free (rather than queued ahead), so the chunks waiting to start are not
+    counted against the budget while the workers are busy. The actual peak
+    resident memory of each worker while processing each image is measured,
+    and summarised in the run report.
+
+    Images that take too long, or that crash a worker process, do not stall
+    the whole job. If timeout is set, an ExtractTimeout is raised in a worker
+    once an image has taken timeout seconds, and if the worker is stuck (e.g.
+    in a native library) it is killed after 1.5 * timeout seconds, and
+    replaced with a fresh worker. These images (and images being processed by
+    workers that die) are retried up to retries times. Chunks of images taken
+    by workers that die before starting them are put back in the queue.
+
+    Each worker writes errors to its own journal, and these are merged into
+    "errors.log" in savedir at the end of the run, see utils.journal. Every
+    failed attempt at an image is recorded.
+
+    The cores are shared between the workers, the native libraries (BLAS,
+    SPAMs) of each worker are limited to a budget of threads (by default
+    cores / njobs), so the machine is not oversubscribed. See utils.threads
+    for more details, and scripts/benchmark_threads.py for finding the best
+    split of processes and threads.
+
+    If dedup is set, a cheap pre-pass finds near-duplicate images (e.g.
+    overlapping consecutive frames) from a perceptual hash of a tiny decode of
+    each image, and only the first image of each set of near-duplicates has
+    its descriptor extracted. The others either get a copy of its descriptor
+    (dedup_mode='copy') or none at all ('skip'). Which images are duplicates
+    of which is written to "duplicates.json" in savedir, see utils.dedup.
+
+    If telemetry is set, snapshots of the run's throughput (images/second,
+    rolling ETA, error rate, queue depth, bytes written and per-worker
+    throughput) are written periodically, as JSON lines or a Prometheus
+    textfile, for monitoring from outside the run. See utils.telemetry.
+
+    If profile_memory is set, the peak memory allocated, and the change in
+    resident memory, of each stage of the extraction (e.g. decode, sift,
+    encode, pool, project and serialise for ScSPM) of each image is measured,
+    see utils.memprofile. A summary of each stage over all of the images, with
+    the images that needed the most memory, is written to the run report, and
+    the stages of each image to "memory.jsonl" in savedir. This is for
+    choosing njobs, maxdim and the memory of the nodes of a cluster from
+    measurements, it costs a little time per stage.
+
     Arguments:
         filelist: A list of files of image names including their paths of images
                   to read and extract descriptors from
@@ -136,15 +293,53 @@ def extract_smp (filelist, savedir, descobj, njobs=None, verbose=False):
         decobj:   An image descriptor object which does the actual extraction
                   work. the method called is descobj.extract(image). See
                   descriptors.Descriptor for an abstract base class. 
-        njobs:    int, Number of threads to use. If None, then the number of
-                  threads is chosen to be the same as the number of cores.
+        njobs:    int, Number of worker processes to use. If None, then the
+                  number of processes is chosen to be the same as the number of
+                  cores.
         verbose:  bool, display progress?
+        timeout:  float, the maximum number of seconds to spend on one image.
+                  None (default) means no limit.
+        retries:  int (default 1), the number of times to retry an image that
+                  timed out, or that was being processed by a worker that died.
+        retry_errors: bool (default False), also retry images that raised an
+                  error (these are usually just corrupt images).
+        maxtasksperchild: int, the number of tasks (chunks of images) a worker
+                  process completes before it is replaced by a fresh process,
+                  this contains memory leaks in native libraries. None
+                  (default) means workers are never replaced.
+        schedule: str (default 'cost'), 'cost' to process images largest first,
+                  or 'fifo' to process them in the given order.
+        chunktime: float (default 2.), the number of seconds each chunk of
+                  images should take to process.
+        membudget: int or str, the memory (bytes, or e.g. '32G') that all of
+                  the images being processed at once can use. An image that
+                  needs more than this on its own is processed alone. None
+                  (default) means no limit. This does not include the baseline
+                  memory of each worker process.
+        threads:  int, the number of threads each worker's native libraries
+                  can use. None (default) means cores / njobs (at least 1).
+        pin:      bool (default False), pin each worker to its own set of
+                  cores, one per thread (this needs psutil on Python 2). A
+                  worker that replaces one that died (or was recycled) gets
+                  its cores.
+        dedup:    float, the similarity (fraction of equal perceptual hash
+                  bits, e.g. 0.9) above which images are near-duplicates. None
+                  (default) means no duplicate detection.
+        dedup_mode: str (default 'copy'), 'copy' to use the descriptor of the
+                  first of a set of near-duplicate images for the others, or
+                  'skip' to not write descriptors for the duplicates at all.
+        telemetry: str or utils.telemetry.RunTelemetry, where to write
+                  throughput telemetry. A file name ending in ".prom" is a
+                  Prometheus textfile, others are JSON lines. None (default)
+                  means no telemetry.
+        profile_memory: bool (default False), profile the peak memory of
+                  each stage of each image.
 
     Returns:
         True if there we any errors extracting image features. False otherwise. 
         If there is a problem extracting any image descriptors, a file
-        "errors.log" is created in the savedir directory with a list of file
-        names, error number and messages.
+        "errors.log" is created in the savedir directory with a (JSON lines)
+        list of file names, error types and messages.
 
     """
 
@@ -152,35 +347,746 @@ def extract_smp (filelist, savedir, descobj, njobs=None, verbose=False):
     if not os.path.exists(savedir):
         os.mkdir(savedir)
 
-    # Set up parallel job
-    pool = mp.Pool(processes=njobs)
+    if njobs is None:
+        njobs = mp.cpu_count()
 
-    # Iterate through all of the images in filelist and extract features
-    result = pool.map_async(__extract_star, itertools.izip(filelist, 
-                    itertools.repeat(savedir), itertools.repeat(descobj)))
+    if schedule not in ('cost', 'fifo'):
+        raise ValueError("schedule must be 'cost' or 'fifo'!")
 
-    # Set up progess updates
+    if threads is None:
+        threads = thread_budget(njobs)
+
+    if dedup_mode not in ('copy', 'skip'):
+        raise ValueError("dedup_mode must be 'copy' or 'skip'!")
+
+    starttime = time.time()
+
+    # Set up parallel job, the descriptor object is only sent once per worker.
+    # The status queue is unbuffered, so task starts are seen even if a worker
+    # then dies.
+    status = SimpleQueue()
+    slots = mp.Array('i', njobs) if pin == True else None # Pinned cores
+    pool = mp.Pool(processes=njobs, initializer=__init_worker, 
+                   initargs=(savedir, descobj, status, timeout, threads,
+                             slots, profile_memory),
+                   maxtasksperchild=maxtasksperchild)
+
+    # Leave out near-duplicate images
     nfiles = len(filelist)
-    progbar = Progress(nfiles, title='Extracting descriptors', verbose=verbose)
+    duplicates = {}
+    if dedup is not None:
+        duplicates = __find_duplicates(filelist, pool.map(image_hash, filelist,
+                                       chunksize=64), savedir, dedup,
+                                       dedup_mode)
+        filelist = [f for f in filelist if f not in duplicates]
+
+    # Schedule the work
+    if len(filelist) == 0:
+        sizes, costs = (), ()
+    elif (schedule == 'cost') or (membudget is not None):
+        sizes, costs = zip(*pool.map(image_info, filelist, chunksize=64))
+    else:
+        sizes, costs = [None] * len(filelist), [1.] * len(filelist)
+    sched = Scheduler(costs, njobs, target=chunktime, 
+                      order=(schedule == 'cost'))
+
+    # Memory budget
+    if membudget is not None:
+        membudget = parse_size(membudget)
+        memest = [__memory_estimate(descobj, z, c) for z, c in zip(sizes, 
+                  costs)]
+    else:
+        memest = [None] * len(filelist)
+    memuse = 0                          # Estimated memory of running tasks
+    inflight = 2 * njobs if membudget is None else njobs # Tasks in the pool
+    memstats = MemoryStats()
+    profiler = memprofile.StageProfiler() if profile_memory == True else None
+
+    tasks = {}                          # task id -> task state, see below
+    attempts = [0] * len(filelist)
+    busy = {}                           # worker pid -> seconds busy
+    lost = False                        # Tasks lost to dead/killed workers
+    workers = {}                        # worker pid -> Process, to see exits
+    accounted = set()                   # Dead workers whose tasks were found
+    orphans = []                        # When workers died holding no task
+    nerrors = 0
+    ndone = 0
+    tid = 0
+    journal = worker_journal(savedir)   # For errors found by this process
+
+    # Set up progess updates
+    progbar = Progress(len(filelist), title='Extracting descriptors',
+                       verbose=verbose)
+    tel = make_telemetry(telemetry)
+    tel.start(len(filelist), njobs)
+
+    def finish (fidx, code, error=None):
+        """ Finish, or retry, an image. Returns the number of errors. """
+
+        if (code == __TIMEOUT) or ((code == __ERROR) and (retry_errors == True)):
+            if attempts[fidx] <= retries:
+                sched.requeue([fidx])
+                return 0, 0
+        if error is not None:
+            journal.write(filelist[fidx], error, attempts=attempts[fidx])
+        return int(code != __OK), 1
+
+    while (len(sched) > 0) or (len(tasks) > 0):
+
+        # Keep enough tasks queued so no worker is waiting for work
+        while (len(sched) > 0) and (len(tasks) < inflight):
+            chunk = sched.next_chunk()
+
+            # Only admit tasks that fit in the memory budget, with the running
+            # tasks and those about to start (on free workers)
+            mem = 0
+            if membudget is not None:
+                mem = max(memest[f] for f in chunk)
+                starting = sum(task['mem'] for task in tasks.values() if
+                               task['pid'] is None)
+                if (len(tasks) > 0) and (memuse + starting + mem > membudget):
+                    sched.requeue(chunk, front=True)
+                    break
+
+            tasks[tid] = {
+                'files': chunk,     # File indices
+                'result': pool.apply_async(__extract_worker, (tid, 
+                            [filelist[f] for f in chunk])),
+                'pid': None,        # Worker running this task
+                'pos': 0,           # Position of the next/current file
+                'start': None,      # Start time of the current file 
+                'dead': None,       # When the worker was first seen dead
+                'queued': time.time(), # When the task was queued
+                'mem': mem          # Estimated memory of the task
+                }
+            tid += 1
+
+        # Find out which tasks are finished, then get all status messages
+        time.sleep(0.05)
+        finished = [t for t, task in tasks.items() if task['result'].ready()]
+
+        while status.empty() == False:
+            t, pos, pid, now, code, info = status.get()
+            task = tasks.get(t)
+            if task is None:
+                continue
+            fidx = task['files'][pos]
+
+            if code is None:        # Image started
+                if task['pid'] is None:
+                    memuse += task['mem']
+                task['pid'], task['start'], task['pos'] = pid, now, pos
+                attempts[fidx] += 1
+            else:                   # Image finished
+                seconds = now - task['start']
+                busy[pid] = busy.get(pid, 0.) + seconds
+                sched.record(fidx, seconds)
+                task['start'], task['pos'] = None, pos + 1
+                memstats.add(filelist[fidx], info.get('peak_rss'), 
+                             memest[fidx])
+                if profiler is not None:
+                    profiler.add(filelist[fidx], info.get('stages', {}))
+                    __log_memory(savedir, filelist[fidx], info.get('stages',
+                                 {}))
+                nerr, ndn = finish(fidx, code)
+                nerrors += nerr
+                ndone += ndn
+                tel.record(pid, seconds, nerr > 0, info.get('nbytes', 0),
+                           ndn > 0)
+
+        for t in finished:
+            task = tasks.pop(t)
+            memuse -= task['mem']
+            task['result'].get()    # Raise any unexpected errors
+
+        # Find workers that died (recycled workers exit cleanly) without a
+        # task that was still being processed. The pool has no public list of
+        # its workers.
+        now = time.time()
+        for proc in pool._pool:
+            workers.setdefault(proc.pid, proc)
+        for pid, proc in workers.items():
+            if proc.exitcode is None:
+                continue
+            del workers[pid]
+            if (proc.exitcode != 0) and (pid not in accounted) and \
+                    all((task['pid'] != pid) or (task['pos'] >= 
+                        len(task['files'])) for task in tasks.values()):
+                orphans.append(now)
+
+        # These may have died after taking a task, but before starting it.
+        # Tasks are taken in order, so that is the oldest unstarted task of
+        # the first njobs, if it was queued before the worker died.
+        for death in sorted(orphans):
+            waiting = [t for t in sorted(tasks)[:njobs] if (tasks[t]['pid']
+                       is None) and (tasks[t]['queued'] <= death)]
+            if len(waiting) == 0:   # It didn't have a task
+                orphans.remove(death)
+                continue
+
+            # Give the start messages of workers that just died time to arrive
+            if now - death < 1.:
+                break
+
+            orphans.remove(death)
+            task = tasks.pop(waiting[0])    # (Its memory wasn't counted)
+            lost = True
+            sched.requeue(task['files'], front=True)
+
+        # Find tasks that are stuck, or that were on workers that died
+        for t, task in tasks.items():
+            if task['pid'] is None:
+                continue
+
+            stuck = (timeout is not None) and (task['start'] is not None) \
+                    and (now - task['start'] > 1.5 * timeout)
+            if (stuck == False) and (__is_alive(task['pid']) == True):
+                continue
+
+            # Give the results of workers that just exited time to arrive
+            if stuck == False:
+                if task['dead'] is None:
+                    task['dead'] = now
+                if now - task['dead'] < 1.:
+                    continue
+
+            tasks.pop(t)
+            memuse -= task['mem']
+            lost = True
+            accounted.add(task['pid'])
+
+            # Retry (or give up on) the image being processed
+            if stuck == True:
+                __kill(task['pid'])
+                error = ExtractTimeout('Worker killed after {0:.1f}s.'
+                                       .format(now - task['start']))
+                code = __TIMEOUT
+            else:
+                error = RuntimeError('Worker process died.')
+                code = __TIMEOUT
+
+            if task['start'] is not None:
+                busy[task['pid']] = busy.get(task['pid'], 0.) + now \
+                                    - task['start']
+                nerr, ndn = finish(task['files'][task['pos']], code, error)
+                nerrors += nerr
+                ndone += ndn
+                tel.record(task['pid'], now - task['start'], nerr > 0, 0,
+                           ndn > 0)
+                task['pos'] += 1
+
+            # Put the rest of the chunk back at the front of the queue
+            sched.requeue(task['files'][task['pos']:], front=True)
 
-    # Get the status
-    while ((result.ready() is not True) and (verbose == True)):
-        approx_rem = nfiles - result._number_left * result._chunksize
-        progbar.update(max(0, approx_rem)) 
-        time.sleep(5)
+        progbar.update(ndone)
+        tel.queue(len(sched))
+        tel.tick()
 
     progbar.finished()
+    tel.finish()
 
-    # Get notification of errors
-    errflag = any(result.get())
-    pool.close()
+    # A pool with lost tasks will never finish closing, so terminate it
+    if lost == True:
+        pool.terminate()
+    else:
+        pool.close()
     pool.join()
 
+    # Gather all of the per-worker error journals
+    merge_journals(savedir)
+    errflag = nerrors > 0
+
+    if dedup is not None:
+        __resolve_duplicates(savedir, duplicates, dedup_mode)
+
+    # Report on the run
+    report = {
+        'nimages': nfiles,
+        'nerrors': nerrors,
+        'nduplicates': len(duplicates),
+        'load_balance': load_balance(busy, time.time() - starttime, njobs),
+        'memory': dict(memstats.summary(), budget=membudget)
+        }
+    if profiler is not None:
+        report['memory']['stages'] = profiler.summary()
+    __write_report(savedir, report)
+
+    if verbose == True:
+        lb = report['load_balance']
+        print('Load balance: {0:.1f}s wall, {1:.1f}s ideal ({2:.0%} efficient)'
+              .format(lb['wall_seconds'], lb['ideal_seconds'],
+                      lb['efficiency']))
+
+    if errflag == True:
+        print('Done, with errors. See the "errors.log" file in ' + savedir)
+
+    return errflag
+
+
+def extract_shards (shardlist, savedir, descobj, njobs=None, verbose=False,
+                    threads=None):
+    """ Extract features/descriptors from images in shards (tar/zip archives).
+
+    Each shard is read sequentially, in large reads, and its images are
+    decoded from memory, see utils.shards. This avoids the per-file overheads
+    of millions of loose images on shared storage. Each shard is a unit of
+    work, the shards are processed in parallel by njobs worker processes, the
+    largest shards first.
+
+    The descriptors are saved with the member names of the images, e.g. the
+    descriptor of "survey1/im0001.jpg" (in any shard) is saved to
+    "survey1/im0001.p" in savedir. If a descriptor file already exists for an
+    image, it is skipped.
+
+    Arguments:
+        shardlist: A list of shard (tar or zip archive) file names.
+        savedir:  A directory in which to save all of the image features, see
+                  extract_smp().
+        decobj:   An image descriptor object which does the actual extraction
+                  work. the method called is descobj.extract(image), where
+                  image is a decoded image array.
+        njobs:    int, Number of worker processes to use. If None, then the
+                  number of processes is chosen to be the same as the number of
+                  cores.
+        verbose:  bool, display progress?
+        threads:  int, the number of threads each worker's native libraries
+                  can use. None (default) means cores / njobs (at least 1).
+
+    Returns:
+        True if there we any errors extracting image features. False otherwise. 
+        Errors are written to "errors.log" in savedir, the images are named
+        "shard:member".
+
+    """
+
+    # Try to make the save path
+    if not os.path.exists(savedir):
+        os.mkdir(savedir)
+
+    if njobs is None:
+        njobs = mp.cpu_count()
+
+    if threads is None:
+        threads = thread_budget(njobs)
+
+    starttime = time.time()
+
+    # Largest shards first, so the run doesn't end waiting on one big shard
+    shards = sorted(shardlist, key=lambda s: -os.path.getsize(s))
+
+    pool = mp.Pool(processes=njobs, initializer=__init_shard_worker,
+                   initargs=(savedir, descobj, threads))
+    progbar = Progress(len(shards), title='Extracting shards', verbose=verbose)
+
+    nimages, nerrors = 0, 0
+    try:
+        for i, (nimg, nerr) in enumerate(pool.imap_unordered(__shard_worker,
+                                                             shards)):
+            nimages += nimg
+            nerrors += nerr
+            progbar.update(i + 1)
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+    progbar.finished()
+
+    # Gather all of the per-worker error journals
+    merge_journals(savedir)
+    errflag = nerrors > 0
+
+    __write_report(savedir, {
+        'nshards': len(shards),
+        'nimages': nimages,
+        'nerrors': nerrors,
+        'wall_seconds': time.time() - starttime
+        })
+
     if errflag == True:
         print('Done, with errors. See the "errors.log" file in ' + savedir)
 
+    return errflag
+
+
+def extract_sweep (filelist, savedirs, sweepobj, njobs=None, verbose=False,
+                   threads=None):
+    """ Extract features/descriptors for many configurations at once.
+
+    This is for parameter sweeps, where each image needs a descriptor for each
+    of many descriptor configurations, and these share work (e.g. decoding and
+    SIFT), see descriptors.ScSPM.ScSPMSweep. Each configuration's descriptors
+    are saved to its own directory. Images that already have all of their
+    descriptors are skipped.
+
+    Arguments:
+        filelist: A list of files of image names including their paths of images
+                  to read and extract descriptors from
+        savedirs: A list of directories, one per configuration, in which to
+                  save the image features, see extract_smp().
+        sweepobj: A sweep object, whose extract(image) method returns a list of
+                  descriptors, one per configuration (savedir), e.g. a
+                  descriptors.ScSPM.ScSPMSweep object.
+        njobs:    int, Number of worker processes to use. If None, then the
+                  number of processes is chosen to be the same as the number of
+                  cores.
+        verbose:  bool, display progress?
+        threads:  int, the number of threads each worker's native libraries
+                  can use. None (default) means cores / njobs (at least 1).
+
+    Returns:
+        True if there we any errors extracting image features. False otherwise. 
+        Errors are written to "errors.log" in every savedir.
+
+    """
+
+    for savedir in savedirs:
+        if not os.path.exists(savedir):
+            os.makedirs(savedir)
+
+    if njobs is None:
+        njobs = mp.cpu_count()
+
+    if threads is None:
+        threads = thread_budget(njobs)
+
+    pool = mp.Pool(processes=njobs, initializer=__init_sweep_worker,
+                   initargs=(savedirs, sweepobj, threads))
+    progbar = Progress(len(filelist), title='Extracting descriptors',
+                       verbose=verbose)
 
-def __extract_star (args):
-    """ Covert args to (file, savedir, descobj) arguments. """
+    nerrors = 0
+    try:
+        for i, err in enumerate(pool.imap_unordered(__sweep_worker, filelist,
+                                                    chunksize=4)):
+            nerrors += int(err)
+            progbar.update(i + 1)
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+    progbar.finished()
 
-    return extract(*args)
+    for savedir in savedirs:
+        merge_journals(savedir)
+
+    if nerrors > 0:
+        print('Done, with errors. See the "errors.log" files in ' 
+              + ', '.join(savedirs))
+
+    return nerrors > 0
+
+
+def __log_memory (savedir, imfile, stages):
+    """ Append the memory profile of an image's stages to "memory.jsonl". """
+
+    if len(stages) == 0:
+        return
+
+    with open(os.path.join(savedir, MEMLOG), 'a') as f:
+        f.write(json.dumps({'file': imfile, 'stages': stages}, sort_keys=True)
+                + '\n')
+
+
+def __write_report (savedir, report):
+    """ Write a run report (JSON) to "report.json" in savedir. """
+
+    with open(os.path.join(savedir, 'report.json'), 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+
+# Per-worker process state, set by __init_worker()
+__worker = {}
+
+# Worker return codes
+__OK, __ERROR, __TIMEOUT = 0, 1, 2
+
+
+def __init_worker (savedir, descobj, status, timeout, threads, slots,
+                   profile_memory=False):
+    """ Set up the state of a worker process for extract_smp(). """
+
+    # Limit (and pin) threads before any native libraries are (lazily) loaded.
+    # A worker replacing one that died gets its slot (cores).
+    set_threads(threads)
+    __worker['slot'] = None
+    if slots is not None:
+        __worker['slot'] = claim_slot(slots)
+        if __worker['slot'] is not None:
+            pin_cores(__worker['slot'], threads)
+
+    __worker['savedir'] = savedir
+    __worker['descobj'] = descobj
+    __worker['status'] = status
+    __worker['timeout'] = timeout
+    __worker['journal'] = worker_journal(savedir)
+    __worker['workspace'] = __workspace(descobj)
+    if profile_memory == True:
+        memprofile.enable()
+
+    # Let the parent deal with keyboard interrupts
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    if (timeout is not None) and hasattr(signal, 'SIGALRM'):
+        signal.signal(signal.SIGALRM, __alarm)
+
+
+def __extract_worker (tid, files):
+    """ Extract descriptors from a chunk of images in a worker process. 
+    
+    The start and finish (with a return code) of each image is sent to the
+    status queue as (task id, position, pid, time, code, info), where code is
+    None when the image is started, and info is a dict of measurements, e.g.
+    the peak resident memory, bytes written and the memory profile of each
+    stage (if profiling), when it is finished.
+    """
+
+    status = __worker['status']
+    pid = os.getpid()
+    profiler = memprofile.active()
+
+    for pos, imfile in enumerate(files):
+        status.put((tid, pos, pid, time.time(), None, None))
+        reset_peak_rss()
+        info = {}
+        with memprofile.image(imfile) as stages:
+            code = __extract_image(imfile, info)
+        info['peak_rss'] = peak_rss()
+        if profiler is not None:
+            info['stages'] = stages
+            info['peak_rss'] = max(info['peak_rss'], profiler.peakrss)
+        status.put((tid, pos, pid, time.time(), code, info))
+
+
+def __extract_image (imfile, info):
+    """ Extract a descriptor from an image, with a timeout. """
+
+    timeout = __worker['timeout']
+    if (timeout is not None) and hasattr(signal, 'SIGALRM'):
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+
+    try:
+        if extract(imfile, __worker['savedir'], __worker['descobj'], 
+                   __worker['journal'], __worker['workspace'], info) == False:
+            return __OK
+        return __ERROR
+    except ExtractTimeout as e:
+        __worker['journal'].write(imfile, e)
+        return __TIMEOUT
+    finally:
+        if (timeout is not None) and hasattr(signal, 'SIGALRM'):
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+def __feafile (imfile, savedir):
+    """ Get the feature/descriptor file name of an image. """
+
+    imname = os.path.splitext(os.path.split(imfile)[1])[0] # get image name
+    return os.path.join(savedir, imname + ".p")
+
+
+def __find_duplicates (filelist, hashes, savedir, similarity, mode):
+    """ Find (and record) near-duplicate images, see utils.dedup. """
+
+    if mode not in ('copy', 'skip'):
+        raise ValueError("dedup_mode must be 'copy' or 'skip'!")
+
+    duplicates = find_duplicates(filelist, hashes, similarity)
+    write_duplicates(savedir, duplicates, mode)
+    return duplicates
+
+
+def __resolve_duplicates (savedir, duplicates, mode):
+    """ Give near-duplicate images the descriptor of their original image. """
+
+    if mode != 'copy':
+        return
+
+    for imfile, dup in duplicates.items():
+        orgfile = __feafile(dup['original'], savedir)
+        feafile = __feafile(imfile, savedir)
+        if (os.path.exists(orgfile) == False) or \
+                (os.path.exists(feafile) == True):
+            continue
+
+        # Hard link if possible, the descriptors are never modified
+        try:
+            os.link(orgfile, feafile)
+        except (OSError, AttributeError):
+            shutil.copyfile(orgfile, feafile)
+
+
+def __init_shard_worker (savedir, descobj, threads):
+    """ Set up the state of a worker process for extract_shards(). """
+
+    set_threads(threads)
+    __worker['savedir'] = savedir
+    __worker['descobj'] = descobj
+    __worker['journal'] = worker_journal(savedir)
+    __worker['workspace'] = __workspace(descobj)
+
+    # Let the parent deal with keyboard interrupts
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def __shard_worker (shard):
+    """ Extract descriptors from all of the images in a shard.
+
+    Returns the number of images, and the number of errors.
+    """
+
+    nimages, nerrors = 0, 0
+    try:
+        for name, data in read_shard(shard):
+            nimages += 1
+            nerrors += int(__extract_member(shard, name, data))
+    except Exception as e:
+        __worker['journal'].write(shard, e) # Corrupt or unreadable shard
+        nerrors += 1
+
+    return nimages, nerrors
+
+
+def __extract_member (shard, name, data):
+    """ Extract a descriptor from an image in a shard, see extract(). """
+
+    # Don't write outside of savedir
+    key = os.path.normpath(member_key(name))
+    if os.path.isabs(key) or (key.split(os.sep)[0] == os.pardir):
+        __worker['journal'].write(shard + ':' + name, 
+                                  ValueError('Member name is outside savedir!'))
+        return True
+
+    feafile = os.path.join(__worker['savedir'], key + ".p")
+    if os.path.exists(feafile) == True:
+        return False
+
+    try:
+        fea = __describe(__worker['descobj'], imdecode_resize(data),
+                         __worker['workspace'])
+
+        # Members can be in sub-directories, which other workers may also make
+        try:
+            os.makedirs(os.path.dirname(feafile))
+        except OSError:
+            pass
+
+        __write_feature(fea, feafile)
+    except Exception as e:
+        __worker['journal'].write(shard + ':' + name, e)
+        return True
+
+    return False
+
+
+def __init_sweep_worker (savedirs, sweepobj, threads):
+    """ Set up the state of a worker process for extract_sweep(). """
+
+    set_threads(threads)
+    __worker['savedirs'] = savedirs
+    __worker['sweepobj'] = sweepobj
+    __worker['journals'] = [worker_journal(d) for d in savedirs]
+
+    # Let the parent deal with keyboard interrupts
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def __sweep_worker (imfile):
+    """ Extract the descriptors of all configurations for an image.
+
+    Returns True if there was an error.
+    """
+
+    feafiles = [__feafile(imfile, d) for d in __worker['savedirs']]
+    if all(os.path.exists(f) for f in feafiles):
+        return False
+
+    try:
+        feas = __worker['sweepobj'].extract(imfile)
+    except Exception as e:
+        for journal in __worker['journals']:
+            journal.write(imfile, e)
+        return True
+
+    for fea, feafile in zip(feas, feafiles):
+        if os.path.exists(feafile) == False:
+            __write_feature(fea, feafile)
+
+    return False
+
+
+def __describe (descobj, image, workspace=None):
+    """ Extract a descriptor from an image, with a workspace if there is one. 
+    """
+
+    if workspace is None:
+        return descobj.extract(image) # extract image descriptor
+    return descobj.extract(image, workspace=workspace)
+
+
+def __write_feature (fea, feafile, info=None):
+    """ Write a pickled feature, atomically so killed workers leave no partial
+        files.
+    """
+
+    with open(feafile + '.tmp', 'wb') as f:
+        cPickle.dump(fea, f, protocol=2)
+        if info is not None:
+            info['nbytes'] = f.tell()
+    os.rename(feafile + '.tmp', feafile)
+
+
+def __workspace (descobj):
+    """ Make a workspace for a descriptor object, if it supports them. """
+
+    if hasattr(descobj, 'workspace'):
+        return descobj.workspace()
+    return None
+
+
+def __memory_estimate (descobj, size, cost):
+    """ Estimate the memory needed to extract a descriptor from an image. """
+
+    # Assume a square image if the size is unknown
+    if size is None:
+        size = (int(cost**0.5), int(cost**0.5))
+
+    nbytes = None
+    if hasattr(descobj, 'memory_estimate'):
+        nbytes = descobj.memory_estimate(size)
+    if nbytes is None:
+        nbytes = 32 * size[0] * size[1]
+
+    return nbytes
+
+
+def __alarm (signum, frame):
+    """ Signal handler for image extraction timeouts. """
+
+    raise ExtractTimeout('Image extraction timed out.')
+
+
+def __is_alive (pid):
+    """ Check if a (worker) process is still running. """
+
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def __kill (pid):
+    """ Kill a (stuck) worker process. """
+
+    try:
+        os.kill(pid, signal.SIGKILL)
+    except OSError:
+        pass
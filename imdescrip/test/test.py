@@ -20,10 +20,70 @@
 
 """ Unit tests for the imdescrip package. """
 
-import os
+import os, sys, time, json, signal, subprocess, tempfile, shutil, cPickle
+import tarfile, zipfile
 import numpy as np
 import unittest 
-from imdescrip.utils import patch, siftwrap, image 
+import multiprocessing as mp
+from imdescrip import extractor
+from imdescrip.utils import patch, siftwrap, image, encode, journal, schedule
+from imdescrip.utils import memory, threads, workspace, dedup, compress
+from imdescrip.utils import telemetry, shards, siftcache, memprofile
+from imdescrip.descriptors.ScSPM import ScSPM, ScSPMSweep
+from imdescrip.descriptors.descriptor import Descriptor
+
+
+class FlakyDesc (Descriptor):
+    """ A descriptor that fails or hangs on some 'images', for testing. """
+
+    def extract (self, image):
+        if 'bad' in image:
+            raise IOError('Corrupt image!')
+        elif 'hang' in image:
+            time.sleep(60)
+        return np.ones(3)
+
+
+class SpanDesc (Descriptor):
+    """ A descriptor of when it ran, with a tiny memory estimate, for testing.
+    """
+
+    def extract (self, image):
+        start = time.time()
+        time.sleep(0.1)
+        return np.array([start, time.time()])
+
+    def memory_estimate (self, imsize):
+        return 1
+
+
+# The real extract_smp() worker, and a file made when one has died
+DYING = {}
+
+
+class PinDesc (Descriptor):
+    """ A descriptor of the worker's pinned cores (slot), that kills the
+        worker with slot 1 once, on a 'die' image, for testing. """
+
+    def extract (self, image):
+        slot = getattr(extractor, '__worker')['slot']
+        if ('die' in image) and (slot == 1):
+            try:
+                os.close(os.open(DYING['marker'], os.O_CREAT | os.O_EXCL))
+                os.kill(os.getpid(), signal.SIGKILL)
+            except OSError:
+                pass
+        time.sleep(0.02)
+        return np.array([slot, os.getpid(), time.time()])
+
+def dying_worker (tid, files):
+    """ An extract_smp() worker that dies after taking the first chunk. """
+
+    try:
+        os.close(os.open(DYING['marker'], os.O_CREAT | os.O_EXCL))
+    except OSError:
+        return DYING['worker'](tid, files)
+    os._exit(1)
 
 
 class TestImdescrip (unittest.TestCase):
@@ -79,6 +139,56 @@ class TestImdescrip (unittest.TestCase):
         self.assertTrue((self.tpyr == pyr).all())
 
 
+    def test_pyramid_pool (self):
+        """ Test incremental pyramid pooling matches pyramid_pooling. """
+
+        codes = np.random.randn(100, 8)
+        cx = np.random.rand(100) * 50
+        cy = np.random.rand(100) * 30
+        pyr = patch.pyramid_pooling(codes, cx, cy, (30, 50), (1,2,4))
+
+        # Pool in batches, in a different order
+        pool = patch.PyramidPool(8, (30, 50), (1,2,4))
+        for b in np.array_split(np.random.permutation(100), 3):
+            pool.update(codes[b], cx[b], cy[b])
+        self.assertTrue(np.allclose(pool.result(), pyr))
+
+        # Pooling with precomputed bins into an existing buffer
+        bins = patch.pyramid_bins(cx, cy, (30, 50), (1,2,4))
+        out = np.random.randn(pyr.size)
+        res = patch.pyramid_pooling(codes, cx, cy, (30, 50), (1,2,4), 
+                                    bins=bins, out=out)
+        self.assertTrue(res is out)
+        self.assertTrue(np.allclose(out, pyr))
+
+        self.assertRaises(ValueError, patch.PyramidPool, 8, (30, 50), (1,2),
+                          patch.p_mean)
+
+
+    def test_diverse_patches (self):
+        """ Test k-means++ patch selection avoids near-duplicates. """
+
+        # 1000 near-duplicates of one patch, and 5 distinct patches
+        rs = np.random.RandomState(1)
+        patches = np.vstack((np.ones((1000, 8)) + 1e-3 * rs.randn(1000, 8),
+                             10 * np.eye(8)[:5]))
+        idx = patch.diverse_patches(patches, 6, rs)
+        self.assertEqual(len(np.unique(idx)), 6)
+        self.assertEqual((idx >= 1000).sum(), 5)
+
+        # Fewer candidates than requested, and exact duplicates
+        self.assertEqual(len(patch.diverse_patches(patches[:3], 5)), 3)
+        idx = patch.diverse_patches(np.ones((10, 8)), 4, rs)
+        self.assertEqual(len(np.unique(idx)), 4)
+
+        # Draws at the very end of the distribution stay in range
+        class EndState (np.random.RandomState):
+            def rand (self):
+                return 1.
+        idx = patch.diverse_patches(rs.randn(50, 8), 10, EndState(0))
+        self.assertTrue((idx < 50).all())
+
+
     def test_norm_patches (self):
         """ Test patch contrast normalisation/unitisation. """
        
@@ -144,6 +254,848 @@ class TestImdescrip (unittest.TestCase):
         self.assertTrue(40 < tpatches.shape[0] < 60) # Not exact, but that's ok
 
 
+    def test_extract_tiled (self):
+        """ Test tiled extraction gives the same descriptor as extract(). """
+
+        timg = image.imread_resize(os.path.join(self.__loc__, 'test.jpg'), 200)
+        dic = patch.norm_patches(np.random.randn(16, 128)).T
+
+        # Several tiles, with margins, in both directions
+        for pooling in ('max', 'maxabs'):
+            desc = ScSPM(maxdim=None, dsize=16, encoder='soft',
+                         pooling=pooling)
+            desc.dic = dic
+            self.assertTrue(np.allclose(desc.extract_tiled(timg, tilesize=50),
+                                        desc.extract(timg)))
+
+        desc = ScSPM(maxdim=None, dsize=16, encoder='soft', pooling='mean')
+        desc.dic = dic
+        self.assertRaises(ValueError, desc.extract_tiled, timg, 50)
+
+
+    def test_extract_stream (self):
+        """ Test extracting every k-th frame of a stream, with re-used buffers.
+        """
+
+        timg = image.imread_resize(os.path.join(self.__loc__, 'test.jpg'), 200)
+        desc = ScSPM(dsize=16, encoder='soft')
+        desc.dic = patch.norm_patches(np.random.randn(16, 128)).T
+
+        feas = list(desc.extract_stream([timg] * 5, every=2))
+        self.assertEqual([f[0] for f in feas], [0, 2, 4])
+        tfea = desc.extract(timg)
+        for frameno, fea in feas:
+            self.assertTrue(np.allclose(fea, tfea))
+
+
+    def test_import_time (self):
+        """ Test that importing imdescrip is fast and doesn't load heavy deps. """
+
+        # Run in a fresh interpreter so nothing is already imported
+        code = ("import sys, time; t = time.time(); "
+                "import imdescrip.extractor, imdescrip.descriptors.ScSPM; "
+                "import imdescrip.utils.patch, imdescrip.utils.siftwrap; "
+                "t = time.time() - t; "
+                "heavy = [m for m in ('cv', 'spams', 'vlfeat', 'matplotlib') "
+                "         if m in sys.modules]; "
+                "print('{0} {1}'.format(t, ','.join(heavy)))")
+
+        out = subprocess.check_output([sys.executable, '-c', code]).split()
+        self.assertTrue(float(out[0]) < 2.) # import budget in seconds
+        self.assertEqual(len(out), 1)       # no heavy modules loaded
+
+
+    def test_model_save_load (self):
+        """ Test saving, (memory mapped) loading and pickling ScSPM models. """
+
+        desc = ScSPM(dsize=16, levels=(1,2), compress_dim=10)
+        desc.dic = np.asfortranarray(np.random.randn(128, 16))
+        desc.dicA = np.asfortranarray(np.random.randn(16, 16))
+        desc.dicB = np.asfortranarray(np.random.randn(128, 16))
+        desc.dicniter = 100
+        desc.dichistory = [{'iter': 100, 'objective': 0.2, 'sparsity': 5.}]
+
+        tdir = tempfile.mkdtemp()
+        try:
+            mpath = os.path.join(tdir, 'ScSPM')
+            desc.save(mpath)
+            ldesc = ScSPM.load(mpath, verify=True)
+
+            self.assertEqual(ldesc.levels, (1,2))
+            self.assertEqual(ldesc.compress_dim, 10)
+            self.assertTrue(isinstance(ldesc.dic, np.memmap))
+            self.assertEqual(ldesc.get_hash(), desc.get_hash())
+            self.assertEqual(ldesc.dicniter, 100)
+            self.assertEqual(ldesc.dichistory, desc.dichistory)
+            self.assertTrue((ldesc.dicB == desc.dicB).all())
+
+            # Pickling should keep the arrays memory mapped
+            pdesc = cPickle.loads(cPickle.dumps(ldesc, protocol=2))
+            self.assertTrue(isinstance(pdesc.rmat, np.memmap))
+            self.assertTrue((pdesc.rmat == desc.rmat).all())
+
+            # Save back to the directory it is memory mapped from
+            ldesc.dic = ldesc.dic * 2
+            ldesc.dicniter = 200
+            ldesc.save(mpath)
+            self.assertTrue((pdesc.dic == desc.dic).all()) # Old maps still ok
+            sdesc = ScSPM.load(mpath, verify=True)
+            self.assertTrue((sdesc.dic == 2 * desc.dic).all())
+            self.assertTrue((sdesc.rmat == desc.rmat).all())
+            self.assertEqual(sdesc.dicniter, 200)
+            self.assertEqual(len(os.listdir(mpath)), 5) # header + 4 arrays
+        finally:
+            shutil.rmtree(tdir)
+
+
+    def test_checkpoint (self):
+        """ Test dictionary checkpoints survive being killed while saving. """
+
+        desc = ScSPM(dsize=16)
+        desc.dic = np.asfortranarray(np.random.randn(128, 16))
+        desc.dicniter = 10
+
+        tdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tdir, 'ckpt')
+            desc._ScSPM__save_checkpoint(path)
+
+            # Killed between the swap renames, then while saving the next one
+            os.rename(path, path + '.old')
+            os.mkdir(path + '.tmp')
+            olddic = desc.dic
+            desc.dic = np.asfortranarray(np.random.randn(128, 16))
+            desc.dicniter = 20
+            def killed (path):
+                os.mkdir(path)
+                raise KeyboardInterrupt
+            desc.save = killed
+            self.assertRaises(KeyboardInterrupt, desc._ScSPM__save_checkpoint,
+                              path)
+
+            rdesc = ScSPM(dsize=16)
+            rdesc._ScSPM__resume(path)
+            self.assertEqual(rdesc.dicniter, 10)
+            self.assertTrue((rdesc.dic == olddic).all())
+
+            # The next save replaces it
+            del desc.save
+            desc._ScSPM__save_checkpoint(path)
+            self.assertEqual(sorted(os.listdir(tdir)), ['ckpt'])
+            rdesc._ScSPM__resume(path)
+            self.assertEqual(rdesc.dicniter, 20)
+            self.assertTrue((rdesc.dic == desc.dic).all())
+        finally:
+            shutil.rmtree(tdir)
+
+
+    def test_encoders (self):
+        """ Test the fast (non-OMP) patch encoders. """
+
+        dic = patch.norm_patches(np.random.randn(32, 128)).T
+        X = np.random.rand(50, 128)
+
+        codes = encode.hard_topk(X, dic, 5)
+        self.assertEqual(codes.shape, (50, 32))
+        self.assertTrue(((codes != 0).sum(axis=1) == 5).all())
+
+        codes = encode.soft_threshold(X, dic, 0.2)
+        resp = patch.norm_patches(X).dot(dic)
+        self.assertTrue((codes[np.abs(resp) <= 0.2] == 0).all())
+        self.assertTrue((np.sign(codes) * np.sign(resp) >= 0).all())
+
+        codes = encode.batch_omp(X, dic, 5, gram=dic.T.dot(dic), blocksize=16)
+        self.assertTrue(((codes != 0).sum(axis=1) == 5).all())
+        for x, c in zip(X, codes):
+            I = np.nonzero(c)[0]
+            g = np.linalg.lstsq(dic[:,I], x, rcond=-1)[0] # OMP is least squares
+            self.assertTrue(np.allclose(g, c[I]))
+
+        codes = encode.llc(X, dic, 5)
+        self.assertTrue(((codes != 0).sum(axis=1) <= 5).all())
+        self.assertTrue((np.abs(codes.sum(axis=1) - 1) < 1e-10).all())
+
+        # Writing into existing (dirty) workspace buffers gives the same codes
+        ws = workspace.Workspace()
+        for efun, arg in ((encode.hard_topk, 5), (encode.soft_threshold, 0.2),
+                          (encode.batch_omp, 5), (encode.llc, 5)):
+            out = ws.get('codes', (50, 32))
+            out.fill(np.nan)
+            self.assertTrue(efun(X, dic, arg, out=out) is out)
+            self.assertTrue(np.allclose(out, efun(X, dic, arg)))
+
+
+    def test_flat_patches (self):
+        """ Test flat patches are not encoded, and are counted. """
+
+        desc = ScSPM(dsize=32, encoder='soft', alpha=0.1, flat_threshold=1.)
+        desc.dic = patch.norm_patches(np.random.randn(32, 128)).T
+        X = np.random.rand(50, 128)
+        norms = np.random.rand(50) * 2
+
+        codes = desc.encode(X, norms=norms)
+        flat = norms < 1.
+        self.assertEqual(desc.last_stats['skipped'], flat.sum())
+        self.assertTrue((codes[flat] == 0).all())
+        self.assertTrue(np.allclose(codes[~flat], desc.encode(X[~flat])))
+
+        # Into a dirty buffer
+        out = np.ones((50, 32))
+        self.assertTrue(np.allclose(desc.encode(X, out=out, norms=norms), 
+                                    codes))
+        desc.flat_threshold = None
+        desc.encode(X, norms=norms)
+        self.assertEqual(desc.last_stats['skipped'], 0)
+
+
+    def test_atom_index (self):
+        """ Test approximate OMP with an atom index. """
+
+        desc = ScSPM(dsize=64, encoder='aomp', probes=2)
+        desc.dic = patch.norm_patches(np.random.randn(64, 128)).T
+        X = np.random.rand(50, 128)
+        self.assertRaises(ValueError, desc.encode, X)
+
+        desc.build_index(nclusters=8)
+        members = desc.atommembers[desc.atommembers >= 0]
+        self.assertEqual(sorted(members), range(64))
+
+        # Approximate codes are still OMP codes, on fewer atoms
+        codes = desc.encode(X)
+        nnz = (codes != 0).sum(axis=1)
+        self.assertTrue(((nnz > 0) & (nnz <= desc.active)).all())
+
+        # Probing every cluster is exact
+        desc.probes = 8
+        bomp = encode.batch_omp(X, desc.dic, desc.active)
+        self.assertTrue(np.allclose(desc.encode(X), bomp))
+
+
+    def test_workspace (self):
+        """ Test work buffers are re-used, and only grow. """
+
+        ws = workspace.Workspace()
+        a = ws.get('a', (10, 20))
+        b = ws.get('a', (5, 8), order='F')
+        self.assertTrue(b.flags.f_contiguous)
+        self.assertTrue(np.may_share_memory(a, b))
+        nbytes = ws.nbytes()
+
+        c = ws.get('a', (20, 20))
+        self.assertFalse(np.may_share_memory(a, c))
+        self.assertTrue(ws.nbytes() > nbytes)
+        self.assertTrue((ws.zeros('b', (3,), np.float32) == 0).all())
+
+        # Buffers are not pickled
+        pws = cPickle.loads(cPickle.dumps(ws, protocol=2))
+        self.assertEqual(pws.nbytes(), 0)
+
+
+    def test_extract_smp_errors (self):
+        """ Test parallel extraction with errors, timeouts and retries. """
+
+        tdir = tempfile.mkdtemp()
+        try:
+            flist = ['im{0}.jpg'.format(i) for i in range(10)] \
+                    + ['bad.jpg', 'hang.jpg']
+            self.assertTrue(extractor.extract_smp(flist, tdir, FlakyDesc(),
+                            njobs=2, timeout=0.5, retries=1, 
+                            maxtasksperchild=3))
+
+            feas = [f for f in os.listdir(tdir) if f.endswith('.p')]
+            self.assertEqual(len(feas), 10)
+
+            # Only the merged journal should be left, with every failed attempt
+            errors = journal.read_journal(os.path.join(tdir, 'errors.log'))
+            self.assertEqual(sorted(e['file'] for e in errors), 
+                             ['bad.jpg', 'hang.jpg', 'hang.jpg'])
+            self.assertEqual(len(os.listdir(tdir)), 12) # + report.json
+        finally:
+            shutil.rmtree(tdir)
+
+        # A worker dies after taking a chunk, but before starting it
+        tdir = tempfile.mkdtemp()
+        worker = getattr(extractor, '__extract_worker')
+        try:
+            DYING['worker'] = worker
+            DYING['marker'] = os.path.join(tdir, 'died')
+            setattr(extractor, '__extract_worker', dying_worker)
+            flist = ['im{0}.jpg'.format(i) for i in range(6)]
+            self.assertFalse(extractor.extract_smp(flist, tdir, FlakyDesc(),
+                             njobs=2, schedule='fifo'))
+            self.assertTrue(os.path.exists(DYING['marker']))
+            feas = [f for f in os.listdir(tdir) if f.endswith('.p')]
+            self.assertEqual(len(feas), 6)
+        finally:
+            setattr(extractor, '__extract_worker', worker)
+            shutil.rmtree(tdir)
+
+        # Only running images count against the memory budget
+        tdir = tempfile.mkdtemp()
+        try:
+            flist = ['im{0}.jpg'.format(i) for i in range(12)]
+            self.assertFalse(extractor.extract_smp(flist, tdir, SpanDesc(),
+                             njobs=3, schedule='fifo', membudget=2,
+                             chunktime=0.1))
+            spans = []
+            for f in flist:
+                with open(os.path.join(tdir, f[:-4] + '.p'), 'rb') as fp:
+                    spans.append(cPickle.load(fp))
+            running = [sum(s[0] <= t < s[1] for s in spans) for t, e in spans]
+            self.assertEqual(max(running), 2)
+        finally:
+            shutil.rmtree(tdir)
+
+        # Nothing to do (e.g. all of the images are duplicates)
+        tdir = tempfile.mkdtemp()
+        try:
+            for schedule, membudget in (('cost', None), ('fifo', '1G')):
+                self.assertFalse(extractor.extract_smp([], tdir, FlakyDesc(),
+                                 njobs=2, schedule=schedule,
+                                 membudget=membudget))
+            with open(os.path.join(tdir, 'report.json'), 'r') as f:
+                self.assertEqual(json.load(f)['nimages'], 0)
+        finally:
+            shutil.rmtree(tdir)
+
+
+    def test_extract_smp_pin (self):
+        """ Test workers that replace dead ones get their pinned cores. """
+
+        tdir = tempfile.mkdtemp()
+        try:
+            DYING['marker'] = os.path.join(tdir, 'died')
+            flist = ['{0}{1}.jpg'.format('die' if i % 4 == 0 else 'im', i)
+                     for i in range(60)]
+            extractor.extract_smp(flist, tdir, PinDesc(), njobs=2, retries=0,
+                                  schedule='fifo', pin=True)
+            self.assertTrue(os.path.exists(DYING['marker']))
+
+            # Each slot is held by one worker at a time
+            feas = []
+            for f in os.listdir(tdir):
+                if f.endswith('.p'):
+                    with open(os.path.join(tdir, f), 'rb') as fp:
+                        feas.append(cPickle.load(fp))
+            feas.sort(key=lambda f: f[2])
+            holders = {}
+            for slot, pid, t in feas:
+                self.assertTrue(slot in (0, 1))
+                holders.setdefault(slot, [])
+                if pid not in holders[slot]:
+                    holders[slot].append(pid)
+                self.assertEqual(holders[slot][-1], pid)
+            self.assertEqual(sum(len(h) for h in holders.values()), 3)
+        finally:
+            shutil.rmtree(tdir)
+
+
+    def test_dedup (self):
+        """ Test near-duplicate detection with perceptual hashes. """
+
+        self.assertEqual(dedup.max_distance(0.9), 6)
+        self.assertEqual(dedup.hamming(0b1011, 0b0110), 3)
+
+        # Every hash within maxdist is found, whichever bits differ
+        index = dedup.HashIndex(maxdist=6)
+        base = np.random.randint(0, 2**62)
+        index.add(base, 'a')
+        for bits in (range(6), range(58, 64), range(0, 64, 11)):
+            ahash = base ^ sum(1 << b for b in bits)
+            self.assertEqual(index.query(ahash), ('a', len(bits)))
+        self.assertEqual(index.query(base ^ 0b1111111)[0], None)
+
+        flist = ['im0', 'im1', 'im2', 'im3']
+        hashes = [base, base ^ 0b11, None, ~base & (2**64 - 1)]
+        dups = dedup.find_duplicates(flist, hashes, similarity=0.9)
+        self.assertEqual(dups, {'im1': {'original': 'im0', 'distance': 2}})
+
+        # The top (64th) bit is set, and not set in a near neighbour
+        img = np.tile(np.arange(9.), (8, 1))
+        near = img.copy()
+        near[7, 8] = 0
+        near[0, 1] = 5
+        hashes = [dedup.gray_hash(img), dedup.gray_hash(near)]
+        self.assertEqual(hashes[0], 2**64 - 1)
+        self.assertTrue(0 <= hashes[1] < 2**63)
+        self.assertEqual(dedup.hamming(*hashes), 2)
+        self.assertEqual(dedup.find_duplicates(flist[:2], hashes, 0.9),
+                         {'im1': {'original': 'im0', 'distance': 2}})
+
+        # Hashes need PIL or OpenCV to read the image
+        thash = dedup.image_hash(os.path.join(self.__loc__, 'test.jpg'))
+        self.assertEqual(dedup.image_hash('nonexistent.jpg'), None)
+        if thash is not None:
+            self.assertTrue(0 <= thash < 2**64)
+
+
+    def test_compression (self):
+        """ Test incremental PCA, and learned ScSPM compression. """
+
+        # Batches give the same components as PCA of all of the data
+        X = np.dot(np.random.randn(300, 5), np.random.randn(5, 40)) \
+                + 0.01 * np.random.randn(300, 40) + 3
+        pca = compress.IncrementalPCA(5)
+        for i in range(0, 300, 70):
+            pca.partial_fit(X[i:i+70])
+
+        U, S, Vt = np.linalg.svd(X - X.mean(axis=0), full_matrices=False)
+        self.assertTrue(np.allclose(pca.mean, X.mean(axis=0)))
+        self.assertTrue(np.allclose(np.abs(np.dot(pca.components, Vt[:5].T)),
+                                    np.eye(5), atol=1e-6))
+        self.assertTrue(0.99 < pca.explained_variance_ratio().sum() <= 1)
+
+        desc = ScSPM(dsize=8, levels=(1,2), compress_dim=10)
+        tdir = tempfile.mkdtemp()
+        try:
+            for i, x in enumerate(np.random.rand(30, 40)):
+                with open(os.path.join(tdir, 'im{0}.p'.format(i)), 'wb') as f:
+                    cPickle.dump(x, f, protocol=2)
+
+            batches = list(compress.feature_batches(tdir, batchsize=8))
+            self.assertEqual([b.shape[0] for b in batches], [8, 8, 8, 6])
+
+            self.assertTrue(0 < desc.learn_compression(tdir, 6, 8) < 1)
+            self.assertEqual(desc.pcacomp.shape, (40, 6))
+            self.assertEqual(desc.compress_dim, 6)
+            self.assertEqual(desc.rmat, None)
+            self.assertRaises(ValueError, desc.learn_compression, tdir, 50)
+        finally:
+            shutil.rmtree(tdir)
+
+
+    def test_telemetry (self):
+        """ Test run throughput telemetry, and the extractors' snapshots. """
+
+        tdir = tempfile.mkdtemp()
+        try:
+            tel = telemetry.RunTelemetry(os.path.join(tdir, 'run.prom'))
+            tel.start(10, njobs=2)
+            tel.record(1, 0.5, nbytes=100)
+            tel.record(2, 1., error=True, nbytes=50)
+            tel.record(2, 1., done=False)
+            tel.queue(4)
+            snap = tel.snapshot()
+            self.assertEqual(snap['images_done'], 2)
+            self.assertEqual(snap['error_rate'], 0.5)
+            self.assertEqual(snap['bytes_written'], 150)
+            self.assertEqual(snap['workers']['2']['images_per_second'], 1.)
+            self.assertTrue(snap['eta_seconds'] > 0)
+
+            tel.finish()
+            with open(os.path.join(tdir, 'run.prom')) as f:
+                prom = f.read()
+            self.assertTrue('imdescrip_queue_depth 4.0\n' in prom)
+            self.assertTrue('imdescrip_worker_images_total{worker="2"} 2.0' 
+                            in prom)
+
+            # JSON lines from a serial run
+            jpath = os.path.join(tdir, 'run.jsonl')
+            flist = ['im0.jpg', 'bad.jpg', 'im1.jpg']
+            extractor.extract_batch(flist, os.path.join(tdir, 'feas'),
+                                    FlakyDesc(), telemetry=jpath)
+            with open(jpath) as f:
+                snaps = [json.loads(l) for l in f]
+            self.assertEqual(snaps[-1]['images_done'], 3)
+            self.assertEqual(snaps[-1]['errors'], 1)
+            self.assertTrue(snaps[-1]['bytes_written'] > 0)
+        finally:
+            shutil.rmtree(tdir)
+
+
+    def test_memprofile (self):
+        """ Test per-stage memory profiling, and the extractors' reports. """
+
+        with memprofile.stage('decode'):   # Does nothing when off
+            pass
+        self.assertTrue(memprofile.active() is None)
+
+        prof = memprofile.enable()
+        try:
+            for name in ('small', 'large'):
+                with memprofile.image(name) as stages:
+                    with memprofile.stage('decode'):
+                        a = np.ones(10 if name == 'small' else 4 * 1024**2)
+                    with memprofile.stage('encode'):
+                        b = a * 2
+                    with memprofile.stage('encode'):
+                        b = a * 3
+                self.assertEqual(sorted(stages), ['decode', 'encode'])
+            with memprofile.stage('learn'):
+                pass
+        finally:
+            self.assertTrue(memprofile.disable() is prof)
+
+        summary = prof.summary()
+        self.assertTrue(summary['method'] in ('tracemalloc', 'rss'))
+        self.assertEqual(summary['stages']['encode']['count'], 2)
+        self.assertEqual(sorted(summary['run']), ['learn'])
+        self.assertEqual(summary['images']['count'], 2)
+        if summary['method'] == 'tracemalloc' or memory.reset_peak_rss():
+            self.assertEqual(summary['images']['outliers'][0]['name'], 'large')
+            self.assertTrue(stages['decode']['peak'] >= 32 * 1024**2)
+
+        # The extractors write the profile to the run report
+        tdir = tempfile.mkdtemp()
+        try:
+            flist = ['im0.jpg', 'bad.jpg', 'im1.jpg']
+            for i, run in enumerate((extractor.extract_batch, 
+                                     extractor.extract_smp)):
+                savedir = os.path.join(tdir, str(i))
+                if i == 0:
+                    run(flist, savedir, FlakyDesc(), profile_memory=True)
+                else:
+                    run(flist, savedir, FlakyDesc(), njobs=2,
+                        profile_memory=True)
+                with open(os.path.join(savedir, 'report.json')) as f:
+                    report = json.load(f)['memory']['stages']
+                self.assertEqual(report['stages']['serialise']['count'], 2)
+                with open(os.path.join(savedir, 'memory.jsonl')) as f:
+                    self.assertEqual(len(f.readlines()), 2)
+            self.assertTrue(memprofile.active() is None)
+        finally:
+            shutil.rmtree(tdir)
+
+
+    def test_shards (self):
+        """ Test reading images from tar and zip shards. """
+
+        tdir = tempfile.mkdtemp()
+        try:
+            tpath = os.path.join(tdir, 'shard0.tar')
+            with tarfile.open(tpath, 'w') as tf:
+                tf.add(os.path.join(self.__loc__, 'test.jpg'), 'a/test.jpg')
+                tf.add(os.path.join(self.__loc__, 'test.py'), 'a/test.py')
+
+            zpath = os.path.join(tdir, 'shard1.zip')
+            with zipfile.ZipFile(zpath, 'w') as zf:
+                zf.writestr('b/im1.jpg', 'not an image')
+                zf.writestr('b/im0.png', 'not an image either')
+
+            self.assertTrue(shards.is_shard(tpath) and shards.is_shard(zpath))
+            self.assertFalse(shards.is_shard('test.jpg'))
+            self.assertEqual(shards.shard_members(tpath), ['a/test.jpg'])
+            self.assertEqual(shards.shard_members(zpath), ['b/im1.jpg', 
+                             'b/im0.png'])
+            self.assertEqual(shards.member_key('b/im1.jpg'), 'b/im1')
+
+            with open(os.path.join(self.__loc__, 'test.jpg'), 'rb') as f:
+                self.assertEqual(list(shards.read_shard(tpath)),
+                                 [('a/test.jpg', f.read())])
+            self.assertEqual(len(shards.image_sources([tpath, zpath, 'x.jpg'])),
+                             4)
+            self.assertEqual(shards.image_sources(['x.jpg']), ['x.jpg'])
+
+            # Tar shards are listed once, then their saved member lists are
+            # read instead
+            self.assertTrue(os.path.exists(tpath + shards.INDEX_EXT))
+            with open(tpath + shards.INDEX_EXT, 'w') as f:
+                json.dump(['a/test.jpg', 'a/im1.png', 'a/notes.txt'], f)
+            self.assertEqual(shards.shard_members(tpath), ['a/test.jpg',
+                             'a/im1.png'])
+            self.assertEqual(len(shards.ShardImages([tpath, 'x.jpg'])), 3)
+            os.utime(tpath + shards.INDEX_EXT, (0, 0))  # Shard is newer
+            self.assertEqual(shards.shard_members(tpath), ['a/test.jpg'])
+
+            # Undecodable images are journaled by member
+            savedir = os.path.join(tdir, 'feas')
+            self.assertTrue(extractor.extract_shards([zpath], savedir, 
+                            FlakyDesc(), njobs=2))
+            errors = journal.read_journal(os.path.join(savedir, 'errors.log'))
+            self.assertEqual(sorted(e['file'] for e in errors), 
+                             [zpath + ':b/im0.png', zpath + ':b/im1.jpg'])
+        finally:
+            shutil.rmtree(tdir)
+
+
+    def test_sift_cache (self):
+        """ Test storing, reading and sampling cached SIFT descriptors. """
+
+        tdir = tempfile.mkdtemp()
+        try:
+            cache = siftcache.SiftCache(os.path.join(tdir, 'cache'), 64, 16, 4)
+            imfile = os.path.join(self.__loc__, 'test.jpg')
+            self.assertEqual(cache.key(imfile), cache.key(imfile))
+            self.assertNotEqual(cache.key(imfile), siftcache.SiftCache(
+                                os.path.join(tdir, 'cache'), 64, 16, 8)
+                                .key(imfile))
+            self.assertTrue(cache.get(cache.key(imfile)) is None)
+
+            # Cache the "SIFT" of some images, on a 10 x 15 grid
+            cy, cx = np.mgrid[8:48:4, 4:64:4]
+            cx, cy = cx.ravel(), cy.ravel()
+            images = [np.random.rand(48, 64) for i in range(3)]
+            sifts = [np.random.randint(0, 256, (150, 128)) for i in images]
+            for img, sift in zip(images, sifts):
+                cache.put(cache.key(img), sift, cx, cy, sift.mean(axis=1),
+                          img.shape)
+
+            # Read back by another (unpickled) object
+            cache2 = cPickle.loads(cPickle.dumps(cache))
+            self.assertEqual(len(cache2), 3)
+            patches, px, py, norms, imshape = cache2.sift(images[1])
+            self.assertEqual(patches.dtype, np.uint8)
+            self.assertTrue((patches == sifts[1]).all())
+            self.assertTrue(np.allclose(px, cx) and np.allclose(py, cy))
+            self.assertTrue(np.allclose(norms, sifts[1].mean(axis=1)))
+            self.assertEqual(imshape, (48, 64))
+            self.assertEqual(len(os.listdir(cache.path)), 2) # One pack, index
+
+            # Sample training patches from the cache, every 2nd patch
+            tpatches = siftwrap.training_patches(images, 3 * 38, 16, 64,
+                                                 cache=cache2)
+            self.assertEqual(tpatches.shape, (3 * 5 * 8, 128))
+            self.assertTrue((tpatches[:40] == sifts[0].reshape((10, 15, 128))
+                             [::2, ::2].reshape((-1, 128))).all())
+            self.assertRaises(ValueError, siftwrap.training_patches, images,
+                              100, 8, 64, cache=cache2)
+            cache2.close()
+            cache.close()
+        finally:
+            shutil.rmtree(tdir)
+
+
+    def test_training_matrix (self):
+        """ Test building the normalised training patch matrix in place. """
+
+        tdir = tempfile.mkdtemp()
+        try:
+            cache = siftcache.SiftCache(tdir, None, 16, 4)
+            cy, cx = np.mgrid[8:48:4, 4:64:4]
+            images = [np.random.rand(48, 64) for i in range(4)]
+            for img in images:
+                cache.put(cache.key(img), np.random.randint(0, 256, (150, 
+                          128)), cx.ravel(), cy.ravel(), np.ones(150), 
+                          img.shape)
+
+            tpatches = patch.norm_patches(siftwrap.training_patches(images, 
+                                          160, 16, cache=cache))
+            X = siftwrap.training_matrix(images, 160, 16, cache=cache)
+            self.assertEqual(X.shape, (128, 160))
+            self.assertTrue(X.flags['F_CONTIGUOUS'])
+            self.assertTrue(np.allclose(X, tpatches.T))
+
+            # At most npatches, shared between the images, memory mapped
+            X = siftwrap.training_matrix(images, 100, 16, cache=cache,
+                                         mmap=os.path.join(tdir, 'X.dat'))
+            self.assertTrue(isinstance(X, np.memmap))
+            self.assertEqual(X.shape, (128, 100))
+            self.assertTrue(np.allclose((X**2).sum(axis=0), 1))
+            cache.close()
+        finally:
+            shutil.rmtree(tdir)
+
+
+    def test_window_pool (self):
+        """ Test pyramid pooling of sub-windows from block maxima. """
+
+        cy, cx = np.mgrid[4:100:8, 4:140:8]
+        cx, cy = np.float64(cx.ravel()[1:]), np.float64(cy.ravel()[1:])
+        codes = np.random.randn(len(cx), 6)
+        boxes = [(0, 0, 140, 100), (13, 7, 77.5, 93), (50, 20, 58, 29), 
+                 (30, 30, 31, 90), (200, 200, 300, 300)]
+
+        for pfun in (patch.p_max, patch.p_maxabs, patch.p_mean):
+            pool = patch.WindowPool(codes, cx, cy, pfun=pfun)
+            for x0, y0, x1, y1 in boxes:
+                inside = (cx >= x0) & (cx < x1) & (cy >= y0) & (cy < y1)
+                ref = patch.pyramid_pooling(codes[inside], cx[inside] - x0, 
+                                            cy[inside] - y0, (y1 - y0, x1 - x0),
+                                            (1, 2, 3), pfun=pfun)
+                self.assertTrue(np.allclose(pool.pool((x0, y0, x1, y1), 
+                                                      (1, 2, 3)), ref))
+
+        # The whole image window is the image's descriptor
+        tdir = tempfile.mkdtemp()
+        try:
+            desc = ScSPM(maxdim=None, pstride=8, dsize=6, encoder='soft',
+                         compress_dim=4)
+            desc.dic = patch.norm_patches(np.random.randn(6, 128)).T
+            desc.use_sift_cache(tdir)
+            img = np.random.rand(100, 140)
+            desc.siftcache.put(desc.siftcache.key(img), np.random.randint(0,
+                               256, (len(cx), 128)), cx, cy, np.ones(len(cx)),
+                               img.shape)
+            feas = desc.extract_windows(img, boxes[:2])
+            self.assertEqual(feas.shape, (2, 4))
+            self.assertTrue(np.allclose(feas[0], desc.extract(img)))
+            desc.siftcache.close()
+        finally:
+            shutil.rmtree(tdir)
+
+
+    def test_sweep (self):
+        """ Test the grouping of shared work in ScSPM parameter sweeps. """
+
+        self.assertRaises(ValueError, ScSPM, pooling='median')
+
+        dic = np.asfortranarray(np.random.randn(128, 16))
+        descs = [ScSPM(dsize=16, active=5), 
+                 ScSPM(dsize=16, active=5, levels=(1,2)),
+                 ScSPM(dsize=16, active=5, pooling='mean', compress_dim=10),
+                 ScSPM(dsize=16, active=5, compress_dim=10),
+                 ScSPM(dsize=16, active=3)]
+        for d in descs:
+            d.dic = dic
+
+        sweep = ScSPMSweep(descs)
+        self.assertEqual(len(sweep), 5)
+        self.assertEqual(len(sweep.groups), 2)      # Encodings
+        self.assertEqual(sweep.groups[0][1], [(((1,2,4), 'max'), [0, 3]),
+                                              (((1,2), 'max'), [1]),
+                                              (((1,2,4), 'mean'), [2])])
+        self.assertEqual(sweep.groups[1][1], [(((1,2,4), 'max'), [4])])
+
+        self.assertRaises(ValueError, ScSPMSweep, descs + [ScSPM(psize=24)])
+
+
+    def test_sweep_extract (self):
+        """ Test each configuration of a sweep gets its own extract() result.
+        """
+
+        imfile = os.path.join(self.__loc__, 'test.jpg')
+        timg = image.imread_resize(imfile, 200)
+        dic = patch.norm_patches(np.random.randn(16, 128)).T
+        descs = [ScSPM(maxdim=200, dsize=16, active=5, encoder='topk'),
+                 ScSPM(maxdim=200, dsize=16, active=5, encoder='topk',
+                       levels=(1,2)),
+                 ScSPM(maxdim=200, dsize=16, active=5, encoder='topk',
+                       pooling='mean', compress_dim=10),
+                 ScSPM(maxdim=200, dsize=16, active=5, encoder='topk',
+                       compress_dim=10),
+                 ScSPM(maxdim=200, dsize=16, active=3, encoder='topk',
+                       pooling='maxabs'),
+                 ScSPM(maxdim=200, dsize=16, active=3, encoder='topk',
+                       flat_threshold=0.5)]
+        for d in descs:
+            d.dic = dic
+
+        sweep = ScSPMSweep(descs)
+        feas = sweep.extract(timg)
+        for fea, d in zip(feas, descs):
+            self.assertTrue(np.allclose(fea, d.extract(timg)))
+
+        tdir = tempfile.mkdtemp()
+        try:
+            savedirs = [os.path.join(tdir, str(i)) for i in range(len(descs))]
+            self.assertFalse(extractor.extract_sweep([imfile], savedirs, sweep,
+                                                     njobs=1))
+            for savedir in savedirs:
+                self.assertTrue(os.path.exists(os.path.join(savedir, 
+                                                            'test.p')))
+        finally:
+            shutil.rmtree(tdir)
+
+
+    def test_dictionary_drift (self):
+        """ Test the atom drift report of a dictionary update. """
+
+        dic = np.random.randn(128, 20)
+        drift = encode.dictionary_drift(dic, 3 * dic)
+        self.assertAlmostEqual(drift['mean_cosine'], 1)
+        self.assertEqual(drift['changed'], 0)
+
+        newdic = dic.copy()
+        newdic[:, :5] = -newdic[:, :5]
+        drift = encode.dictionary_drift(dic, newdic)
+        self.assertAlmostEqual(drift['min_cosine'], -1)
+        self.assertEqual(drift['changed'], 5)
+        self.assertAlmostEqual(drift['changed_fraction'], 0.25)
+
+
+    def test_dictionary_plateau (self):
+        """ Test early stopping of segmented dictionary learning. """
+
+        desc = ScSPM(dsize=16)
+        plateaued = desc._ScSPM__plateaued
+        for obj in (1., 0.5, 0.4):
+            desc.dichistory.append({'objective': obj})
+        self.assertFalse(plateaued(1e-3, 2))
+
+        desc.dichistory.append({'objective': 0.39999})
+        self.assertFalse(plateaued(1e-3, 2))
+        desc.dichistory.append({'objective': 0.39998})
+        self.assertTrue(plateaued(1e-3, 2))
+        self.assertFalse(plateaued(None, 2))
+
+
+    def test_scheduler (self):
+        """ Test largest-first, adaptive chunk scheduling. """
+
+        costs = [1., 100., 1., 1., 50., 1., 1., 1.]
+        sched = schedule.Scheduler(costs, njobs=2, target=1.)
+        self.assertEqual(sched.next_chunk(), [1])   # Largest first, alone
+
+        sched.record(1, 1.)                         # 100 cost/second
+        self.assertEqual(sched.next_chunk(), [4])
+        chunk = sched.next_chunk()                  # remaining / (2 * njobs)
+        self.assertEqual(len(chunk), 1)
+        self.assertEqual(len(sched), 5)
+
+        sched.requeue(chunk, front=True)
+        self.assertEqual(sched.next_chunk(), chunk)
+
+        # Image header sizes
+        tsize = image.imread_size(os.path.join(self.__loc__, 'test.jpg'))
+        self.assertEqual(tsize, (214, 320))
+
+
+    def test_threads (self):
+        """ Test the thread budget. """
+
+        self.assertEqual(threads.thread_budget(4, cores=16), 4)
+        self.assertEqual(threads.thread_budget(32, cores=16), 1)
+
+        old = threads.get_threads(None)
+        try:
+            threads.set_threads(3)
+            self.assertEqual(threads.get_threads(), 3)
+            self.assertEqual(os.environ['OMP_NUM_THREADS'], '3')
+            threads.set_threads(None)
+            self.assertEqual(threads.get_threads(-1), -1)
+        finally:
+            threads.set_threads(old)
+
+        # Slots are claimed once, and freed when their process exits
+        slots = mp.Array('i', 2)
+        self.assertEqual(threads.claim_slot(slots), 0)
+        self.assertEqual(threads.claim_slot(slots), 0)
+        proc = subprocess.Popen([sys.executable, '-c', 'pass'])
+        proc.wait()
+        slots[0] = proc.pid
+        self.assertEqual(threads.claim_slot(slots), 0)
+        slots[1] = proc.pid
+        slots[0] = os.getppid()
+        self.assertEqual(threads.claim_slot(slots), 1)
+        slots[1] = os.getppid()
+        self.assertEqual(threads.claim_slot(slots), None)
+
+
+    def test_memory (self):
+        """ Test memory size parsing, measurement and estimates. """
+
+        self.assertEqual(memory.parse_size('512M'), 512 * 1024**2)
+        self.assertEqual(memory.parse_size('1.5GB'), int(1.5 * 1024**3))
+        self.assertEqual(memory.parse_size(1000), 1000)
+        self.assertRaises(ValueError, memory.parse_size, 'lots')
+        self.assertTrue(memory.peak_rss() > 0)
+
+        stats = memory.MemoryStats(noutliers=2)
+        for i, peak in enumerate([10, 30, 20]):
+            stats.add('im{0}'.format(i), peak, 10)
+        summary = stats.summary()
+        self.assertEqual(summary['peak_max'], 30)
+        self.assertEqual(summary['peak_to_estimate'], 2.)
+        self.assertEqual([o['name'] for o in summary['outliers']], 
+                         ['im1', 'im2'])
+
+        # Bigger images need more memory, until they are resized to maxdim
+        desc = ScSPM(maxdim=320)
+        self.assertTrue(desc.memory_estimate((100, 100)) < 
+                        desc.memory_estimate((300, 300)) <
+                        desc.memory_estimate((3000, 3000)))
+
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -0,0 +1,174 @@
+# Imdescrip -- a collection of tools to extract descriptors from images.
+# Copyright (C) 2013 Daniel M. Steinberg (daniel.m.steinberg@gmail.com)
+#
+# This file is part of Imdescrip.
+#
+# Imdescrip is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Imdescrip is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Imdescrip. If not, see <http://www.gnu.org/licenses/>.
+
+""" Learned (PCA) compression of descriptors, fitted from streamed batches.
+
+    Random projection needs many dimensions to preserve the distances between
+    descriptors, a PCA projection learned from the descriptors themselves
+    needs far fewer. The IncrementalPCA here [1] is fitted one batch at a
+    time, so only (ncomponents + batchsize) descriptors are in memory at once,
+    and descriptors can be streamed from an extraction output directory with
+    feature_batches().
+
+    [1] Ross, D. A.; Lim, J.; Lin, R. & Yang, M. Incremental Learning for
+        Robust Visual Tracking, International Journal of Computer Vision,
+        2008, 77, 125-141
+
+"""
+
+import os, glob, cPickle
+import numpy as np
+
+
+class IncrementalPCA ():
+    """ Principal component analysis, fitted incrementally in batches.
+
+    The way this class is typically used is
+
+        pca = IncrementalPCA(512)
+        for X in feature_batches(feadir):
+            pca.partial_fit(X)
+        Y = pca.transform(X)
+
+    Arguments:
+        ncomponents: int, the number of principal components to keep.
+
+    """
+
+    def __init__ (self, ncomponents):
+
+        self.ncomponents = ncomponents
+        self.nsamples = 0
+        self.mean = None
+        self.components = None      # (ncomponents, dims), rows are components
+        self.singular = None        # Singular values of the components
+        self.scatter = 0.           # Total sum of squared deviations
+
+
+    def partial_fit (self, X):
+        """ Update the principal components with a batch of samples.
+
+        Arguments:
+            X: (nsamples, dims) array of samples (e.g. descriptors).
+
+        """
+
+        X = np.asarray(X, dtype=np.float64)
+        m = X.shape[0]
+        if m == 0:
+            return
+        n = self.nsamples
+        total = n + m
+
+        bmean = X.mean(axis=0)
+        Xc = X - bmean
+        bscatter = (Xc**2).sum()
+
+        if n == 0:
+            self.mean = bmean
+            self.scatter = bscatter
+        else:
+
+            # Stack the old components, the new (centred) samples, and a
+            # correction for the shift in the mean
+            shift = self.mean - bmean
+            Xc = np.vstack((self.singular[:, np.newaxis] * self.components, Xc,
+                            np.sqrt(float(n) * m / total) * shift))
+            self.mean = self.mean + shift * (-float(m) / total)
+            self.scatter += bscatter + float(n) * m / total * np.dot(shift,
+                                                                     shift)
+
+        U, S, Vt = np.linalg.svd(Xc, full_matrices=False)
+        k = min(self.ncomponents, S.shape[0])
+
+        # Make the signs deterministic, largest loading positive
+        signs = np.sign(Vt[np.arange(k), np.abs(Vt[:k]).argmax(axis=1)])
+        signs[signs == 0] = 1
+        self.components = Vt[:k] * signs[:, np.newaxis]
+        self.singular = S[:k]
+        self.nsamples = total
+
+
+    def transform (self, X, out=None):
+        """ Project samples onto the principal components.
+
+        Arguments:
+            X: (nsamples, dims) or (dims,) array of samples.
+            out: array (default None) to write the projections into.
+
+        Returns:
+            (nsamples, ncomponents) or (ncomponents,) array of projections.
+
+        """
+
+        if self.components is None:
+            raise ValueError('The PCA has not been fitted!')
+
+        if out is None:
+            return np.dot(X - self.mean, self.components.T)
+        return np.dot(X - self.mean, self.components.T, out=out)
+
+
+    def explained_variance (self):
+        """ Get the variance explained by each of the components. """
+
+        return self.singular**2 / max(1, self.nsamples - 1)
+
+
+    def explained_variance_ratio (self):
+        """ Get the fraction of the total variance explained by each component.
+        """
+
+        return self.singular**2 / max(self.scatter, 1e-300)
+
+
+def feature_batches (feadir, batchsize=1000, maxfiles=None):
+    """ Stream descriptors from an extraction output directory in batches.
+
+    Arguments:
+        feadir: str, a directory of pickled descriptors (".p" files), as
+            written by the extractor module.
+        batchsize: int (default 1000), the number of descriptors per batch.
+        maxfiles: int (default None), only read this many descriptor files,
+            None means all of them.
+
+    Yields:
+        (batchsize, dims) arrays of descriptors, the last batch may be smaller.
+        The same array is re-used for every batch, so copy it to keep it.
+
+    """
+
+    files = sorted(glob.glob(os.path.join(feadir, '*.p')))[:maxfiles]
+
+    batch = None
+    for i, feafile in enumerate(files):
+        with open(feafile, 'rb') as f:
+            fea = np.asarray(cPickle.load(f), dtype=np.float64).ravel()
+
+        if batch is None:
+            batch = np.empty((min(batchsize, len(files)), fea.shape[0]))
+        if fea.shape[0] != batch.shape[1]:
+            raise ValueError('{0} has {1} dimensions, not {2}!'
+                             .format(feafile, fea.shape[0], batch.shape[1]))
+
+        batch[i % batchsize] = fea
+        if (i % batchsize == batchsize - 1):
+            yield batch
+
+    if (batch is not None) and (len(files) % batchsize > 0):
+        yield batch[:len(files) % batchsize]
@@ -0,0 +1,252 @@
+# Imdescrip -- a collection of tools to extract descriptors from images.
+# Copyright (C) 2013 Daniel M. Steinberg (daniel.m.steinberg@gmail.com)
+#
+# This file is part of Imdescrip.
+#
+# Imdescrip is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Imdescrip is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Imdescrip. If not, see <http://www.gnu.org/licenses/>.
+
+""" Near-duplicate image detection with perceptual (difference) hashes.
+
+    Consecutive frames of a survey often overlap heavily, so extracting a
+    descriptor for every one of them is mostly redundant. A 64 bit difference
+    hash (dHash [1]) is computed from a tiny decode of each image, and images
+    whose hashes are within a Hamming distance of an earlier (representative)
+    image are near-duplicates of it. The HashIndex finds these without
+    comparing every pair of images.
+
+    The tiny decode uses PIL (draft mode, which decodes JPEGs at 1/8 scale or
+    smaller) if it is installed, otherwise OpenCV.
+
+    [1] Krawetz, N. Kind of like that, The Hacker Factor Blog, 2013.
+        http://www.hackerfactor.com/blog/?/archives/529-Kind-of-Like-That.html
+
+"""
+
+import os, json
+import numpy as np
+from image import imread_resize, rgb2gray
+
+
+HASHBITS = 64
+DUPLICATES = 'duplicates.json'
+
+
+def image_hash (imfile):
+    """ Compute the difference hash (dHash) of an image.
+
+    Arguments:
+        imfile: str, the image file name.
+
+    Returns:
+        int, the 64 bit hash of the image, or None if it can't be read.
+
+    """
+
+    try:
+        img = __tiny_gray(imfile, 32)
+    except Exception:
+        return None
+
+    return gray_hash(img)
+
+
+def gray_hash (img):
+    """ Compute the difference hash (dHash) of a (small) gray image.
+
+    Arguments:
+        img: (rows, cols) array of a gray image, at least 8 x 9 pixels is best.
+
+    Returns:
+        int, the 64 bit (unsigned) hash of the image.
+
+    """
+
+    # 8 rows of 9 columns, each bit is whether brightness increases. The bit
+    # numbers are python ints, so the top bit doesn't overflow an int64.
+    small = __area_resize(np.asarray(img, np.float64), 8, 9)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return sum(1 << int(i) for i in np.nonzero(bits)[0])
+
+
+def hamming (hash1, hash2):
+    """ Get the Hamming distance (number of different bits) between hashes. """
+
+    return bin(hash1 ^ hash2).count('1')
+
+
+def max_distance (similarity):
+    """ Convert a similarity (fraction of equal hash bits) into a distance.
+
+    Arguments:
+        similarity: float in [0, 1], e.g. 0.9 means at least 90% of the hash
+            bits must be the same.
+
+    Returns:
+        int, the maximum Hamming distance between the hashes.
+
+    """
+
+    return int(np.floor((1. - similarity) * HASHBITS + 1e-9))
+
+
+class HashIndex ():
+    """ An index of hashes, for finding hashes within a Hamming distance.
+
+    The hashes are split into maxdist + 1 bands of bits, and any two hashes
+    within maxdist of each other must have at least one band that is the same
+    (the pigeonhole principle). So only the hashes that share a band with a
+    query need to be compared with it, and none are missed.
+
+    The way this class is typically used is
+
+        index = HashIndex(maxdist)
+        for item, h in enumerate(hashes):
+            match, dist = index.query(h)
+            if match is None:
+                index.add(h, item)
+
+    Arguments:
+        maxdist: int, the maximum Hamming distance of a match.
+
+    """
+
+    def __init__ (self, maxdist):
+
+        self.maxdist = maxdist
+        nbands = min(maxdist + 1, HASHBITS)
+        edges = np.linspace(0, HASHBITS, nbands + 1).astype(int)
+        self.bands = [((1 << (hi - lo)) - 1, lo) for lo, hi in zip(edges[:-1],
+                      edges[1:])]
+        self.tables = [{} for b in self.bands]
+        self.hashes = {}
+
+
+    def __len__ (self):
+
+        return len(self.hashes)
+
+
+    def add (self, ahash, item):
+        """ Add an item with a hash to the index. """
+
+        self.hashes[item] = ahash
+        for table, key in zip(self.tables, self.__keys(ahash)):
+            table.setdefault(key, []).append(item)
+
+
+    def query (self, ahash):
+        """ Find the closest item in the index, within maxdist of a hash.
+
+        Returns:
+            the item, or None if there isn't one.
+            int, the Hamming distance to the item (None if there isn't one).
+
+        """
+
+        best, bestdist = None, None
+        for table, key in zip(self.tables, self.__keys(ahash)):
+            for item in table.get(key, []):
+                dist = hamming(ahash, self.hashes[item])
+                if (dist <= self.maxdist) and ((bestdist is None) or
+                                               (dist < bestdist)):
+                    best, bestdist = item, dist
+
+        return best, bestdist
+
+
+    def __keys (self, ahash):
+        """ The band keys of a hash. """
+
+        return [(ahash >> shift) & mask for mask, shift in self.bands]
+
+
+def find_duplicates (filelist, hashes, similarity=0.9):
+    """ Find the near-duplicates of earlier images in a list of images.
+
+    Arguments:
+        filelist: list, of image file names.
+        hashes: list, of the image_hash() of each image (None hashes are never
+            duplicates).
+        similarity: float (default 0.9), the fraction of hash bits that must
+            be the same for images to be near-duplicates.
+
+    Returns:
+        dict, of {duplicate image: {"original": representative image,
+            "distance": Hamming distance}} for all of the near-duplicates. The
+            representative images are never duplicates themselves.
+
+    """
+
+    index = HashIndex(max_distance(similarity))
+    duplicates = {}
+
+    for imfile, ahash in zip(filelist, hashes):
+        if ahash is None:
+            continue
+
+        original, dist = index.query(ahash)
+        if original is None:
+            index.add(ahash, imfile)
+        else:
+            duplicates[imfile] = {'original': original, 'distance': dist}
+
+    return duplicates
+
+
+def write_duplicates (savedir, duplicates, mode):
+    """ Write the near-duplicates found to "duplicates.json" in savedir.
+
+    Arguments:
+        savedir: str, the directory to write to.
+        duplicates: dict, from find_duplicates().
+        mode: str, what was done with the duplicates, e.g. 'skip' or 'copy'.
+
+    """
+
+    with open(os.path.join(savedir, DUPLICATES), 'w') as f:
+        json.dump({'mode': mode, 'duplicates': duplicates}, f, indent=2,
+                  sort_keys=True)
+
+
+def __tiny_gray (imfile, size):
+    """ Decode a small (at least size pixels a side) gray version of an image.
+    """
+
+    try:
+        from PIL import Image
+    except ImportError:
+        img = imread_resize(imfile, 4 * size)
+        return np.float64(rgb2gray(img) if img.ndim > 2 else img)
+
+    im = Image.open(imfile)
+    im.draft('L', (size, size)) # Only JPEG supports this, others are ignored
+    return np.asarray(im.convert('L'), np.float64)
+
+
+def __area_resize (img, rows, cols):
+    """ Resize a gray image down by averaging (rows x cols) blocks of pixels.
+    """
+
+    h, w = img.shape
+    if (h < rows) or (w < cols):
+        img = np.repeat(np.repeat(img, int(np.ceil(float(rows) / h)), axis=0),
+                        int(np.ceil(float(cols) / w)), axis=1)
+        h, w = img.shape
+
+    redges = np.linspace(0, h, rows + 1).astype(int)
+    cedges = np.linspace(0, w, cols + 1).astype(int)
+    sums = np.add.reduceat(np.add.reduceat(img, redges[:-1], axis=0),
+                           cedges[:-1], axis=1)
+    counts = np.outer(np.diff(redges), np.diff(cedges))
+    return sums / counts
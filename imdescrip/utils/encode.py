@@ -0,0 +1,535 @@
+# Imdescrip -- a collection of tools to extract descriptors from images.
+# Copyright (C) 2013 Daniel M. Steinberg (daniel.m.steinberg@gmail.com)
+#
+# This file is part of Imdescrip.
+#
+# Imdescrip is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Imdescrip is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Imdescrip. If not, see <http://www.gnu.org/licenses/>.
+
+""" Functions for encoding patches (e.g. SIFT) with a dictionary.
+
+    All of these functions take an (npatches, ndims) array of patches and an
+    (ndims, dsize) dictionary (one atom per column, as learned by SPAMs), and
+    return a dense (npatches, dsize) array of codes. They are all vectorised
+    over every patch in the input, so pass in all of the patches of an image
+    (or batch of images) at once. The codes can also be written into an
+    existing (npatches, dsize) C ordered float64 array, out, e.g. from a
+    utils.workspace.Workspace, to save allocating them for every image.
+
+    omp() is the original (and most accurate) encoder used by ScSPM.
+    batch_omp() gives the same codes, but re-uses a precomputed dictionary
+    Gram matrix (D^T D) and Cholesky updates [3], which is a lot faster for
+    large dictionaries. The others trade some accuracy for speed:
+
+        llc():              locality-constrained linear coding [1], the k
+                            nearest atoms plus a small (k x k) solve.
+        soft_threshold():   one matrix multiply and shrinkage [2].
+        hard_topk():        one matrix multiply and keeping the k largest
+                            (absolute) responses.
+
+    [1] Wang, J.; Yang, J.; Yu, K.; Lv, F.; Huang, T. & Gong, Y.
+        Locality-constrained linear coding for image classification, Computer
+        Vision and Pattern Recognition, 2010. CVPR 2010. IEEE Conference on,
+        2010, 3360-3367
+
+    [2] Coates, A. & Ng, A. The importance of encoding versus training with
+        sparse coding and vector quantization, International Conference on
+        Machine Learning (ICML), 2011.
+
+    [3] Rubinstein, R.; Zibulevsky, M. & Elad, M. Efficient implementation of
+        the K-SVD algorithm using batch orthogonal matching pursuit, Technical
+        Report CS-2008-08, Technion, 2008.
+
+"""
+
+import numpy as np
+from patch import norm_patches
+
+
+def omp (patches, dic, active, numThreads=1, out=None):
+    """ Orthogonal matching pursuit encoding (using SPAMs).
+
+    Arguments:
+        patches: (npatches, ndims) array of patches.
+        dic: (ndims, dsize) Fortran ordered dictionary array.
+        active: int, the number of non-zero coefficients for each patch.
+        numThreads: int (default 1), the number of threads SPAMs can use.
+        out: (npatches, dsize) array (default None) to write the codes into.
+
+    Returns:
+        (npatches, dsize) array of codes.
+
+    """
+
+    from spams import omp as spomp
+
+    codes = spomp(np.asfortranarray(patches.T, np.float64), dic, active,
+                  eps=np.spacing(1), numThreads=numThreads)
+    if out is None:
+        return np.asarray(codes.todense()).T
+
+    # Scatter the sparse (dsize, npatches) codes, without a dense transpose
+    codes = codes.tocoo()
+    out.fill(0)
+    out[codes.col, codes.row] = codes.data
+    return out
+
+
+def batch_omp (patches, dic, active, gram=None, eps=np.spacing(1),
+                blocksize=1024, out=None, index=None, probes=4):
+    """ Batch orthogonal matching pursuit encoding [3].
+
+    This gives the same codes as omp(), but works with a (precomputed) Gram
+    matrix of the dictionary and a progressive Cholesky factorisation of the
+    selected atoms, so the patches are only ever multiplied by the dictionary
+    once. All of the patches in a block are coded at once.
+
+    Arguments:
+        patches: (npatches, ndims) array of patches.
+        dic: (ndims, dsize) dictionary array, with unit length atoms.
+        active: int, the (maximum) number of non-zero coefficients for each
+            patch.
+        gram: (dsize, dsize) array (default None) of the dictionary Gram
+            matrix, dic.T.dot(dic). This is computed if it is None, so pass it
+            in if encoding many images with the same dictionary.
+        eps: float (default machine epsilon), stop coding a patch once its
+            squared residual error is less than this.
+        blocksize: int (default 1024), the number of patches to code at once,
+            this bounds the memory used.
+        out: (npatches, dsize) array (default None) to write the codes into.
+        index: an AtomIndex (default None) of the dictionary, see
+            build_index(). If given, atoms are only selected from the
+            candidate atoms the index shortlists for each patch, which is
+            approximate, but much faster for large dictionaries.
+        probes: int (default 4), the number of atom clusters of the index to
+            shortlist atoms from, more is slower, but more accurate.
+
+    Returns:
+        (npatches, dsize) array of codes.
+
+    """
+
+    X = np.asarray(patches, np.float64)
+    if gram is None:
+        gram = dic.T.dot(dic)
+
+    active = min(active, dic.shape[0], dic.shape[1])
+    codes = _zeros((X.shape[0], dic.shape[1]), out)
+
+    for b in range(0, X.shape[0], blocksize):
+        Xb = X[b:b+blocksize]
+        shortlist = None if index is None else index.shortlist(Xb, dic, probes)
+        _batch_omp_block(Xb, dic, gram, active, eps, codes[b:b+blocksize],
+                         shortlist)
+
+    return codes
+
+
+def llc (patches, dic, knn=5, beta=1e-4, out=None):
+    """ Approximated locality-constrained linear coding [1].
+
+    Each (unit normalised) patch is coded with its knn closest atoms, which are
+    found using a single matrix multiply. The codes are the solution of a
+    small regularised least squares problem (with a sum-to-one constraint).
+
+    Arguments:
+        patches: (npatches, ndims) array of patches.
+        dic: (ndims, dsize) dictionary array, with unit length atoms.
+        knn: int (default 5), the number of nearest atoms to use.
+        beta: float (default 1e-4), the regularisation of the local solve.
+        out: (npatches, dsize) array (default None) to write the codes into.
+
+    Returns:
+        (npatches, dsize) array of codes.
+
+    """
+
+    X = norm_patches(np.asarray(patches, np.float64))
+    npatches, dsize = X.shape[0], dic.shape[1]
+    knn = min(knn, dsize)
+
+    # For unit atoms and patches the nearest atoms have the largest responses
+    idx = _topk(X.dot(dic), knn, absolute=False)
+
+    # Solve for the local codes, all patches at once
+    Z = dic.T[idx] - X[:, np.newaxis, :]            # (npatches, knn, ndims)
+    C = np.einsum('nkd,nld->nkl', Z, Z)
+    C += np.eye(knn) * (beta * np.trace(C, axis1=1, axis2=2))[:, np.newaxis,
+                                                              np.newaxis]
+    w = np.linalg.solve(C, np.ones((npatches, knn, 1)))[:, :, 0]
+    w /= w.sum(axis=1)[:, np.newaxis]
+
+    codes = _zeros((npatches, dsize), out)
+    codes[np.arange(npatches)[:, np.newaxis], idx] = w
+    return codes
+
+
+def soft_threshold (patches, dic, alpha=0.25, out=None):
+    """ Soft threshold encoding [2].
+
+    The codes are the responses of the (unit normalised) patches to the atoms,
+    shrunk towards zero by alpha, i.e. sign(z) * max(0, |z| - alpha).
+
+    Arguments:
+        patches: (npatches, ndims) array of patches.
+        dic: (ndims, dsize) dictionary array, with unit length atoms.
+        alpha: float (default 0.25), the shrinkage threshold. Responses are in
+            [-1, 1], larger values give sparser codes.
+        out: (npatches, dsize) array (default None) to write the codes into.
+
+    Returns:
+        (npatches, dsize) array of codes.
+
+    """
+
+    codes = _dot(norm_patches(np.asarray(patches, np.float64)), dic, out)
+    shrunk = np.abs(codes)
+    shrunk -= alpha
+    np.maximum(shrunk, 0, out=shrunk)
+    np.copysign(shrunk, codes, out=codes)
+    return codes
+
+
+def hard_topk (patches, dic, active, out=None):
+    """ Hard top-k assignment encoding.
+
+    The codes are the responses of the (unit normalised) patches to the atoms
+    with the active largest absolute responses, all other codes are zero.
+
+    Arguments:
+        patches: (npatches, ndims) array of patches.
+        dic: (ndims, dsize) dictionary array, with unit length atoms.
+        active: int, the number of non-zero coefficients for each patch.
+        out: (npatches, dsize) array (default None) to write the codes into.
+
+    Returns:
+        (npatches, dsize) array of codes.
+
+    """
+
+    resp = norm_patches(np.asarray(patches, np.float64)).dot(dic)
+    npatches, dsize = resp.shape
+    idx = _topk(resp, min(active, dsize), absolute=True)
+
+    rows = np.arange(npatches)[:, np.newaxis]
+    codes = _zeros((npatches, dsize), out)
+    codes[rows, idx] = resp[rows, idx]
+    return codes
+
+
+def build_index (dic, nclusters=None, niter=10, rstate=np.random):
+    """ Build an AtomIndex of a dictionary, for shortlisting atoms.
+
+    The atoms are clustered with (spherical) k-means, where an atom and its
+    negation are the same, since OMP selects atoms by their absolute
+    correlation with a patch.
+
+    Arguments:
+        dic: (ndims, dsize) dictionary array.
+        nclusters: int (default None), the number of clusters of atoms, None
+            means sqrt(dsize).
+        niter: int (default 10), the number of k-means iterations.
+        rstate: a numpy RandomState object (default is the numpy global one).
+
+    Returns:
+        an AtomIndex object.
+
+    """
+
+    dsize = dic.shape[1]
+    if nclusters is None:
+        nclusters = int(round(np.sqrt(dsize)))
+    nclusters = min(nclusters, dsize)
+
+    atoms = np.asarray(dic, np.float64)
+    atoms = atoms / np.maximum(1e-20, np.sqrt((atoms**2).sum(axis=0)))
+    centres = atoms[:, rstate.permutation(dsize)[:nclusters]].copy()
+    cols = np.arange(dsize)
+
+    for i in range(niter + 1):
+        sim = centres.T.dot(atoms)
+        assign = np.abs(sim).argmax(axis=0)
+        if i == niter:
+            break
+
+        # New centres, with the atoms flipped to agree with their old centre
+        signed = atoms * np.sign(sim[assign, cols])
+        for c in range(nclusters):
+            members = assign == c
+            if members.any() == False: # Re-seed empty clusters
+                centres[:, c] = atoms[:, rstate.randint(dsize)]
+                continue
+            centre = signed[:, members].sum(axis=1)
+            centres[:, c] = centre / max(1e-20, np.sqrt((centre**2).sum()))
+
+    # Cluster members, padded with -1
+    sizes = np.bincount(assign, minlength=nclusters)
+    members = -np.ones((nclusters, sizes.max()), int)
+    for c in range(nclusters):
+        members[c, :sizes[c]] = np.nonzero(assign == c)[0]
+
+    return AtomIndex(centres, members)
+
+
+class AtomIndex ():
+    """ An index of clusters of dictionary atoms, for shortlisting the atoms a
+        patch is likely to be coded with, see build_index().
+
+    The candidate atoms for a patch are the atoms in the probes clusters whose
+    centres are most (absolutely) correlated with the patch. So a patch is
+    only correlated with nclusters + probes * dsize / nclusters atoms, rather
+    than all dsize atoms, e.g. 64 + 4 * 64 = 320 instead of 4096.
+
+    Arguments:
+        centres: (ndims, nclusters) array of the (unit) cluster centres.
+        members: (nclusters, maxsize) int array of the atoms in each cluster,
+            padded with -1.
+
+    """
+
+    def __init__ (self, centres, members):
+
+        self.centres = centres
+        self.members = members
+
+
+    def shortlist (self, patches, dic, probes=4):
+        """ Shortlist the candidate atoms for patches.
+
+        Arguments:
+            patches: (npatches, ndims) array of patches.
+            dic: (ndims, dsize) dictionary array (that this index was built
+                from).
+            probes: int (default 4), the number of atom clusters to shortlist
+                atoms from.
+
+        Returns:
+            (npatches, M) array of the responses of the patches to their
+                candidate atoms.
+            (npatches, M) int array of the candidate atoms of the patches.
+            (npatches, M) bool array, which candidates are valid (the rest are
+                padding).
+
+        """
+
+        n = patches.shape[0]
+        nclusters, size = self.members.shape
+        probes = min(probes, nclusters)
+        top = _topk(patches.dot(self.centres), probes, absolute=True)
+
+        cand = self.members[top].reshape(n, probes * size)
+        valid = cand >= 0
+        cand[~valid] = 0
+
+        # Responses, one matrix multiply per cluster (and probe)
+        resp = np.zeros((n, probes, size))
+        for j in range(probes):
+            order = np.argsort(top[:, j], kind='mergesort')
+            splits = np.nonzero(np.diff(top[order, j]))[0] + 1
+            for rows in np.split(order, splits):
+                atoms = self.members[top[rows[0], j]]
+                atoms = atoms[atoms >= 0]
+                resp[rows, j, :len(atoms)] = patches[rows].dot(dic[:, atoms])
+
+        return resp.reshape(n, probes * size), cand, valid
+
+
+def dictionary_drift (olddic, newdic, threshold=0.95):
+    """ Measure how much the atoms of a dictionary have changed, e.g. after an
+        update.
+
+    The drift of each atom is measured by the cosine similarity between its
+    old and new versions (1 is unchanged). Codes, and so descriptors, made
+    with atoms that have drifted a lot will not be comparable with codes from
+    the new dictionary.
+
+    Arguments:
+        olddic: (ndims, dsize) array of the old dictionary.
+        newdic: (ndims, dsize) array of the new dictionary.
+        threshold: float (default 0.95), atoms with a cosine similarity below
+            this are counted as changed.
+
+    Returns:
+        dict, with the mean and minimum cosine similarity of the atoms, and the
+        number and fraction of atoms that have changed.
+
+    """
+
+    if olddic.shape != newdic.shape:
+        raise ValueError('The dictionaries need to be the same shape!')
+
+    cosine = (olddic * newdic).sum(axis=0) / np.maximum(1e-20, 
+                np.sqrt((olddic**2).sum(axis=0) * (newdic**2).sum(axis=0)))
+    changed = int((cosine < threshold).sum())
+
+    return {
+        'mean_cosine': float(cosine.mean()),
+        'min_cosine': float(cosine.min()),
+        'threshold': threshold,
+        'changed': changed,
+        'changed_fraction': float(changed) / cosine.size
+        }
+
+
+def dictionary_objective (patches, dic, lambda1=0.15, numThreads=1):
+    """ Measure how well a dictionary codes patches, e.g. held-out patches.
+
+    The patches are coded with the lasso (using SPAMs), with the same L1
+    constraint, ||a||_1 <= lambda1, as dictionary learning (trainDL mode 0).
+
+    Arguments:
+        patches: (npatches, ndims) array of (normalised) patches.
+        dic: (ndims, dsize) array of the dictionary.
+        lambda1: float (default 0.15), the L1 constraint on the codes.
+        numThreads: int (default 1), the number of threads SPAMs can use.
+
+    Returns:
+        dict, with the objective (the mean of 0.5 * ||x - D a||^2, lower is
+        better), and the sparsity (the mean number of non-zero codes).
+
+    """
+
+    from spams import lasso
+
+    X = np.asfortranarray(patches.T, np.float64)
+    D = np.asfortranarray(dic, np.float64)
+    codes = lasso(X, D=D, lambda1=lambda1, mode=0, numThreads=numThreads)
+
+    resid = X - codes.T.dot(D.T).T
+    return {
+        'objective': float(0.5 * (resid**2).sum() / X.shape[1]),
+        'sparsity': float(codes.nnz) / X.shape[1]
+        }
+
+
+def _batch_omp_block (X, dic, gram, active, eps, codes, shortlist=None):
+    """ Batch-OMP of a block of patches, X, written into codes. 
+
+    If a shortlist is given (see AtomIndex.shortlist()), atoms are only
+    selected from the candidate atoms of each patch.
+    """
+
+    n = X.shape[0]
+    if shortlist is None:
+        alpha0 = X.dot(dic)             # Initial atom responses
+        cand = None
+    else:
+        alpha0, cand, valid = shortlist
+        Gc = np.zeros((n, active, cand.shape[1])) # Gram rows of selections
+    alpha = alpha0.copy()               # Residual atom responses
+    err = (X**2).sum(axis=1)            # Squared residual errors
+    xnorm = err.copy()
+    idx = np.zeros((n, active), int)    # Selected atoms
+    lidx = np.zeros((n, active), int)   # Selected atoms (columns of alpha)
+    gamma = np.zeros((n, active))       # Coefficients of the selected atoms
+    nsel = np.zeros(n, int)             # Number of selected atoms
+    L = np.zeros((n, active, active))   # Cholesky factors of gram[I, I]
+    live = np.arange(n)                 # Patches still being coded
+
+    for t in range(active):
+
+        live = live[err[live] > eps]
+        if len(live) == 0:
+            break
+
+        # Select the atom most correlated with the residual
+        score = np.abs(alpha[live])
+        if cand is not None:
+            score[~valid[live]] = -1
+        lsel = score.argmax(axis=1)
+        sel = lsel if cand is None else cand[live, lsel]
+
+        # Update the Cholesky factorisation with the new atom
+        if t == 0:
+            L[live, 0, 0] = 1
+        else:
+            w = _forward(L[live, :t, :t], gram[idx[live, :t], sel[:, None]])
+            diag = 1 - (w**2).sum(axis=1)
+
+            # Stop coding patches where the new atom is linearly dependent
+            indep = diag > 1e-10
+            live, sel, lsel = live[indep], sel[indep], lsel[indep]
+            w, diag = w[indep], diag[indep]
+            if len(live) == 0:
+                break
+
+            L[live, t, :t] = w
+            L[live, t, t] = np.sqrt(diag)
+
+        idx[live, t] = sel
+        lidx[live, t] = lsel
+        nsel[live] = t + 1
+
+        # Solve L L^T gamma = alpha0_I for the new coefficients
+        Ll = L[live, :t+1, :t+1]
+        a0 = alpha0[live[:, None], lidx[live, :t+1]]
+        gam = _backward(Ll, _forward(Ll, a0))
+        gamma[live, :t+1] = gam
+
+        # Update the residual responses and errors, alpha = alpha0 - G_I gamma
+        alive = alpha0[live]
+        if cand is None:
+            for j in range(t + 1):
+                alive -= gam[:, j:j+1] * gram[idx[live, j]]
+        else:
+            Gc[live, t] = gram[sel[:, None], cand[live]]
+            alive -= np.einsum('nj,njm->nm', gam, Gc[live, :t+1])
+        alpha[live] = alive
+        err[live] = xnorm[live] - (gam * a0).sum(axis=1)
+
+    # Scatter the coefficients into the codes
+    rows, cols = np.nonzero(np.arange(active) < nsel[:, None])
+    codes[rows, idx[rows, cols]] = gamma[rows, cols]
+
+
+def _forward (L, b):
+    """ Solve L y = b for a stack of lower triangular matrices, L. """
+
+    y = np.empty_like(b)
+    for j in range(b.shape[1]):
+        y[:, j] = (b[:, j] - (L[:, j, :j] * y[:, :j]).sum(axis=1)) / L[:, j, j]
+    return y
+
+
+def _backward (L, b):
+    """ Solve L^T x = b for a stack of lower triangular matrices, L. """
+
+    x = np.empty_like(b)
+    for j in reversed(range(b.shape[1])):
+        x[:, j] = (b[:, j] - (L[:, j+1:, j] * x[:, j+1:]).sum(axis=1)) \
+                    / L[:, j, j]
+    return x
+
+
+def _zeros (shape, out=None):
+    """ Get a zeroed array, out if it is given. """
+
+    if out is None:
+        return np.zeros(shape)
+    out.fill(0)
+    return out
+
+
+def _dot (a, b, out=None):
+    """ Matrix multiply, into out if it is given. """
+
+    if out is None:
+        return a.dot(b)
+    return np.dot(a, b, out=out)
+
+
+def _topk (resp, k, absolute=False):
+    """ Get the (unordered) column indices of the k largest values per row. """
+
+    score = np.abs(resp) if absolute == True else resp
+    return np.argpartition(-score, k - 1, axis=1)[:, :k]
@@ -16,9 +16,14 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with Imdescrip. If not, see <http://www.gnu.org/licenses/>.
 
-""" Some useful and generic commonly performed image operations. """
+""" Some useful and generic commonly performed image operations. 
 
-import cv
+    NOTE: OpenCV (cv) is imported on first use, not when this module is
+          imported. So is rasterio, which is optionally used by open_windows()
+          for windowed reading of very large (e.g. GeoTIFF) images.
+"""
+
+import struct
 import numpy as np
 
 
@@ -26,7 +31,9 @@ def imread_resize (imname, maxdim=None):
     """ Read and resize the and image to a maximum dimension (preserving aspect)
 
     Arguments:
-        imname: string of the full name and path to the image to be read
+        imname: string of the full name and path to the image to be read, or
+            an already decoded (height, width[, channels]) np.array image
+            (e.g. from imdecode_resize()), which is just resized.
         maxdim: int of the maximum dimension the image should take (in pixels).
             None if no resize is to take place (same as imread).
 
@@ -38,8 +45,43 @@ def imread_resize (imname, maxdim=None):
             image's type.
     """
 
+    if isinstance(imname, np.ndarray):
+        return imresize(imname, maxdim)
+
+    import cv
+
     # read in the image
-    image = cv.LoadImageM(imname)
+    return __resize_rgb(cv.LoadImageM(imname), maxdim)
+
+
+def imdecode_resize (data, maxdim=None):
+    """ Decode an (encoded, e.g. JPEG) image from memory, and resize it.
+
+    Arguments:
+        data: str (bytes) of the encoded image, e.g. read from an archive.
+        maxdim: int of the maximum dimension the image should take (in pixels).
+            None if no resize is to take place.
+
+    Returns:
+        image: (height, width, channels) np.array of the image, see
+            imread_resize().
+    """
+
+    import cv
+
+    buf = cv.CreateMatHeader(1, len(data), cv.CV_8UC1)
+    cv.SetData(buf, data, len(data))
+    image = cv.DecodeImageM(buf)
+    if (image is None) or (image.rows == 0):
+        raise IOError('Could not decode the image!')
+
+    return __resize_rgb(image, maxdim)
+
+
+def __resize_rgb (image, maxdim):
+    """ Resize an OpenCV image, and convert it to an RGB (or gray) array. """
+
+    import cv
 
     # Resize image if necessary
     imgdim = max(image.rows, image.cols)
@@ -78,7 +120,225 @@ def rgb2gray (rgbim):
     elif rgbim.ndim != 3:
         raise ValueError("Need a three channel image!")
 
+    import cv
+
     grayim = cv.CreateMat(rgbim.shape[0], rgbim.shape[1], cv.CV_8UC1)
     cv.CvtColor(cv.fromarray(rgbim), grayim, cv.CV_RGB2GRAY) 
     return np.asarray(grayim)
 
+
+
+def imresize (image, maxdim=None):
+    """ Resize an image (in memory) to a maximum dimension (preserving aspect).
+
+    Arguments:
+        image: (height, width[, channels]) np.array of an image.
+        maxdim: int of the maximum dimension the image should take (in pixels).
+            None if no resize is to take place.
+
+    Returns:
+        image: (height, width[, channels]) np.array of the image, if maxdim is
+            not None, then {height, width} <= maxdim. This is the input image
+            if it is not resized.
+    """
+
+    imgdim = max(image.shape[:2])
+    if (maxdim is None) or (imgdim <= maxdim):
+        return image
+
+    import cv
+
+    scaler = float(maxdim)/imgdim
+    imin = cv.fromarray(np.ascontiguousarray(image))
+    imout = cv.CreateMat(int(round(scaler*image.shape[0])),
+                         int(round(scaler*image.shape[1])), imin.type)
+    cv.Resize(imin, imout)
+    return np.asarray(imout)
+
+
+def video_frames (videoname, maxdim=None, every=1, gray=False):
+    """ Read the frames of a video, resized to a maximum dimension.
+
+    This is a generator, and the decoding, colour conversion and resize
+    buffers are allocated once and re-used for every frame. So the frames
+    yielded are overwritten by the next frame, copy them if they need to be
+    kept. Frames that are skipped (see every) are not decoded.
+
+    Arguments:
+        videoname: string of the full name and path to the video to be read.
+        maxdim: int of the maximum dimension the frames should take (in
+            pixels). None if no resize is to take place.
+        every: int (default 1), only read every k-th frame.
+        gray: bool (default False), convert the frames to gray-scale.
+
+    Yields:
+        frameno: int, the number of the frame in the video (from 0).
+        image: (height, width[, 3]) np.array of the frame in RGB (or gray).
+    """
+
+    import cv
+
+    capture = cv.CaptureFromFile(videoname)
+    if capture is None:
+        raise IOError('Cannot open video {0}!'.format(videoname))
+
+    frameno = -1
+    colbuf, sizebuf = None, None
+    while cv.GrabFrame(capture):
+
+        frameno += 1
+        if frameno % every != 0:
+            continue
+
+        frame = cv.GetMat(cv.RetrieveFrame(capture))
+
+        # Colour conversion, BGR -> RGB or gray
+        if colbuf is None:
+            ctype = cv.CV_8UC1 if gray == True else cv.CV_8UC3
+            colbuf = cv.CreateMat(frame.rows, frame.cols, ctype)
+        cv.CvtColor(frame, colbuf, cv.CV_BGR2GRAY if gray == True 
+                    else cv.CV_BGR2RGB)
+
+        # Resize if necessary
+        imgdim = max(frame.rows, frame.cols)
+        if (maxdim is None) or (imgdim <= maxdim):
+            yield frameno, np.asarray(colbuf)
+            continue
+
+        if sizebuf is None:
+            scaler = float(maxdim)/imgdim
+            sizebuf = cv.CreateMat(int(round(scaler*frame.rows)),
+                                   int(round(scaler*frame.cols)), colbuf.type)
+        cv.Resize(colbuf, sizebuf)
+        yield frameno, np.asarray(sizebuf)
+
+
+def imread_size (imname):
+    """ Read the size of an image from its header, without decoding it.
+
+    This only reads the first few KB of the image file, and understands PNG,
+    JPEG, GIF and BMP images.
+
+    Arguments:
+        imname: string of the full name and path to the image.
+
+    Returns:
+        (height, width) tuple of the image size, or None if the image format is
+        not understood.
+    """
+
+    with open(imname, 'rb') as f:
+        head = f.read(26)
+
+        # PNG: the IHDR chunk is always first
+        if head[:8] == '\x89PNG\r\n\x1a\n':
+            width, height = struct.unpack('>II', head[16:24])
+            return height, width
+
+        # GIF
+        if head[:6] in ('GIF87a', 'GIF89a'):
+            width, height = struct.unpack('<HH', head[6:10])
+            return height, width
+
+        # BMP (height can be negative for top-down images)
+        if head[:2] == 'BM':
+            width, height = struct.unpack('<ii', head[18:26])
+            return abs(height), width
+
+        # JPEG: find the start of frame segment
+        if head[:2] == '\xff\xd8':
+            f.seek(2)
+            while True:
+                marker = f.read(2)
+                if (len(marker) < 2) or (marker[0] != '\xff'):
+                    return None
+                if marker[1] in ('\xd8', '\x01') or \
+                        ('\xd0' <= marker[1] <= '\xd7'):
+                    continue # Stand-alone markers
+                seglen = struct.unpack('>H', f.read(2))[0]
+                if ('\xc0' <= marker[1] <= '\xcf') and \
+                        (marker[1] not in ('\xc4', '\xc8', '\xcc')):
+                    height, width = struct.unpack('>xHH', f.read(5))
+                    return height, width
+                f.seek(seglen - 2, 1)
+
+    return None
+
+
+def open_windows (image):
+    """ Open an image for reading in windows (tiles), see ImageWindows.
+
+    Arguments:
+        image: the image to read, either
+            - a string of the name of a ".npy" file, which is memory mapped,
+            - a string of the name of any image that rasterio (GDAL) can read,
+              e.g. a (tiled) GeoTIFF, if rasterio is installed,
+            - a string of the name of any other image, which is read whole
+              with OpenCV (so this saves no memory),
+            - an array (height, width[, channels]) of an image (in memory, or a
+              memory map).
+
+    Returns:
+        an ImageWindows object.
+    """
+
+    if not isinstance(image, basestring):
+        return ImageWindows(image)
+
+    if image.lower().endswith('.npy'):
+        return ImageWindows(np.load(image, mmap_mode='r'))
+
+    try:
+        import rasterio
+    except ImportError:
+        return ImageWindows(imread_resize(image))
+
+    return ImageWindows(rasterio.open(image))
+
+
+class ImageWindows ():
+    """ Read windows (tiles) of an image without (necessarily) decoding all of
+        it, see open_windows().
+
+    Arguments:
+        source: an array (height, width[, channels]) of an image, or an open
+            rasterio dataset.
+
+    Attributes:
+        shape: tuple (height, width) of the whole image.
+    """
+
+    def __init__ (self, source):
+
+        self.source = source
+        if isinstance(source, np.ndarray):
+            self.shape = source.shape[:2]
+        else:
+            self.shape = (source.height, source.width)
+
+
+    def read (self, r0, r1, c0, c1):
+        """ Read a window of the image.
+
+        Arguments:
+            r0, r1: int, the first and one-past-last rows of the window.
+            c0, c1: int, the first and one-past-last columns of the window.
+
+        Returns:
+            image: (r1-r0, c1-c0[, channels]) np.array of the window.
+        """
+
+        if isinstance(self.source, np.ndarray):
+            return np.array(self.source[r0:r1, c0:c1])
+
+        win = self.source.read(window=((r0, r1), (c0, c1)))
+        if win.shape[0] == 1:
+            return win[0]
+        return np.ascontiguousarray(win[:3].transpose(1, 2, 0))
+
+
+    def close (self):
+        """ Close the image (if it is an open file). """
+
+        if hasattr(self.source, 'close'):
+            self.source.close()
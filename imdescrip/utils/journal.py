@@ -0,0 +1,139 @@
+# Imdescrip -- a collection of tools to extract descriptors from images.
+# Copyright (C) 2013 Daniel M. Steinberg (daniel.m.steinberg@gmail.com)
+#
+# This file is part of Imdescrip.
+#
+# Imdescrip is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Imdescrip is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Imdescrip. If not, see <http://www.gnu.org/licenses/>.
+
+""" Structured (JSON lines) error journals.
+
+    Each process writes to its own journal file, so there is no contention
+    between workers (and no interleaved lines) when many processes are
+    reporting errors. The per-process journals are merged into one journal
+    at the end of a run with merge_journals().
+
+    Each line of a journal is a JSON object like:
+
+        {"file": "/path/im.jpg", "type": "IOError", "error": "...",
+         "pid": 1234, "time": 1360000000.0, ...}
+
+"""
+
+import os, glob, json, time
+
+
+JOURNAL = 'errors.log'
+
+
+class Journal ():
+    """ An append-only JSON lines journal of errors.
+
+    Arguments:
+        path: str, the journal file name. Use worker_journal() to make a
+            journal for one process in a directory.
+
+    """
+
+    def __init__ (self, path):
+
+        self.path = path
+
+
+    def write (self, imfile, error, **info):
+        """ Write an error to this journal.
+
+        Arguments:
+            imfile: str, the name of the image (or other item) that failed.
+            error: Exception or str, the error.
+            info: any other (JSON-able) information to record, e.g. the number
+                of attempts.
+
+        """
+
+        entry = {
+            'file': imfile,
+            'type': error.__class__.__name__ if isinstance(error, Exception)
+                    else 'Error',
+            'error': str(error),
+            'pid': os.getpid(),
+            'time': time.time()
+            }
+        entry.update(info)
+
+        # Open per entry, errors are rare and workers may be killed at any time
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry, sort_keys=True) + '\n')
+
+
+def worker_journal (savedir):
+    """ Make a journal for this process in a directory.
+
+    Arguments:
+        savedir: str, the directory of the journal.
+
+    Returns:
+        a Journal object, writing to "errors-<pid>.log" in savedir.
+
+    """
+
+    return Journal(os.path.join(savedir, 'errors-{0}.log'.format(os.getpid())))
+
+
+def merge_journals (savedir):
+    """ Merge all of the per-process journals in a directory into one.
+
+    The per-process journals ("errors-<pid>.log") are appended to the
+    "errors.log" journal in savedir, and are then deleted.
+
+    Arguments:
+        savedir: str, the directory of the journals.
+
+    Returns:
+        int, the number of errors that were merged.
+
+    """
+
+    nerrors = 0
+    journals = sorted(glob.glob(os.path.join(savedir, 'errors-*.log')))
+    if len(journals) == 0:
+        return nerrors
+
+    with open(os.path.join(savedir, JOURNAL), 'a') as out:
+        for jfile in journals:
+            with open(jfile, 'r') as f:
+                for line in f:
+                    if line.strip() != '':
+                        out.write(line)
+                        nerrors += 1
+            os.remove(jfile)
+
+    return nerrors
+
+
+def read_journal (path):
+    """ Read all of the entries of a journal.
+
+    Arguments:
+        path: str, the journal file name.
+
+    Returns:
+        list, of dicts of each journal entry.
+
+    """
+
+    if not os.path.exists(path):
+        return []
+
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip() != '']
@@ -0,0 +1,165 @@
+# Imdescrip -- a collection of tools to extract descriptors from images.
+# Copyright (C) 2013 Daniel M. Steinberg (daniel.m.steinberg@gmail.com)
+#
+# This file is part of Imdescrip.
+#
+# Imdescrip is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Imdescrip is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Imdescrip. If not, see <http://www.gnu.org/licenses/>.
+
+""" Process memory measurement utilities.
+
+    These read the resident set size (RSS) of this process from /proc on
+    Linux, and fall back to the resource module (peak RSS only) elsewhere.
+
+"""
+
+import re, heapq
+
+
+__UNITS = {'': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+
+
+def parse_size (size):
+    """ Parse a memory size, e.g. 1024, '512M' or '16G', into bytes.
+
+    Arguments:
+        size: int (bytes) or str, a number with an optional K, M, G or T
+            (binary) suffix.
+
+    Returns:
+        int, the number of bytes.
+
+    """
+
+    if isinstance(size, (int, long, float)):
+        return int(size)
+
+    match = re.match(r'^\s*([0-9.]+)\s*([KMGT]?)i?B?\s*$', size.upper())
+    if match is None:
+        raise ValueError('Cannot understand memory size {0}!'.format(size))
+
+    return int(float(match.group(1)) * __UNITS[match.group(2)])
+
+
+def current_rss ():
+    """ Get the current resident set size (bytes) of this process, or None. """
+
+    return __proc_status('VmRSS')
+
+
+def peak_rss ():
+    """ Get the peak resident set size (bytes) of this process.
+
+    This is the peak since the process started, or since the last successful
+    call to reset_peak_rss().
+    """
+
+    peak = __proc_status('VmHWM')
+    if peak is not None:
+        return peak
+
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except ImportError:
+        return None
+
+
+def reset_peak_rss ():
+    """ Reset the peak resident set size of this process (Linux only).
+
+    Returns:
+        bool, True if the peak was reset, so peak_rss() will only measure from
+        now.
+    """
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+class MemoryStats ():
+    """ Aggregate per-item (e.g. per-image) peak memory measurements.
+
+    This keeps running totals and the largest few items (the outliers), so it
+    uses constant memory however many items are added.
+
+    Arguments:
+        noutliers: int (default 10), the number of largest items to keep.
+
+    """
+
+    def __init__ (self, noutliers=10):
+
+        self.noutliers = noutliers
+        self.count = 0
+        self.total = 0
+        self.maximum = 0
+        self.ratios = 0.    # Sum of peak/estimate ratios
+        self.nratios = 0
+        self.outliers = []  # Heap of (peak, name, estimate)
+
+
+    def add (self, name, peak, estimate=None):
+        """ Add the peak memory (bytes) of an item, and its estimate. """
+
+        if peak is None:
+            return
+
+        self.count += 1
+        self.total += peak
+        self.maximum = max(self.maximum, peak)
+        if (estimate is not None) and (estimate > 0):
+            self.ratios += float(peak) / estimate
+            self.nratios += 1
+
+        if len(self.outliers) < self.noutliers:
+            heapq.heappush(self.outliers, (peak, name, estimate))
+        else:
+            heapq.heappushpop(self.outliers, (peak, name, estimate))
+
+
+    def summary (self):
+        """ Get a (JSON-able) summary of the measurements.
+
+        Returns:
+            dict, with the count, maximum and mean peak bytes, the mean ratio of
+            the peaks to their estimates, and the largest items.
+
+        """
+
+        return {
+            'count': self.count,
+            'peak_max': self.maximum,
+            'peak_mean': float(self.total) / self.count if self.count else 0.,
+            'peak_to_estimate': self.ratios / self.nratios if self.nratios
+                                else None,
+            'outliers': [{'name': n, 'peak': p, 'estimate': e} for p, n, e
+                         in sorted(self.outliers, reverse=True)]
+            }
+
+
+def __proc_status (field):
+    """ Read a memory field (in bytes) from /proc/self/status, or None. """
+
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024 # kB
+    except (IOError, OSError):
+        pass
+    return None
@@ -0,0 +1,295 @@
+# Imdescrip -- a collection of tools to extract descriptors from images.
+# Copyright (C) 2013 Daniel M. Steinberg (daniel.m.steinberg@gmail.com)
+#
+# This file is part of Imdescrip.
+#
+# Imdescrip is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Imdescrip is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Imdescrip. If not, see <http://www.gnu.org/licenses/>.
+
+""" Opt-in peak memory profiling of the stages of extraction and learning.
+
+    The code of the descriptors and extractors marks its stages (e.g.
+    "decode", "sift", "encode", "pool", "project" and "serialise") with
+
+        with memprofile.stage('sift'):
+            ...
+
+    which does nothing unless profiling has been enabled in the process with
+    enable(). Then each stage records the peak memory allocated above what was
+    allocated when it started, and the change in the resident set size (RSS)
+    of the process. Stages inside an image (see image()) are recorded per
+    image, and summarised over all of the images, with the images that needed
+    the most memory (the outliers). Stages outside of an image (e.g. learning
+    a dictionary) are summarised for the whole run.
+
+    Allocations are measured with tracemalloc if it is available and can
+    reset its peak (Python 3.9+, numpy arrays are traced), otherwise with the
+    peak RSS of the process (reset per stage on Linux, see utils.memory).
+
+"""
+
+import contextlib
+from memory import current_rss, peak_rss, reset_peak_rss, MemoryStats
+
+
+class StageProfiler ():
+    """ Peak memory of the stages of each image, and of a whole run.
+
+    The way this class is typically used is (through the module functions)
+
+        prof = memprofile.enable()
+        for imfile in images:
+            with memprofile.image(imfile):
+                descobj.extract(imfile) # Which has memprofile.stage()s
+        report = prof.summary()
+
+    Arguments:
+        noutliers: int (default 10), the number of images with the largest
+            peaks to keep, for each stage and for the whole image.
+
+    """
+
+    def __init__ (self, noutliers=10):
+
+        self.noutliers = noutliers
+        self.tracemalloc = None
+        try:
+            import tracemalloc
+            if hasattr(tracemalloc, 'reset_peak'):
+                if tracemalloc.is_tracing() == False:
+                    tracemalloc.start()
+                self.tracemalloc = tracemalloc
+        except ImportError:
+            pass
+
+        self.stages = {}    # stage -> [MemoryStats of peaks, rss deltas]
+        self.images = MemoryStats(noutliers)
+        self.run = {}       # stage -> record, for stages outside of images
+        self.current = None # The stage records of the current image
+        self.stack = []     # The stages being measured
+        self.peakrss = 0    # Peak RSS of the current image, see image()
+
+
+    @contextlib.contextmanager
+    def stage (self, name):
+        """ Measure the memory of a stage (a context manager).
+
+        Stages can be nested, the peak of a stage includes those of the stages
+        inside it. A stage repeated in an image (or run) keeps the largest
+        peak, and the total RSS change.
+
+        Arguments:
+            name: str, the name of the stage.
+
+        """
+
+        # The (absolute) peak so far of the stage this one is inside
+        if len(self.stack) > 0:
+            self.stack[-1][2] = max(self.stack[-1][2], self.__peak())
+
+        start = [self.__allocated(), current_rss(), 0]
+        self.__reset()
+        self.stack.append(start)
+        try:
+            yield
+        finally:
+            self.stack.pop()
+            peak = max(self.__peak(), start[2])
+            if len(self.stack) > 0:
+                self.stack[-1][2] = max(self.stack[-1][2], peak)
+            if self.tracemalloc is None:
+                self.peakrss = max(self.peakrss, peak)
+
+            rss = current_rss()
+            record = {
+                'peak': max(0, peak - start[0]),
+                'rss_delta': rss - start[1] if None not in (rss, start[1])
+                             else None
+                }
+
+            records = self.run if self.current is None else self.current
+            if name in records:
+                record['peak'] = max(record['peak'], records[name]['peak'])
+                if record['rss_delta'] is not None:
+                    record['rss_delta'] += records[name]['rss_delta'] or 0
+            records[name] = record
+
+
+    @contextlib.contextmanager
+    def image (self, name):
+        """ Measure the stages of an image (a context manager).
+
+        Arguments:
+            name: str, the name of the image.
+
+        Yields:
+            dict, of {stage: {'peak': bytes, 'rss_delta': bytes}}, which is
+                filled in when the image is finished.
+
+        Note:
+            Measuring the peak RSS of each stage resets the peak RSS of the
+            process (see utils.memory.reset_peak_rss()), so without
+            tracemalloc the peak RSS of the whole image is kept in peakrss.
+
+        """
+
+        records = {}
+        self.current = records
+        self.peakrss = 0
+        try:
+            yield records
+        finally:
+            self.current = None
+            self.add(name, records)
+
+
+    def add (self, name, records):
+        """ Add the stage records of an image, e.g. from another process.
+
+        Arguments:
+            name: str, the name of the image.
+            records: dict, of stage records, see image().
+
+        """
+
+        if len(records) == 0:
+            return
+
+        for stage, record in records.items():
+            if stage not in self.stages:
+                self.stages[stage] = [MemoryStats(self.noutliers),
+                                      MemoryStats(0)]
+            self.stages[stage][0].add(name, record['peak'])
+            self.stages[stage][1].add(name, record['rss_delta'])
+
+        self.images.add(name, max(r['peak'] for r in records.values()))
+
+
+    def summary (self):
+        """ Get a (JSON-able) summary of the measurements.
+
+        Returns:
+            dict, with the method ('tracemalloc' or 'rss'), the peaks of each
+            stage over all images (see utils.memory.MemoryStats), with their
+            mean and largest RSS changes, the largest stage peak of each image
+            ('images'), and the stages outside of images ('run').
+
+        """
+
+        stages = {}
+        for stage, (peaks, deltas) in self.stages.items():
+            rss = deltas.summary()
+            stages[stage] = dict(peaks.summary(), rss_delta_max=rss['peak_max'],
+                                 rss_delta_mean=rss['peak_mean'])
+            stages[stage].pop('peak_to_estimate')
+
+        images = self.images.summary()
+        images.pop('peak_to_estimate')
+        return {
+            'method': self.method(),
+            'stages': stages,
+            'images': images,
+            'run': self.run
+            }
+
+
+    def method (self):
+        """ How allocations are measured, 'tracemalloc' or 'rss'. """
+
+        return 'rss' if self.tracemalloc is None else 'tracemalloc'
+
+
+    def __allocated (self):
+
+        if self.tracemalloc is None:
+            return current_rss() or 0
+        return self.tracemalloc.get_traced_memory()[0]
+
+
+    def __peak (self):
+
+        if self.tracemalloc is None:
+            return peak_rss() or 0
+        return self.tracemalloc.get_traced_memory()[1]
+
+
+    def __reset (self):
+
+        if self.tracemalloc is None:
+            reset_peak_rss()
+        else:
+            self.tracemalloc.reset_peak()
+
+
+class NullContext ():
+    """ A context manager that does nothing, for when profiling is off. """
+
+    def __enter__ (self):
+        return {}
+
+    def __exit__ (self, *exc):
+        return False
+
+
+# The profiler of this process, see enable()
+__state = {'profiler': None, 'null': NullContext()}
+
+
+def enable (noutliers=10):
+    """ Enable memory profiling in this process.
+
+    Arguments:
+        noutliers: int (default 10), see StageProfiler.
+
+    Returns:
+        the (new) StageProfiler, which records all of the stages in this
+        process until disable() is called.
+
+    """
+
+    __state['profiler'] = StageProfiler(noutliers)
+    return __state['profiler']
+
+
+def disable ():
+    """ Disable memory profiling in this process.
+
+    Returns:
+        the StageProfiler that was recording, or None.
+
+    """
+
+    profiler, __state['profiler'] = __state['profiler'], None
+    return profiler
+
+
+def active ():
+    """ Get the StageProfiler of this process, or None if profiling is off. """
+
+    return __state['profiler']
+
+
+def stage (name):
+    """ Measure a stage if profiling is on, see StageProfiler.stage(). """
+
+    if __state['profiler'] is None:
+        return __state['null']
+    return __state['profiler'].stage(name)
+
+
+def image (name):
+    """ Measure an image if profiling is on, see StageProfiler.image(). """
+
+    if __state['profiler'] is None:
+        return __state['null']
+    return __state['profiler'].image(name)
@@ -0,0 +1,202 @@
+# Imdescrip -- a collection of tools to extract descriptors from images.
+# Copyright (C) 2013 Daniel M. Steinberg (daniel.m.steinberg@gmail.com)
+#
+# This file is part of Imdescrip.
+#
+# Imdescrip is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Imdescrip is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Imdescrip. If not, see <http://www.gnu.org/licenses/>.
+
+""" Versioned, memory-mappable model files.
+
+    A model is saved as a directory with a small JSON header (header.json) and
+    one raw numpy (.npy) file per array. The header holds the format version,
+    the model class name, its (JSON-able) parameters and the shape, type and
+    md5 hash of each array. The arrays can be loaded with np.load(...,
+    mmap_mode='r'), so many processes on a machine can share a single page
+    cached copy of e.g. a dictionary, and loading is almost instant.
+
+    The array files are named by their contents (hash), and are never written
+    over. So a model can be saved back to the directory it was (memory mapped)
+    from, while it, or other processes, are reading it. The header is written
+    last, and atomically, it is what switches the directory to the new model.
+
+    The layout of a model directory is:
+
+        model/
+            header.json
+            dic-<md5>.npy
+            rmat-<md5>.npy
+            ...
+
+"""
+
+import os, json
+import numpy as np
+from hashlib import md5
+
+
+FORMAT_NAME = 'imdescrip-model'
+FORMAT_VERSION = 1
+HEADER = 'header.json'
+
+
+def array_hash (array):
+    """ Get the md5 hash (hex string) of an array's data.
+
+    Arguments:
+        array: np.array, C or Fortran ordered arrays are hashed in their memory
+            order, other arrays are made contiguous first.
+
+    Returns:
+        string md5 hash.
+
+    """
+
+    if array.flags.c_contiguous == False:
+        if array.flags.f_contiguous == True:
+            array = array.T # Same memory, C ordered view
+        else:
+            array = np.ascontiguousarray(array)
+
+    code = md5()
+    code.update(array)
+    return code.hexdigest()
+
+
+def save_model (path, name, params, arrays):
+    """ Save a model's parameters and arrays to a model directory.
+
+    Arguments:
+        path: str, the model directory to create (or overwrite). The arrays
+            of a model it already has are removed once the new one is saved.
+        name: str, the name of the model class, e.g. 'ScSPM'.
+        params: dict, the model parameters, this must be JSON serialisable.
+        arrays: dict, of {name: np.array} to save. Arrays that are None are not
+            saved.
+
+    """
+
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    header = {
+        'format': FORMAT_NAME,
+        'version': FORMAT_VERSION,
+        'class': name,
+        'params': params,
+        'arrays': {}
+        }
+
+    for aname, array in arrays.items():
+        if array is None:
+            continue
+
+        # An array that is already saved (e.g. the one this model was memory
+        # mapped from) is not written again
+        ahash = array_hash(array)
+        afile = '{0}-{1}.npy'.format(aname, ahash)
+        apath = os.path.join(path, afile)
+        if __is_saved(apath, array) == False:
+            with open(apath + '.tmp', 'wb') as f:
+                np.save(f, array)
+            os.rename(apath + '.tmp', apath)
+
+        header['arrays'][aname] = {
+            'file': afile,
+            'shape': list(array.shape),
+            'dtype': str(array.dtype),
+            'md5': ahash
+            }
+
+    # Write the header last, and atomically, so it marks a complete model
+    hfile = os.path.join(path, HEADER)
+    with open(hfile + '.tmp', 'w') as f:
+        json.dump(header, f, indent=2, sort_keys=True)
+    os.rename(hfile + '.tmp', hfile)
+
+    # Remove the arrays of the model this one replaced. Processes that have
+    # them memory mapped keep reading them until they are closed.
+    keep = set(a['file'] for a in header['arrays'].values())
+    for afile in os.listdir(path):
+        if afile.endswith(('.npy', '.npy.tmp')) and (afile not in keep):
+            os.remove(os.path.join(path, afile))
+
+
+def read_header (path):
+    """ Read and check the header of a model directory.
+
+    Arguments:
+        path: str, the model directory.
+
+    Returns:
+        dict, the model header.
+
+    """
+
+    hfile = os.path.join(path, HEADER)
+    if not os.path.exists(hfile):
+        raise IOError('{0} is not a model directory!'.format(path))
+
+    with open(hfile, 'r') as f:
+        header = json.load(f)
+
+    if header.get('format') != FORMAT_NAME:
+        raise ValueError('{0} is not an imdescrip model!'.format(path))
+    if header['version'] > FORMAT_VERSION:
+        raise ValueError('Model format version {0} is newer than this version'
+                         ' of imdescrip can read ({1})!'
+                         .format(header['version'], FORMAT_VERSION))
+
+    return header
+
+
+def load_model (path, mmap=True, verify=False):
+    """ Load a model's header and arrays from a model directory.
+
+    Arguments:
+        path: str, the model directory.
+        mmap: bool (default True), memory map the arrays (read only) instead of
+            reading them into memory.
+        verify: bool (default False), check the md5 hashes of the arrays. This
+            reads all of the arrays from disk, so it negates the speed of
+            memory mapping for the first load.
+
+    Returns:
+        dict, the model header.
+        dict, of {name: np.array} of all of the arrays in the model.
+
+    """
+
+    header = read_header(path)
+    arrays = {}
+
+    for aname, ainfo in header['arrays'].items():
+        arrays[aname] = np.load(os.path.join(path, ainfo['file']),
+                                mmap_mode='r' if mmap == True else None)
+
+        if (verify == True) and (array_hash(arrays[aname]) != ainfo['md5']):
+            raise ValueError('Array {0} in model {1} is corrupt!'
+                             .format(aname, path))
+
+    return header, arrays
+
+
+def __is_saved (apath, array):
+    """ Is an array already saved (the same data and layout) in a file? """
+
+    if not os.path.exists(apath):
+        return False
+
+    saved = np.load(apath, mmap_mode='r')
+    return (saved.shape == array.shape) and (saved.dtype == array.dtype) and \
+           (saved.flags.f_contiguous == array.flags.f_contiguous)
@@ -34,16 +34,9 @@
 
 import math
 import numpy as np 
-from scipy.misc import toimage
 from image import imread_resize, rgb2gray
 from progress import Progress
-
-# Optional imports
-try: 
-    from matplotlib import pyplot as plt
-    hasmatplotlib = True
-except:
-    hasmatplotlib = False
+from shards import image_sources
 
 
 def grid_patches (image, psize, pstride):
@@ -110,6 +103,7 @@ def training_patches (imnames, npatches, psize, maxdim=None, colour=False,
 
     Arguments:
         imnames: A list of image names from which to extract training patches.
+            These can also be shards (archives) of images, see utils.shards.
         npatches: The number (int) of patches to extract from the images
         maxdim: The maximum dimension of the image in pixels. The image is
             rescaled if it is larger than this. By default there is no scaling. 
@@ -123,6 +117,7 @@ def training_patches (imnames, npatches, psize, maxdim=None, colour=False,
 
     """
 
+    imnames = image_sources(imnames, maxdim)
     nimg = len(imnames)
     ppeimg = int(round(float(npatches)/nimg))
     plist = []
@@ -212,7 +207,7 @@ def p_max (patches):
 
 
 def pyramid_pooling (patches, centresx, centresy, imsize, levels=(1,2,4), 
-        pfun=p_max):
+        pfun=p_max, bins=None, out=None):
     """ Spatial pyramid pooling of image patches (or codes of image patches)
 
     This funtion implements spatial pyramid pooling, which essentially turns a
@@ -234,6 +229,12 @@ def pyramid_pooling (patches, centresx, centresy, imsize, levels=(1,2,4),
             pooling regions. See [1] for more details.
         pfun: is the name of the pooling function to use. p_maxabs() implements
             the max abs pooling described in [1].
+        bins: an optional (len(levels), npatches) array of the pyramid bins of
+            the patches from pyramid_bins(). Pass this in if pooling many
+            images of the same size (e.g. video frames), it is computed from
+            the patch centres otherwise.
+        out: an optional (ndims * array(levels)**2,) array to write the result
+            into, otherwise a new array is allocated.
 
     Returns:
         A (1, ndims * array(levels)**2) array of all of the pooled patches/codes
@@ -243,14 +244,49 @@ def pyramid_pooling (patches, centresx, centresy, imsize, levels=(1,2,4),
 
     # Get the number of bins in the pyramid
     Dbins = patches.shape[1]        # Dimensionality of the pyramid bins
-    lbins = np.array(levels) ** 2   # Number of bins on each pyramid level
-    tbins = lbins.sum()             # Total number of pyramid bins
+    tbins = (np.array(levels) ** 2).sum() # Total number of pyramid bins
 
     # pre-allocate 
-    poolpatches = np.zeros((tbins, Dbins))
-    cnt = 0
+    if out is None:
+        out = np.zeros(tbins * Dbins)
+    else:
+        out.fill(0)
+    poolpatches = out.reshape((tbins, Dbins))
+
+    if bins is None:
+        bins = pyramid_bins(centresx, centresy, imsize, levels)
 
     # Pyramid pooling
+    for binidx in bins:
+        for j in np.unique(binidx):
+            poolpatches[j,:] = pfun(patches[binidx == j,:])
+
+    return out 
+
+
+def pyramid_bins (centresx, centresy, imsize, levels=(1,2,4)):
+    """ Find which spatial pyramid bins image patches belong to.
+
+    Arguments:
+        centresx: an (npatches, 1) array of the x, or row, centre locations of 
+            the image patches.
+        centresy: an (npatches, 1) array of the y, or col, centre locations of 
+            the image patches.
+        imsize: a tuple (rows, cols) of the size of the original image that the
+            patches were extracted from.
+        levels: A tuple of ints that defines the spatial pyramid pooling levels,
+            see pyramid_pooling().
+
+    Returns:
+        A (len(levels), npatches) int array of the bin of each patch in each
+        level. Bins are numbered consecutively over all levels, i.e. the
+        first bin of level 2 is levels[0]**2.
+
+    """
+
+    bins = np.zeros((len(levels), len(centresx)), int)
+    offset = 0
+
     for (i, lev) in enumerate(levels):
 
         # Bin width/height
@@ -258,16 +294,231 @@ def pyramid_pooling (patches, centresx, centresy, imsize, levels=(1,2,4),
         hunit = float(imsize[0]) / lev
 
         # Find patch-bin memberships
-        binidx = np.floor(centresy / hunit) * lev + np.floor(centresx / wunit)
+        bins[i] = offset + np.floor(centresy / hunit) * lev \
+                    + np.floor(centresx / wunit)
+        offset += lev**2
+
+    return bins
+
+
+class PyramidPool ():
+    """ Incremental spatial pyramid (max) pooling.
+
+    This accumulates the same result as pyramid_pooling(), but the patches (or
+    patch codes) can be given in any number of batches, e.g. from tiles of an
+    image. Only max type pooling functions (p_max and p_maxabs) can be
+    accumulated like this.
+
+    The way this class is typically used is
+
+        pool = PyramidPool(ndims, imsize, levels)
+        for patches, centresx, centresy in batches:
+            pool.update(patches, centresx, centresy)
+        descriptor = pool.result()
+
+    Arguments:
+        ndims: int, the dimensionality of the patches/codes.
+        imsize: a tuple (rows, cols) of the size of the whole image.
+        levels: A tuple of ints that defines the spatial pyramid pooling levels,
+            see pyramid_pooling().
+        pfun: the pooling function, p_max (default) or p_maxabs.
+
+    """
+
+    def __init__ (self, ndims, imsize, levels=(1,2,4), pfun=p_max):
+
+        if pfun not in (p_max, p_maxabs):
+            raise ValueError('Only max pooling can be done incrementally!')
+
+        self.imsize = imsize
+        self.levels = levels
+        self.pfun = pfun
+
+        # Empty bins are marked with -inf, they are zero in the result
+        tbins = (np.array(levels) ** 2).sum()
+        self.pooled = np.empty((tbins, ndims))
+        self.pooled.fill(-np.inf)
+
+
+    def update (self, patches, centresx, centresy):
+        """ Pool another batch of patches (or patch codes).
+
+        Arguments:
+            patches: an (npatches, ndims) array of image patches, or codes of
+                image patches.
+            centresx: an (npatches, 1) array of the x, or row, centre locations
+                of the image patches (in whole image coordinates).
+            centresy: an (npatches, 1) array of the y, or col, centre locations
+                of the image patches (in whole image coordinates).
+
+        """
+
+        if len(patches) == 0:
+            return
+
+        for binidx in pyramid_bins(centresx, centresy, self.imsize, 
+                                   self.levels):
+            for j in np.unique(binidx):
+                self.pooled[j,:] = np.maximum(self.pooled[j,:], 
+                                        self.pfun(patches[binidx == j,:]))
+
+
+    def result (self):
+        """ Get the pooled descriptor, the same as from pyramid_pooling(). """
+
+        result = self.pooled.copy()
+        result[np.isneginf(result)] = 0
+        return result.flatten()
+
+
+class WindowPool ():
+    """ Spatial pyramid pooling of many sub-windows of one image's codes.
+
+    This gives the same result as pyramid_pooling() of the patches (codes)
+    with centres inside each window, with the pyramid over the window, for
+    any number of windows (e.g. sliding windows or region proposals). The
+    patches must be on a regular grid (like dense SIFT patches), and a
+    structure of block maxima (or, for p_mean, an integral image) of them is
+    built once, so each bin of a window is pooled from a few precomputed
+    blocks instead of all of its patches.
+
+    The block maxima are a sparse table of square blocks: the maxima of every
+    (2^k x 2^k) block of grid cells, for each k up to the smaller side of the
+    grid. This is a few times the size of the patches, and a rectangular bin
+    is covered by (2^k x 2^k) blocks, where 2^k is at least half of its
+    shorter side, so pooling it costs a few lookups of ndims.
+
+    The way this class is typically used is
+
+        pool = WindowPool(codes, centresx, centresy)
+        for box in boxes:
+            descriptor = pool.pool(box, levels)
+
+    Arguments:
+        patches: an (npatches, ndims) array of image patches, or codes of image
+            patches, on a regular grid.
+        centresx: an (npatches, 1) array of the x (column) centre locations of
+            the image patches.
+        centresy: an (npatches, 1) array of the y (row) centre locations of the
+            image patches.
+        pfun: the pooling function, p_max (default), p_maxabs or p_mean.
+
+    """
+
+    def __init__ (self, patches, centresx, centresy, pfun=p_max):
+
+        if pfun not in (p_max, p_maxabs, p_mean):
+            raise ValueError('Unknown pooling function!')
+
+        self.pfun = pfun
+        self.ux = np.unique(centresx)
+        self.uy = np.unique(centresy)
+        rows = np.searchsorted(self.uy, centresy)
+        cols = np.searchsorted(self.ux, centresx)
+        R, C, D = len(self.uy), len(self.ux), patches.shape[1]
+
+        if pfun == p_mean:
+
+            # Integral images of the patches and of the patch counts
+            self.sums = np.zeros((R + 1, C + 1, D))
+            self.sums[rows + 1, cols + 1] = patches
+            self.counts = np.zeros((R + 1, C + 1))
+            self.counts[rows + 1, cols + 1] = 1
+            for a in (self.sums, self.counts):
+                np.cumsum(a, axis=0, out=a)
+                np.cumsum(a, axis=1, out=a)
+            return
+
+        # Block maxima, missing grid cells are -inf (and empty bins are 0)
+        grid = np.empty((R, C, D))
+        grid.fill(-np.inf)
+        grid[rows, cols] = np.abs(patches) if pfun == p_maxabs else patches
+        self.missing = len(patches) < R * C
+        self.blocks = [grid]
+        k = 1
+        while 2**k <= min(R, C):
+            h, last = 2**(k - 1), self.blocks[-1]
+            self.blocks.append(np.maximum(
+                np.maximum(last[:-h, :-h], last[h:, :-h]),
+                np.maximum(last[:-h, h:], last[h:, h:])))
+            k += 1
+
+
+    def pool (self, box, levels=(1,2,4), out=None):
+        """ Pyramid pool the patches (codes) in a window.
+
+        Arguments:
+            box: (x0, y0, x1, y1) the window, patches with x0 <= centresx < x1
+                and y0 <= centresy < y1 are in it.
+            levels: A tuple of ints that defines the spatial pyramid pooling
+                levels (over the window), see pyramid_pooling().
+            out: an optional (ndims * array(levels)**2,) array to write the
+                result into, otherwise a new array is allocated.
+
+        Returns:
+            A (ndims * array(levels)**2,) array of the pooled patches/codes of
+            the window, the same as pyramid_pooling() of them.
+
+        """
+
+        x0, y0, x1, y1 = box
+        D = (self.sums if self.pfun == p_mean else self.blocks[0]).shape[2]
+        tbins = (np.array(levels) ** 2).sum()
+        if out is None:
+            out = np.zeros(tbins * D)
+        poolpatches = out.reshape((tbins, D))
+
+        offset = 0
+        for lev in levels:
+            rbins = self.__bin_ranges(self.uy, y0, y1, lev)
+            cbins = self.__bin_ranges(self.ux, x0, x1, lev)
+            for i, (r0, r1) in enumerate(rbins):
+                for j, (c0, c1) in enumerate(cbins):
+                    self.__pool_block(r0, r1, c0, c1, 
+                                      poolpatches[offset + i * lev + j])
+            offset += lev**2
+
+        return out
+
+
+    def __bin_ranges (self, centres, lo, hi, lev):
+        """ The [start, stop) grid indices of the patches in each bin of a
+            level, binned like pyramid_bins().
+        """
+
+        start, stop = np.searchsorted(centres, [lo, hi])
+        binidx = np.floor((centres[start:stop] - lo) / (float(hi - lo) / lev))
+        binidx = np.minimum(binidx, lev - 1)
+        edges = start + np.searchsorted(binidx, np.arange(lev + 1) - 0.5)
+        return [(int(a), int(b)) for a, b in zip(edges[:-1], edges[1:])]
 
-        # Bin the patches
-        for j in range(lbins[i]):
-            pidx = np.nonzero(binidx == j)[0]
-            if len(pidx) > 0:
-                poolpatches[cnt,:] = pfun(patches[pidx,:])
-            cnt += 1
 
-    return poolpatches.flatten() 
+    def __pool_block (self, r0, r1, c0, c1, out):
+        """ Pool the grid cells [r0, r1) x [c0, c1) into out. """
+
+        if (r1 <= r0) or (c1 <= c0):
+            out.fill(0)
+            return
+
+        if self.pfun == p_mean:
+            S, N = self.sums, self.counts
+            n = N[r1, c1] - N[r0, c1] - N[r1, c0] + N[r0, c0]
+            if n < 0.5:
+                out.fill(0)
+            else:
+                out[:] = (S[r1, c1] - S[r0, c1] - S[r1, c0] + S[r0, c0]) / n
+            return
+
+        # Cover the cells with (possibly overlapping) square blocks
+        k = min(r1 - r0, c1 - c0).bit_length() - 1
+        size = 2**k
+        blocks = self.blocks[k]
+        out[:] = blocks[r0, c0]
+        for r in range(r0, r1 - size, size) + [r1 - size]:
+            for c in range(c0, c1 - size, size) + [c1 - size]:
+                np.maximum(out, blocks[r, c], out=out)
+        if self.missing == True:
+            out[np.isneginf(out)] = 0
 
 
 def norm_patches (patches, epsilon=1e-20):
@@ -304,43 +555,103 @@ def centre_patches (patches):
     return patches - np.mean(patches, axis=1).reshape(patches.shape[0],1)
 
 
-if hasmatplotlib == True:
-    def disp_patches (patches, colour=False):
-        """ Display flattened (square) patches in a grid.
-    
-        This function is best for displaying the bases of learned dictionaries.
-    
-        Arguments:
-            patches: (npatches, pixels) is a numpy np.array of all of the
-                flattened image patches in each row. These will automatically be
-                scalled to be displayed as images. It is assumed the original
-                patches are square
-            colour: boolean flag indicating whether or not these patches are
-                supposed to be colour or not.
-    
-        """
-    
-        # Argument checking
-        if (colour == False) and (math.sqrt(patches.shape[1])%1 != 0):
-            raise ValueError('Gray image has to have square patches')
-        elif (colour == True) and (math.sqrt(float(patches.shape[1])/3)%1 != 0):
-            raise ValueError('Colour image has to have square patches')
+def diverse_patches (patches, npatches, rstate=np.random):
+    """ Select a diverse subset of patches by k-means++ seeding.
+
+    The patches are chosen one at a time, with a probability proportional to
+    their squared distance from the closest patch already chosen (k-means++
+    seeding [2]). So near-duplicate patches (e.g. of sand or open water) are
+    unlikely to be chosen more than a few times.
+
+    Arguments:
+        patches: an (N, ndims) array of candidate patches (or descriptors).
+        npatches: int, the number of patches to select.
+        rstate: a numpy RandomState object (default is the numpy global one).
+
+    Returns:
+        an array of the (npatches,) indices of the selected patches. If N <=
+        npatches, all patches are selected.
+
+    References:
+        [2] Arthur, D. & Vassilvitskii, S. k-means++: The advantages of careful
+            seeding, Proceedings of the eighteenth annual ACM-SIAM symposium on
+            Discrete algorithms, 2007, 1027-1035
+
+    """
+
+    N = patches.shape[0]
+    if N <= npatches:
+        return np.arange(N)
+
+    X = np.asarray(patches, np.float64)
+    chosen = np.empty(npatches, int)
+    chosen[0] = rstate.randint(N)
+    dist = ((X - X[chosen[0]])**2).sum(axis=1)
+
+    for i in range(1, npatches):
+        cumdist = np.cumsum(dist)
+        if cumdist[-1] <= 0: # All remaining patches are duplicates
+            chosen[i:] = rstate.choice(np.setdiff1d(np.arange(N), chosen[:i]),
+                                       npatches - i, replace=False)
+            break
+
+        # The total is the last cumulative sum, so rounding can't overshoot
+        chosen[i] = min(N - 1, np.searchsorted(cumdist, rstate.rand()
+                                               * cumdist[-1], side='right'))
+        np.minimum(dist, ((X - X[chosen[i]])**2).sum(axis=1), out=dist)
+
+    return chosen
+
+
+def disp_patches (patches, colour=False):
+    """ Display flattened (square) patches in a grid.
+
+    This function is best for displaying the bases of learned dictionaries.
+
+    Arguments:
+        patches: (npatches, pixels) is a numpy np.array of all of the
+            flattened image patches in each row. These will automatically be
+            scalled to be displayed as images. It is assumed the original
+            patches are square
+        colour: boolean flag indicating whether or not these patches are
+            supposed to be colour or not.
+
+    Note:
+        matplotlib is an optional dependency, and is only imported when this
+        function is called.
+
+    """
+
+    # Argument checking
+    if (colour == False) and (math.sqrt(patches.shape[1])%1 != 0):
+        raise ValueError('Gray image has to have square patches')
+    elif (colour == True) and (math.sqrt(float(patches.shape[1])/3)%1 != 0):
+        raise ValueError('Colour image has to have square patches')
+
+    # Get patch size
+    if colour == False:
+        psize = math.sqrt(patches.shape[1])  
+    else: 
+        psize = math.sqrt(patches.shape[1]/3)
     
-        # Get patch size
+    ssize = math.ceil(math.sqrt(patches.shape[0]))
+
+    # Optional, heavy imports -- only loaded when something is displayed
+    try: 
+        from matplotlib import pyplot as plt
+    except ImportError:
+        raise ImportError('matplotlib is required to display patches!')
+
+    if colour == True:
+        from scipy.misc import toimage
+
+    # plot filters
+    plt.figure()
+    for i, p in enumerate(patches):
+        plt.subplot(ssize, ssize, i + 1)
         if colour == False:
-            psize = math.sqrt(patches.shape[1])  
-        else: 
-            psize = math.sqrt(patches.shape[1]/3)
-        
-        ssize = math.ceil(math.sqrt(patches.shape[0]))
-    
-        # plot filters
-        plt.figure()
-        for i, p in enumerate(patches):
-            plt.subplot(ssize, ssize, i + 1)
-            if colour == False:
-                plt.imshow(p.reshape(psize, psize), cmap="gray")
-            else:
-                plt.imshow(toimage(p.reshape(psize, psize, 3), mode='RGB'))
-            plt.axis("off")
-        plt.show()
+            plt.imshow(p.reshape(psize, psize), cmap="gray")
+        else:
+            plt.imshow(toimage(p.reshape(psize, psize, 3), mode='RGB'))
+        plt.axis("off")
+    plt.show()
@@ -0,0 +1,208 @@
+# Imdescrip -- a collection of tools to extract descriptors from images.
+# Copyright (C) 2013 Daniel M. Steinberg (daniel.m.steinberg@gmail.com)
+#
+# This file is part of Imdescrip.
+#
+# Imdescrip is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Imdescrip is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Imdescrip. If not, see <http://www.gnu.org/licenses/>.
+
+""" Cost-aware scheduling of images for parallel descriptor extraction.
+
+    Datasets that mix small and large images end with a long tail if work is
+    handed out in the given order, a few workers process big images while the
+    rest are idle. The Scheduler here orders images largest (most costly)
+    first, and hands them out in chunks that adapt to the observed throughput:
+    chunks aim to take a fixed amount of time, but shrink as the remaining work
+    runs out (guided self-scheduling), so all workers finish at about the same
+    time.
+
+    The cost of an image is estimated from its size (in pixels) from its
+    header, see image_cost().
+
+"""
+
+import os
+from collections import deque
+from image import imread_size
+
+
+def image_cost (imfile):
+    """ Estimate the cost of extracting a descriptor from an image.
+
+    The cost is the number of pixels in the image, read from its header. If
+    the header can't be read, it is estimated from the file size.
+
+    Arguments:
+        imfile: str, the image file name.
+
+    Returns:
+        float, the estimated cost (pixels) of the image, at least 1.
+
+    """
+
+    return image_info(imfile)[1]
+
+
+def image_info (imfile):
+    """ Get the size and estimated cost of an image, see image_cost().
+
+    Arguments:
+        imfile: str, the image file name.
+
+    Returns:
+        tuple (height, width) of the image, or None if it can't be read.
+        float, the estimated cost (pixels) of the image, at least 1.
+
+    """
+
+    try:
+        size = imread_size(imfile)
+        if size is not None:
+            return size, max(1., float(size[0] * size[1]))
+        return None, max(1., 5. * os.path.getsize(imfile)) # ~0.2 bytes/pixel
+    except (IOError, OSError):
+        return None, 1.
+
+
+class Scheduler ():
+    """ Largest-first scheduling of work items in adaptively sized chunks.
+
+    The way this class is typically used is
+
+        sched = Scheduler(costs, njobs)
+        while len(sched) > 0:
+            chunk = sched.next_chunk()
+            # hand out chunk, and for each item, once processed
+            sched.record(item, seconds)
+
+    Arguments:
+        costs: list, the (estimated) cost of each item.
+        njobs: int, the number of workers.
+        target: float (default 2.), the number of seconds each chunk should
+            take to process, once the throughput is known.
+        order: bool (default True), order the items largest cost first,
+            otherwise they are scheduled in the given order.
+
+    """
+
+    def __init__ (self, costs, njobs, target=2., order=True):
+
+        self.costs = costs
+        self.njobs = njobs
+        self.target = target
+        self.rate = None    # Cost per second per worker
+
+        items = range(len(costs))
+        if order == True:
+            items = sorted(items, key=lambda i: -costs[i])
+        self.queue = deque(items)
+        self.remaining = float(sum(costs))
+
+
+    def __len__ (self):
+
+        return len(self.queue)
+
+
+    def next_chunk (self):
+        """ Get the next chunk of items to process.
+
+        Until the throughput is known (see record()), chunks are one item.
+        Then chunks are as big as can be processed in self.target seconds, but
+        no more than 1/(2 * njobs) of the remaining work.
+
+        Returns:
+            list, of the item indices in the chunk (at least one item, unless
+            there are none left).
+
+        """
+
+        if len(self.queue) == 0:
+            return []
+
+        limit = 0.
+        if self.rate is not None:
+            limit = min(self.rate * self.target,
+                        self.remaining / (2 * self.njobs))
+
+        chunk = [self.queue.popleft()]
+        cost = self.costs[chunk[0]]
+        while (len(self.queue) > 0) and \
+                (cost + self.costs[self.queue[0]] <= limit):
+            chunk.append(self.queue.popleft())
+            cost += self.costs[chunk[-1]]
+
+        self.remaining -= cost
+        return chunk
+
+
+    def requeue (self, items, front=False):
+        """ Put items back into the queue, e.g. for retrying.
+
+        Arguments:
+            items: list, of item indices.
+            front: bool (default False), put the items at the front of the
+                queue, otherwise they go to the back.
+
+        """
+
+        if front == True:
+            self.queue.extendleft(reversed(items))
+        else:
+            self.queue.extend(items)
+        self.remaining += sum(self.costs[i] for i in items)
+
+
+    def record (self, item, seconds):
+        """ Record how long an item took to process, to update the throughput.
+
+        Arguments:
+            item: int, the item index.
+            seconds: float, the time taken to process the item.
+
+        """
+
+        if seconds <= 0:
+            return
+
+        rate = self.costs[item] / seconds
+        if self.rate is None:
+            self.rate = rate
+        else:
+            self.rate = 0.8 * self.rate + 0.2 * rate
+
+
+def load_balance (busy, wall, njobs):
+    """ Summarise how well work was balanced between workers.
+
+    Arguments:
+        busy: dict, of {worker: seconds busy}.
+        wall: float, the wall-clock time of the run.
+        njobs: int, the number of workers (concurrent).
+
+    Returns:
+        dict, with the total busy (CPU) time, the wall time, the ideal wall
+        time (busy / njobs), and the efficiency (ideal / wall, 1 is perfect).
+
+    """
+
+    total = float(sum(busy.values()))
+    ideal = total / njobs
+    return {
+        'njobs': njobs,
+        'busy_seconds': total,
+        'wall_seconds': wall,
+        'ideal_seconds': ideal,
+        'efficiency': ideal / wall if wall > 0 else 1.,
+        'worker_busy_seconds': dict((str(w), b) for w, b in busy.items())
+        }
@@ -0,0 +1,218 @@
+# Imdescrip -- a collection of tools to extract descriptors from images.
+# Copyright (C) 2013 Daniel M. Steinberg (daniel.m.steinberg@gmail.com)
+#
+# This file is part of Imdescrip.
+#
+# Imdescrip is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Imdescrip is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Imdescrip. If not, see <http://www.gnu.org/licenses/>.
+
+""" Reading images from sharded (tar or zip) archives.
+
+    Datasets of millions of small images are slow to list and open as loose
+    files on shared (network) storage, every image costs a few metadata
+    operations. Packing them into shards -- tar or zip archives of a few
+    thousand images each -- means each shard is read sequentially, in large
+    reads, and the images are decoded from memory (see
+    image.imdecode_resize()).
+
+    Images in shards are named by their member name (path within the shard),
+    e.g. the descriptor of "survey1/im0001.jpg" is saved as
+    "survey1/im0001.p", see member_key(). So member names should be unique
+    across all of the shards of a dataset.
+
+    Listing the members of a tar shard means reading all of it (its headers
+    are spread through it), so the list is saved next to the shard, e.g.
+    "shard0.tar.members", the first time it is listed, and read from there
+    after that (until the shard changes). Zip shards have a directory of
+    their members at the end, so they are listed directly.
+
+"""
+
+import os, json, tarfile, zipfile
+from image import imdecode_resize
+
+
+SHARD_EXTS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.zip')
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp', '.pgm',
+              '.ppm')
+BUFSIZE = 16 * 1024**2 # Read shards in 16MB reads
+INDEX_EXT = '.members'  # Saved member lists of tar shards
+
+
+def is_shard (path):
+    """ Is a file name a shard (a tar or zip archive)? """
+
+    return path.lower().endswith(SHARD_EXTS)
+
+
+def member_key (name):
+    """ Get the (output) key of a shard member, its name without extension. """
+
+    return os.path.splitext(name)[0]
+
+
+def read_shard (path, extensions=IMAGE_EXTS, bufsize=BUFSIZE):
+    """ Read the (image) members of a shard, in the order they are stored.
+
+    Tar shards are streamed, so they are read strictly sequentially. Zip
+    shards are read in the order of their members in the archive.
+
+    Arguments:
+        path: str, the shard file name.
+        extensions: tuple, of the (lower case) extensions of the members to
+            read, None means all members.
+        bufsize: int, the size (bytes) of the reads from the shard file.
+
+    Yields:
+        name: str, the member name.
+        data: str (bytes), the member's (encoded image) data.
+
+    """
+
+    with open(path, 'rb', bufsize) as f:
+        if path.lower().endswith('.zip'):
+            zf = zipfile.ZipFile(f)
+            for info in sorted(zf.infolist(), key=lambda i: i.header_offset):
+                if __wanted(info.filename, extensions) == True:
+                    yield info.filename, zf.read(info)
+        else:
+            tf = tarfile.open(fileobj=f, mode='r|*')
+            for info in tf:
+                if info.isfile() and __wanted(info.name, extensions) == True:
+                    yield info.name, tf.extractfile(info).read()
+
+
+def shard_members (path, extensions=IMAGE_EXTS):
+    """ List the (image) member names of a shard, in the order they are stored.
+
+    Arguments:
+        path: str, the shard file name.
+        extensions: tuple, of the (lower case) extensions of the members to
+            list, None means all members.
+
+    Returns:
+        list, of member names.
+
+    """
+
+    if path.lower().endswith('.zip'):
+        with zipfile.ZipFile(path) as zf:
+            infos = sorted(zf.infolist(), key=lambda i: i.header_offset)
+            return [i.filename for i in infos if __wanted(i.filename,
+                    extensions) == True]
+
+    names = __read_index(path)
+    if names is None:
+        tf = tarfile.open(path, 'r:*')
+        try:
+            names = [i.name for i in tf if i.isfile()]
+        finally:
+            tf.close()
+        __write_index(path, names)
+
+    return [n for n in names if __wanted(n, extensions) == True]
+
+
+class ShardImages ():
+    """ A sequence of images from shards (and/or loose image files).
+
+    This can be passed where a list of image file names is expected (e.g. for
+    training patches), it has a length, and iterating over it yields the
+    decoded images of the shards' members (and the names of any loose
+    images), shard by shard.
+
+    Arguments:
+        sources: list, of shard and/or image file names.
+        maxdim: int (default None), resize the decoded images to this maximum
+            dimension, None means no resizing.
+
+    """
+
+    def __init__ (self, sources, maxdim=None):
+
+        self.sources = sources
+        self.maxdim = maxdim
+        self.nmembers = {}  # shard -> number of images, once known
+
+
+    def __len__ (self):
+
+        for s in self.sources:
+            if is_shard(s) and (s not in self.nmembers):
+                self.nmembers[s] = len(shard_members(s))
+        return sum(self.nmembers.get(s, 1) for s in self.sources)
+
+
+    def __iter__ (self):
+
+        for source in self.sources:
+            if is_shard(source) == False:
+                yield source
+                continue
+
+            # Count the images while reading them, for len()
+            count = 0
+            for name, data in read_shard(source):
+                count += 1
+                yield imdecode_resize(data, self.maxdim)
+            self.nmembers[source] = count
+
+
+def image_sources (images, maxdim=None):
+    """ Wrap a list of images in a ShardImages object if it includes shards.
+
+    Arguments:
+        images: list, of image (and/or shard) file names.
+        maxdim: int (default None), see ShardImages.
+
+    Returns:
+        images, or a ShardImages object if any of the images are shards.
+
+    """
+
+    if any(isinstance(i, basestring) and is_shard(i) for i in images):
+        return ShardImages(images, maxdim)
+    return images
+
+
+def __read_index (path):
+    """ Read the saved member list of a shard, None if there isn't a current
+        one.
+    """
+
+    ipath = path + INDEX_EXT
+    try:
+        if os.path.getmtime(ipath) < os.path.getmtime(path):
+            return None
+        with open(ipath, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def __write_index (path, names):
+    """ Save the member list of a shard, if its directory is writable. """
+
+    ipath = path + INDEX_EXT
+    try:
+        with open(ipath + '.tmp', 'w') as f:
+            json.dump(names, f)
+        os.rename(ipath + '.tmp', ipath)
+    except (IOError, OSError):
+        pass
+
+
+def __wanted (name, extensions):
+    """ Should a member be read? """
+
+    return (extensions is None) or name.lower().endswith(extensions)
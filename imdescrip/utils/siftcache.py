@@ -0,0 +1,269 @@
+# Imdescrip -- a collection of tools to extract descriptors from images.
+# Copyright (C) 2013 Daniel M. Steinberg (daniel.m.steinberg@gmail.com)
+#
+# This file is part of Imdescrip.
+#
+# Imdescrip is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Imdescrip is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Imdescrip. If not, see <http://www.gnu.org/licenses/>.
+
+""" An on-disk cache of the dense SIFT descriptors of images.
+
+    Decoding images and computing their dense SIFT descriptors is most of the
+    cost of getting dictionary training patches, and much of the cost of
+    extracting descriptors. It is also the same every time another dictionary
+    size is tried, or the images are re-encoded with a retrained dictionary.
+    A SiftCache keeps each image's SIFT descriptors (as uint8, vlfeat's are
+    [0, 255] integers), patch centres and gradient norms, so they are only
+    computed once.
+
+    Entries are keyed by the image's content (a hash of the image file, or of
+    the decoded image array), and the maxdim, psize and pstride they were
+    computed with, so one cache directory can be shared by different SIFT
+    settings, and moved or renamed images are still found.
+
+    Each process appends its entries to its own pack file ("sift-<pid>.pack",
+    the raw arrays of the entries one after another) and index
+    ("sift-<pid>.idx", a JSON line per entry), so there is no contention
+    between workers. An index line is only written once its arrays are in the
+    pack, so a killed worker never leaves a broken entry.
+
+"""
+
+import os, glob, json, hashlib
+import numpy as np
+from image import imread_resize
+from siftwrap import DSIFT_patches
+
+
+BLOCKSIZE = 1024**2 # Hash image files in 1MB reads
+
+
+class SiftCache ():
+    """ An on-disk cache of dense SIFT descriptors, for one set of settings.
+
+    The way this class is typically used is
+
+        cache = SiftCache('siftcache', maxdim, psize, pstride)
+        for image in images:
+            patches, cx, cy, norms, imshape = cache.sift(image)
+
+    It can also be given to siftwrap.training_patches() and ScSPM (see
+    ScSPM.use_sift_cache()), which then read SIFT descriptors from it instead
+    of computing them. SiftCache objects can be pickled (e.g. for
+    multiprocessing), each process then writes to its own pack file.
+
+    Arguments:
+        path: str, the cache directory, it is made if it doesn't exist.
+        maxdim: int, the maximum dimension images are resized to before SIFT
+            extraction (None means no resizing).
+        psize: int, the (square) SIFT patch size, in pixels.
+        pstride: int, the stride between SIFT patches, in pixels.
+
+    """
+
+    def __init__ (self, path, maxdim, psize, pstride):
+
+        if not os.path.exists(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path): # Another process may have made it
+                    raise
+
+        self.path = path
+        self.maxdim = maxdim
+        self.psize = psize
+        self.pstride = pstride
+        self.__reset()
+
+
+    def __len__ (self):
+
+        return len(self.__index())
+
+
+    def __contains__ (self, key):
+
+        return key in self.__index()
+
+
+    def key (self, image):
+        """ Get the cache key of an image.
+
+        Arguments:
+            image: str, an image file name, or a decoded image array.
+
+        Returns:
+            str, the key of the image's content and this cache's settings.
+
+        """
+
+        h = hashlib.sha1()
+        if isinstance(image, np.ndarray):
+            h.update(str((image.shape, image.dtype.str)))
+            h.update(np.ascontiguousarray(image).data)
+        else:
+            with open(image, 'rb') as f:
+                for block in iter(lambda: f.read(BLOCKSIZE), ''):
+                    h.update(block)
+
+        return '{0}-{1}-{2}-{3}'.format(h.hexdigest(), self.maxdim, self.psize,
+                                        self.pstride)
+
+
+    def get (self, key):
+        """ Read an entry from the cache.
+
+        Arguments:
+            key: str, the key of the entry, see key().
+
+        Returns:
+            patches: (npatches, 128) uint8 array of SIFT descriptors.
+            centresx: (npatches,) array of the patch centres (columns).
+            centresy: (npatches,) array of the patch centres (rows).
+            norms: (npatches,) array of the patch gradient norms.
+            imshape: tuple, the (rows, cols) of the (resized) image.
+
+            or None if the entry is not in the cache.
+
+        """
+
+        entry = self.__index().get(key)
+        if entry is None:
+            return None
+
+        pack, offset, n, imshape = entry
+        f = self.__readers.get(pack)
+        if f is None:
+            f = self.__readers[pack] = open(os.path.join(self.path, pack), 'rb')
+
+        f.seek(offset)
+        patches = np.fromfile(f, np.uint8, n * 128)
+        centres = np.fromfile(f, np.float32, 3 * n)
+        if (patches.shape[0] != n * 128) or (centres.shape[0] != 3 * n):
+            raise IOError('Truncated SIFT cache entry {0} in {1}!'
+                          .format(key, pack))
+
+        cx, cy, norms = centres.reshape((3, n))
+        return patches.reshape((n, 128)), cx, cy, norms, imshape
+
+
+    def put (self, key, patches, centresx, centresy, norms, imshape):
+        """ Add an entry to the cache (see get() for the arguments). """
+
+        # Each process writes its own pack, even if this object was forked
+        if (self.__writer is None) or (self.__writer[0] != os.getpid()):
+            name = 'sift-{0}'.format(os.getpid())
+            self.__writer = (os.getpid(), name + '.pack', open(os.path.join(
+                             self.path, name + '.pack'), 'ab'), open(
+                             os.path.join(self.path, name + '.idx'), 'a'))
+        pid, pack, packf, idxf = self.__writer
+
+        packf.seek(0, os.SEEK_END)
+        offset = packf.tell()
+        np.asarray(patches, np.uint8).tofile(packf)
+        np.asarray([centresx, centresy, norms], np.float32).tofile(packf)
+        packf.flush()
+
+        idxf.write(json.dumps({'key': key, 'pack': pack, 'offset': offset,
+                               'npatches': int(patches.shape[0]),
+                               'shape': [int(s) for s in imshape[:2]]})
+                   + '\n')
+        idxf.flush()
+
+        self.__index()[key] = (pack, offset, int(patches.shape[0]),
+                               tuple(int(s) for s in imshape[:2]))
+
+
+    def sift (self, image):
+        """ Get the SIFT descriptors of an image, from the cache if possible.
+
+        If the image is not in the cache, it is read, resized to maxdim, its
+        SIFT descriptors are computed and then added to the cache.
+
+        Arguments:
+            image: str, an image file name, or a decoded image array.
+
+        Returns:
+            see get().
+
+        """
+
+        key = self.key(image)
+        entry = self.get(key)
+        if entry is not None:
+            return entry
+
+        img = imread_resize(image, self.maxdim)
+        patches, cx, cy, norms = DSIFT_patches(img, self.psize, self.pstride,
+                                               norms=True)
+        self.put(key, patches, cx, cy, norms, img.shape)
+        return self.get(key)
+
+
+    def refresh (self):
+        """ Re-read the indices, e.g. to see entries added by other processes.
+        """
+
+        self.close()
+        self.__reset()
+
+
+    def close (self):
+        """ Close this cache's open files. """
+
+        for f in self.__readers.values():
+            f.close()
+        if self.__writer is not None:
+            self.__writer[2].close()
+            self.__writer[3].close()
+        self.__reset()
+
+
+    def __reset (self):
+
+        self.__entries = None
+        self.__readers = {}
+        self.__writer = None
+
+
+    def __index (self):
+        """ The {key: (pack, offset, npatches, imshape)} of all the entries. """
+
+        if self.__entries is None:
+            self.__entries = {}
+            for idxfile in sorted(glob.glob(os.path.join(self.path,
+                                                         'sift-*.idx'))):
+                with open(idxfile, 'r') as f:
+                    for line in f:
+                        if line.endswith('\n') == False:
+                            break   # A partly written line, being written
+                        e = json.loads(line)
+                        self.__entries[e['key']] = (e['pack'], e['offset'],
+                                                    e['npatches'],
+                                                    tuple(e['shape']))
+
+        return self.__entries
+
+
+    def __getstate__ (self):
+        """ Pickle the settings, not the open files. """
+
+        return {'path': self.path, 'maxdim': self.maxdim, 'psize': self.psize,
+                'pstride': self.pstride}
+
+
+    def __setstate__ (self, state):
+
+        self.__dict__.update(state)
+        self.__reset()
@@ -24,6 +24,9 @@
 
     NOTE:   The SIFT descriptors output by vlfeat are [0, 255] integers!
 
+    NOTE:   vlfeat is only imported when SIFT descriptors are actually
+            extracted, importing this module is cheap.
+
     TODO:   Cut out the middle man, make this interface with the c++ vl_feat
             direct OR write better python wrappers.
 
@@ -31,21 +34,42 @@
 
 import math
 import numpy as np
-from vlfeat import vl_dsift
 from image import imread_resize, rgb2gray
 from progress import Progress
+from patch import diverse_patches, norm_patches
+from shards import image_sources
+import memprofile
 
 
-def training_patches (imnames, npatches, psize, maxdim=None, verbose=False):
+def training_patches (imnames, npatches, psize, maxdim=None, verbose=False,
+                      sampling='grid', oversample=4, minnorm=0.5, cache=None):
     """ Extract SIFT patches from images for dictionary training
 
     Arguments:
         imnames: A list of image names from which to extract training patches.
+            These can also be shards (archives) of images, see utils.shards.
         npatches: The number (int) of patches to extract from the images
         maxdim: The maximum dimension of the image in pixels. The image is
             rescaled if it is larger than this. By default there is no scaling. 
         psize: A int of the size of the square patches to extract
         verbose: bool, print progress bar
+        sampling: str (default 'grid'), how to sample the patches from each
+            image, 'grid' samples a regular grid. 'diverse' samples a grid
+            oversample times denser, discards low contrast patches (see
+            minnorm), and then selects a diverse subset of the rest with
+            k-means++ seeding (see patch.diverse_patches()). So homogeneous
+            images contribute fewer near-duplicate patches.
+        oversample: int (default 4), the number of candidate patches per patch
+            selected when sampling is 'diverse'.
+        minnorm: float (default 0.5), when sampling is 'diverse', candidate
+            patches with a gradient norm (contrast) less than this fraction of
+            the median gradient norm of the image are discarded.
+        cache: a utils.siftcache.SiftCache (default None), with the same psize
+            and maxdim. If given, the patches are sampled from the (dense, at
+            the cache's pstride) SIFT descriptors in the cache, which are only
+            computed (and cached) for images not already in it. So re-sampling
+            patches, e.g. for another dictionary size, doesn't decode or SIFT
+            the images again.
 
     Returns:
         An np.array (npatches, 128) of SIFT descriptors. NOTE, the actual 
@@ -56,10 +80,12 @@ def training_patches (imnames, npatches, psize, maxdim=None, verbose=False):
 
     """
 
+    __check_sampling(psize, maxdim, sampling, cache)
+
+    imnames = image_sources(imnames, maxdim)
     nimg = len(imnames)
     ppeimg = int(round(float(npatches)/nimg))
     plist = []
-    bsize = __patch2bin(psize)
 
     if verbose == True:
         print('Extracting SIFT patches from images...')
@@ -69,18 +95,9 @@ def training_patches (imnames, npatches, psize, maxdim=None, verbose=False):
 
     # Get patches 
     for i, ims in enumerate(imnames): 
-        
-        # Read in and resize the image -- convert to gray if needed
-        img = imread_resize(ims, maxdim) 
-        if img.ndim > 2:
-            img = rgb2gray(img)
-
-        # Extract the patches
-        spaceing = max(1, int(math.floor(math.sqrt( \
-                        float(np.prod(img.shape))/ppeimg))))
-        xy, desc = vl_dsift(np.float32(img), step=spaceing, size=bsize)
-        plist.append(desc.T)
-        
+        with memprofile.image(__image_name(ims, i)):
+            plist.append(__image_patches(ims, ppeimg, psize, maxdim, sampling,
+                                         oversample, minnorm, cache))
         progbar.update(i)
 
     progbar.finished()
@@ -88,7 +105,75 @@ def training_patches (imnames, npatches, psize, maxdim=None, verbose=False):
     return np.reshape(patches, (patches.shape[0], np.prod(patches.shape[1:])))
 
 
-def DSIFT_patches (image, psize, pstride):
+def training_matrix (imnames, npatches, psize, maxdim=None, verbose=False,
+                     sampling='grid', oversample=4, minnorm=0.5, cache=None,
+                     mmap=None):
+    """ Extract normalised SIFT patches into a matrix for dictionary training
+
+    This samples the same patches as training_patches(), but they are written
+    straight into a preallocated (128, npatches) Fortran ordered float64
+    matrix, the layout SPAMs' trainDL needs, and are normalised (to unit
+    length) in place. So the only full size array made is the one returned,
+    rather than the list of per-image arrays, their concatenation, the
+    normalised copy and the transposed copy for SPAMs.
+
+    Arguments:
+        imnames, npatches, psize, maxdim, verbose, sampling, oversample,
+            minnorm, cache: see training_patches().
+        mmap: str (default None), a file name to memory map the matrix to, so
+            it doesn't need to fit in memory. The file is overwritten, delete
+            it when finished with the matrix. None means the matrix is in
+            memory.
+
+    Returns:
+        An np.array (128, npatches) Fortran ordered matrix of normalised SIFT
+        descriptors (columns). The number of columns is at most npatches, it
+        can be less if the images don't have enough patches. If there are more
+        patches in an image than its share of npatches, an even subset of them
+        is kept.
+
+    """
+
+    __check_sampling(psize, maxdim, sampling, cache)
+
+    imnames = image_sources(imnames, maxdim)
+    nimg = len(imnames)
+    ppeimg = int(round(float(npatches)/nimg))
+
+    if mmap is None:
+        X = np.empty((128, npatches), np.float64, order='F')
+    else:
+        X = np.memmap(mmap, np.float64, 'w+', shape=(128, npatches), order='F')
+
+    if verbose == True:
+        print('Extracting SIFT patches from images...')
+
+    # Set up progess updates
+    progbar = Progress(nimg, title='Extracting patches', verbose=verbose)
+
+    # Fill the matrix an image at a time
+    nfilled = 0
+    for i, ims in enumerate(imnames): 
+        with memprofile.image(__image_name(ims, i)):
+            desc = __image_patches(ims, ppeimg, psize, maxdim, sampling,
+                                   oversample, minnorm, cache)
+
+        # Share the remaining columns between the remaining images
+        quota = (npatches - nfilled) // (nimg - i)
+        if desc.shape[0] > quota:
+            desc = desc[np.linspace(0, desc.shape[0] - 1, quota).astype(int)]
+
+        cols = X[:, nfilled:nfilled + desc.shape[0]]
+        cols[:] = desc.T
+        cols /= np.sqrt((cols**2).sum(axis=0) + 1e-20)
+        nfilled += desc.shape[0]
+        progbar.update(i)
+
+    progbar.finished()
+    return X[:, :nfilled]   # The first columns of a Fortran array, not a copy
+
+
+def DSIFT_patches (image, psize, pstride, imbuf=None, norms=False):
     """ Extract a grid of (overlapping) SIFT patches from an image
 
     This function extracts SIFT descriptors from square patches in an
@@ -98,11 +183,18 @@ def DSIFT_patches (image, psize, pstride):
         image: np.array (rows, cols, channels) of an image (in memory)
         psize: int the size of the square patches to extract, in pixels.
         pstride: int the stride (in pixels) between successive patches.
+        imbuf: np.array (rows, cols) of float32 (default None) to convert the
+            (gray) image into for vlfeat, e.g. from a utils.workspace.Workspace.
+            One is allocated if this is None.
+        norms: bool (default False), also return the gradient norm (contrast)
+            of each patch, before the descriptors are normalised.
 
     Returns:
         patches: np.array (npatches, 128) SIFT descriptors for each patch
         centresx: np.array (npatches) the centres (column coords) of the patches
         centresy: np.array (npatches) the centres (row coords) of the patches
+        norm: np.array (npatches) the gradient norm of each patch, only if
+            norms is True.
 
     Note:
         The SIFT descriptors output by vlfeat are [0, 255] integers!
@@ -112,15 +204,117 @@ def DSIFT_patches (image, psize, pstride):
     if pstride < 1:
         raise ValueError('pstride needs to be 1 pixel or more!')
 
+    from vlfeat import vl_dsift
+
     if image.ndim > 2:
         image = rgb2gray(image)
 
-    xy, desc = vl_dsift(np.float32(image), step=pstride, 
-                        size=__patch2bin(psize))
+    if imbuf is None:
+        imbuf = np.float32(image)
+    else:
+        imbuf[:] = image
+
+    xy, desc = vl_dsift(imbuf, step=pstride, size=__patch2bin(psize),
+                        norm=norms)
 
+    if norms == True:
+        return desc.T, xy[0,:], xy[1,:], xy[2,:]
     return desc.T, xy[0,:], xy[1,:]
 
 
+def __check_sampling (psize, maxdim, sampling, cache):
+    """ Check the training patch sampling arguments. """
+
+    if sampling not in ('grid', 'diverse'):
+        raise ValueError("sampling must be 'grid' or 'diverse'!")
+    if (cache is not None) and ((cache.psize != psize) or 
+                                (cache.maxdim != maxdim)):
+        raise ValueError('The SIFT cache has a different psize or maxdim!')
+
+
+def __image_patches (image, npatches, psize, maxdim, sampling, oversample,
+                     minnorm, cache):
+    """ Sample about npatches SIFT patches from an image. """
+
+    # Sample the cached SIFT patches of the image
+    if cache is not None:
+        with memprofile.stage('sift'):
+            return __cached_sift(cache, image, npatches, sampling, oversample,
+                                 minnorm)
+        
+    # Read in and resize the image -- convert to gray if needed
+    with memprofile.stage('decode'):
+        img = imread_resize(image, maxdim) 
+        if img.ndim > 2:
+            img = rgb2gray(img)
+
+    # Extract the patches
+    bsize = __patch2bin(psize)
+    with memprofile.stage('sift'):
+        if sampling == 'grid':
+            from vlfeat import vl_dsift
+            spaceing = max(1, int(math.floor(math.sqrt( \
+                            float(np.prod(img.shape))/npatches))))
+            xy, desc = vl_dsift(np.float32(img), step=spaceing, size=bsize)
+            return desc.T
+
+        return __diverse_sift(img, npatches, bsize, oversample, minnorm)
+
+
+def __diverse_sift (img, npatches, bsize, oversample, minnorm):
+    """ Sample diverse, high contrast SIFT patches from an image. """
+
+    from vlfeat import vl_dsift
+
+    spaceing = max(1, int(math.floor(math.sqrt( \
+                    float(np.prod(img.shape))/(oversample * npatches)))))
+    xy, desc = vl_dsift(np.float32(img), step=spaceing, size=bsize, norm=True)
+
+    # The third row of xy is the gradient norm
+    return __diverse_select(desc.T, xy[2,:], npatches, minnorm)
+
+
+def __cached_sift (cache, image, npatches, sampling, oversample, minnorm):
+    """ Sample SIFT patches from the cached (dense) SIFT patches of an image.
+
+    The cached patches are on a grid with a stride of cache.pstride, so this
+    takes every k-th patch along each axis of it, to approximate the grid (of
+    npatches, or oversample * npatches candidates) sampled by vl_dsift.
+    """
+
+    patches, cx, cy, norms, imshape = cache.sift(image)
+    if sampling == 'diverse':
+        npgrid = oversample * npatches
+    else:
+        npgrid = npatches
+
+    spaceing = math.sqrt(float(np.prod(imshape)) / npgrid)
+    step = max(1, int(math.floor(spaceing / cache.pstride)))
+    ix = np.round((cx - cx.min()) / cache.pstride).astype(int)
+    iy = np.round((cy - cy.min()) / cache.pstride).astype(int)
+    keep = ((ix % step) == 0) & ((iy % step) == 0)
+
+    desc = np.float32(patches[keep])
+    if sampling == 'grid':
+        return desc
+    return __diverse_select(desc, norms[keep], npatches, minnorm)
+
+
+def __diverse_select (desc, norms, npatches, minnorm):
+    """ Select diverse patches from those with enough contrast. """
+
+    # Discard low contrast patches
+    desc = desc[norms >= minnorm * np.median(norms)]
+
+    return desc[diverse_patches(norm_patches(desc), npatches)]
+
+
+def __image_name (image, i):
+    """ The name of an image for memory profiling, its file name if any. """
+
+    return image if isinstance(image, basestring) else 'image {0}'.format(i)
+
+
 def __patch2bin (psize):
     """ Convert image patch size to SIFT bin size as expected by VLFeat. """
 
@@ -0,0 +1,289 @@
+# Imdescrip -- a collection of tools to extract descriptors from images.
+# Copyright (C) 2013 Daniel M. Steinberg (daniel.m.steinberg@gmail.com)
+#
+# This file is part of Imdescrip.
+#
+# Imdescrip is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Imdescrip is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Imdescrip. If not, see <http://www.gnu.org/licenses/>.
+
+""" Throughput telemetry for extraction runs, for batch schedulers/monitoring.
+
+    A RunTelemetry object is told about every image processed, and every
+    interval seconds it writes a snapshot of the run: images done, images per
+    second and the ETA (over a rolling window), the error rate, the queue
+    depth, bytes written and the throughput of each worker. Snapshots are
+    written as:
+
+        - JSON lines, one snapshot object per line appended to a file, or
+        - a Prometheus textfile (for the node_exporter textfile collector),
+          which is replaced (atomically) by each snapshot.
+
+    The NullTelemetry does nothing, and is used when telemetry is off, so it
+    costs a few (empty) method calls per image.
+
+"""
+
+import os, time, json
+from collections import deque
+
+
+class NullTelemetry ():
+    """ Telemetry that records nothing, see RunTelemetry for the methods. """
+
+    def start (self, total, njobs=1):
+        pass
+
+    def record (self, worker, seconds, error=False, nbytes=0, done=True):
+        pass
+
+    def queue (self, depth):
+        pass
+
+    def tick (self, force=False):
+        pass
+
+    def finish (self):
+        pass
+
+
+class RunTelemetry (NullTelemetry):
+    """ Telemetry of an extraction run, written periodically to a file.
+
+    The way this class is typically used is
+
+        tel = RunTelemetry('run.prom')
+        tel.start(nimages, njobs)
+        for image in images:
+            # process image
+            tel.record(worker, seconds, error, nbytes)
+            tel.queue(nwaiting)
+            tel.tick()              # Writes a snapshot every interval seconds
+        tel.finish()
+
+    Arguments:
+        path: str, the file to write the snapshots to.
+        fmt: str (default None), 'jsonl' or 'prom' (Prometheus textfile). None
+            means 'prom' if the path ends in '.prom', otherwise 'jsonl'.
+        interval: float (default 10.), the number of seconds between
+            snapshots.
+        window: float (default 60.), the number of seconds the (rolling) rate
+            and ETA are measured over.
+
+    """
+
+    def __init__ (self, path, fmt=None, interval=10., window=60.):
+
+        if fmt is None:
+            fmt = 'prom' if path.endswith('.prom') else 'jsonl'
+        if fmt not in ('jsonl', 'prom'):
+            raise ValueError("fmt must be 'jsonl' or 'prom'!")
+
+        self.path = path
+        self.fmt = fmt
+        self.interval = interval
+        self.window = window
+        self.start(0)
+
+
+    def start (self, total, njobs=1):
+        """ Start (or restart) the telemetry of a run.
+
+        Arguments:
+            total: int, the number of images in the run.
+            njobs: int (default 1), the number of workers.
+
+        """
+
+        self.total = total
+        self.njobs = njobs
+        self.starttime = time.time()
+        self.lasttick = self.starttime
+        self.done = 0
+        self.errors = 0
+        self.nbytes = 0
+        self.depth = 0
+        self.workers = {}               # worker -> [images, busy seconds]
+        self.history = deque([(self.starttime, 0)]) # (time, done) samples
+
+
+    def record (self, worker, seconds, error=False, nbytes=0, done=True):
+        """ Record an image that has been processed.
+
+        Arguments:
+            worker: the worker (e.g. pid) that processed the image.
+            seconds: float, the time taken to process the image.
+            error: bool (default False), was there an error?
+            nbytes: int (default 0), the number of bytes written.
+            done: bool (default True), is the image done, False if it will be
+                retried.
+
+        """
+
+        stats = self.workers.setdefault(worker, [0, 0.])
+        stats[0] += 1
+        stats[1] += seconds
+        self.nbytes += nbytes
+
+        if done == True:
+            self.done += 1
+            self.errors += int(error)
+            self.history.append((time.time(), self.done))
+
+
+    def queue (self, depth):
+        """ Record the number of images waiting to be processed. """
+
+        self.depth = depth
+
+
+    def tick (self, force=False):
+        """ Write a snapshot, if interval seconds have passed since the last.
+
+        Arguments:
+            force: bool (default False), write a snapshot now.
+
+        """
+
+        now = time.time()
+        if (force == False) and (now - self.lasttick < self.interval):
+            return
+
+        self.lasttick = now
+        self.__write(self.snapshot(now))
+
+
+    def finish (self):
+        """ Write the final snapshot of the run. """
+
+        self.tick(force=True)
+
+
+    def snapshot (self, now=None):
+        """ Get a snapshot of the run.
+
+        Returns:
+            dict, of the run's (JSON-able) telemetry.
+
+        """
+
+        if now is None:
+            now = time.time()
+
+        # Rolling rate over the window
+        while (len(self.history) > 1) and \
+                (now - self.history[1][0] >= self.window):
+            self.history.popleft()
+        t0, done0 = self.history[0]
+        rate = (self.done - done0) / (now - t0) if now > t0 else 0.
+        remaining = self.total - self.done
+
+        return {
+            'time': now,
+            'elapsed_seconds': now - self.starttime,
+            'images_total': self.total,
+            'images_done': self.done,
+            'images_per_second': rate,
+            'eta_seconds': remaining / rate if rate > 0 else None,
+            'errors': self.errors,
+            'error_rate': float(self.errors) / self.done if self.done else 0.,
+            'queue_depth': self.depth,
+            'bytes_written': self.nbytes,
+            'njobs': self.njobs,
+            'workers': dict((str(w), {'images': n, 'busy_seconds': b,
+                             'images_per_second': n / b if b > 0 else 0.})
+                            for w, (n, b) in self.workers.items())
+            }
+
+
+    def __write (self, snap):
+        """ Write a snapshot to the telemetry file. """
+
+        if self.fmt == 'jsonl':
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(snap, sort_keys=True) + '\n')
+            return
+
+        # Prometheus textfiles must be replaced atomically
+        with open(self.path + '.tmp', 'w') as f:
+            f.write(prometheus_text(snap))
+        os.rename(self.path + '.tmp', self.path)
+
+
+def prometheus_text (snap):
+    """ Format a telemetry snapshot in the Prometheus text exposition format.
+
+    Arguments:
+        snap: dict, a snapshot from RunTelemetry.snapshot().
+
+    Returns:
+        str, the metrics.
+
+    """
+
+    metrics = [
+        ('images_total', 'gauge', 'Images in the run.', 'images_total'),
+        ('images_done_total', 'counter', 'Images processed.', 'images_done'),
+        ('images_per_second', 'gauge', 'Rolling throughput.',
+            'images_per_second'),
+        ('eta_seconds', 'gauge', 'Estimated seconds to finish.',
+            'eta_seconds'),
+        ('errors_total', 'counter', 'Images with errors.', 'errors'),
+        ('error_rate', 'gauge', 'Fraction of images with errors.',
+            'error_rate'),
+        ('queue_depth', 'gauge', 'Images waiting to be processed.',
+            'queue_depth'),
+        ('bytes_written_total', 'counter', 'Descriptor bytes written.',
+            'bytes_written'),
+        ('elapsed_seconds', 'gauge', 'Seconds since the run started.',
+            'elapsed_seconds')
+        ]
+
+    lines = []
+    for name, mtype, doc, key in metrics:
+        if snap[key] is None:
+            continue
+        lines += ['# HELP imdescrip_{0} {1}'.format(name, doc),
+                  '# TYPE imdescrip_{0} {1}'.format(name, mtype),
+                  'imdescrip_{0} {1!r}'.format(name, float(snap[key]))]
+
+    for name, key, doc in (('worker_images_total', 'images',
+                            'Images processed by each worker.'),
+                           ('worker_images_per_second', 'images_per_second',
+                            'Throughput of each worker while busy.')):
+        lines += ['# HELP imdescrip_{0} {1}'.format(name, doc),
+                  '# TYPE imdescrip_{0} {1}'.format(name, 'counter' if
+                  name.endswith('_total') else 'gauge')]
+        lines += ['imdescrip_{0}{{worker="{1}"}} {2!r}'.format(name, w,
+                  float(stats[key])) for w, stats in
+                  sorted(snap['workers'].items())]
+
+    return '\n'.join(lines) + '\n'
+
+
+def make_telemetry (telemetry):
+    """ Make a telemetry object from an extractor's telemetry argument.
+
+    Arguments:
+        telemetry: None (no telemetry), a str file name (see RunTelemetry), or
+            a (Null/Run)Telemetry object.
+
+    Returns:
+        a telemetry object.
+
+    """
+
+    if telemetry is None:
+        return NullTelemetry()
+    if isinstance(telemetry, basestring):
+        return RunTelemetry(telemetry)
+    return telemetry
@@ -0,0 +1,202 @@
+# Imdescrip -- a collection of tools to extract descriptors from images.
+# Copyright (C) 2013 Daniel M. Steinberg (daniel.m.steinberg@gmail.com)
+#
+# This file is part of Imdescrip.
+#
+# Imdescrip is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Imdescrip is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Imdescrip. If not, see <http://www.gnu.org/licenses/>.
+
+""" A thread budget for the native libraries (BLAS, OpenMP, SPAMs).
+
+    NumPy's BLAS and SPAMs start their own threads, by default one per core.
+    So running one process per core (e.g. extract_smp()) can start cores^2
+    threads, which thrash. The thread budget is the number of threads each
+    process may use, typically cores / processes, and set_threads() applies it
+    to:
+
+        - the thread environment variables (OMP_NUM_THREADS etc.), for
+          libraries that are loaded afterwards (e.g. SPAMs is loaded on first
+          use),
+        - already loaded BLAS/OpenMP libraries, if threadpoolctl is installed,
+        - the numThreads argument imdescrip passes to SPAMs, see get_threads().
+
+    Processes can also be pinned to a set of cores with pin_cores(), this uses
+    psutil if it is installed (or os.sched_setaffinity on Python 3). Worker
+    processes claim their share of the cores with claim_slot(), so a worker
+    that replaces one that died gets the cores it left.
+
+"""
+
+import os
+import multiprocessing as mp
+
+
+THREAD_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+               'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+__budget = {'threads': None, 'limiter': None}
+
+
+def available_cores ():
+    """ Get the list of cores this process is allowed to run on. """
+
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+
+    try:
+        import psutil
+        return sorted(psutil.Process().cpu_affinity())
+    except (ImportError, AttributeError):
+        return range(mp.cpu_count())
+
+
+def thread_budget (njobs, cores=None):
+    """ Get the number of threads each of njobs processes should use.
+
+    Arguments:
+        njobs: int, the number of processes.
+        cores: int, the number of cores to share between the processes. None
+            (default) means all of the cores available to this process.
+
+    Returns:
+        int, the number of threads per process, at least 1.
+
+    """
+
+    if cores is None:
+        cores = len(available_cores())
+    return max(1, cores // njobs)
+
+
+def set_threads (nthreads):
+    """ Set the thread budget of this process.
+
+    Arguments:
+        nthreads: int, the number of threads the native libraries may use. None
+            removes the budget (and restores the loaded libraries' original
+            limits), but the environment variables are left as they are.
+
+    Returns:
+        bool, True if the budget could be applied to the BLAS/OpenMP libraries
+        that are already loaded (this needs threadpoolctl).
+
+    """
+
+    if __budget['limiter'] is not None:
+        __budget['limiter'].restore_original_limits()
+
+    __budget['threads'] = nthreads
+    __budget['limiter'] = None
+    if nthreads is None:
+        return False
+
+    for var in THREAD_VARS:
+        os.environ[var] = str(nthreads)
+
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return False
+
+    __budget['limiter'] = threadpool_limits(limits=nthreads)
+    return True
+
+
+def get_threads (default=1):
+    """ Get the thread budget of this process, for passing to e.g. SPAMs.
+
+    Arguments:
+        default: int (default 1), the number of threads to use if no budget has
+            been set with set_threads(). -1 means all cores to SPAMs.
+
+    Returns:
+        int, the number of threads.
+
+    """
+
+    if __budget['threads'] is None:
+        return default
+    return __budget['threads']
+
+
+def claim_slot (slots):
+    """ Claim a free slot (e.g. a share of the cores) for this process.
+
+    Arguments:
+        slots: a shared integer array (multiprocessing.Array('i', nslots)) of
+            the pid holding each slot, 0 for free slots. Slots held by
+            processes that have exited are free.
+
+    Returns:
+        int, the index of the slot claimed, or None if there are none free.
+        A process that already holds a slot gets the same one.
+
+    """
+
+    pid = os.getpid()
+    with slots.get_lock():
+        if pid in slots[:]:
+            return slots[:].index(pid)
+
+        for i, holder in enumerate(slots[:]):
+            if (holder == 0) or (__is_alive(holder) == False):
+                slots[i] = pid
+                return i
+
+    return None
+
+
+def pin_cores (index, nthreads, cores=None):
+    """ Pin this process to its share of the cores.
+
+    Process index gets cores [index * nthreads, (index + 1) * nthreads), modulo
+    the number of cores.
+
+    Arguments:
+        index: int, the index of this process (e.g. the worker number).
+        nthreads: int, the number of cores for this process.
+        cores: list, the cores to share out. None (default) means all of the
+            cores available to this process.
+
+    Returns:
+        list, of the cores this process is pinned to, or None if this isn't
+        supported on this platform (it needs psutil on Python 2).
+
+    """
+
+    if cores is None:
+        cores = available_cores()
+    mine = [cores[(index * nthreads + i) % len(cores)] for i in
+            range(min(nthreads, len(cores)))]
+
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, mine)
+        return mine
+
+    try:
+        import psutil
+        psutil.Process().cpu_affinity(mine)
+    except (ImportError, AttributeError):
+        return None
+
+    return mine
+
+
+def __is_alive (pid):
+    """ Is a process still running? """
+
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
@@ -0,0 +1,109 @@
+# Imdescrip -- a collection of tools to extract descriptors from images.
+# Copyright (C) 2013 Daniel M. Steinberg (daniel.m.steinberg@gmail.com)
+#
+# This file is part of Imdescrip.
+#
+# Imdescrip is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Imdescrip is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Imdescrip. If not, see <http://www.gnu.org/licenses/>.
+
+""" Re-usable work buffers, to avoid allocating arrays for every image.
+
+    A Workspace keeps one flat buffer per name, and hands out arrays (views of
+    these buffers) of whatever shape is asked for. A buffer only grows, when a
+    larger array than before is asked for, so after the first few (largest)
+    images no more memory is allocated.
+
+    The arrays handed out are overwritten the next time the same name is
+    asked for, so they must not be kept (copy them if needed).
+
+"""
+
+import numpy as np
+
+
+class Workspace ():
+    """ Named, growable work buffers.
+
+    The way this class is typically used is
+
+        ws = Workspace()
+        for image in images:
+            codes = ws.get('codes', (npatches, dsize))
+            # fill and use codes, but don't keep it
+
+    Workspaces are not pickled with their buffers, they are empty when
+    unpickled (e.g. in another process).
+
+    Arguments:
+        growth: float (default 1.25), when a buffer needs to grow, it grows to
+            this many times the size asked for, so slightly larger images do not
+            each cause a new allocation.
+
+    """
+
+    def __init__ (self, growth=1.25):
+
+        self.growth = growth
+        self.buffers = {}
+
+
+    def get (self, name, shape, dtype=np.float64, order='C'):
+        """ Get an (uninitialised) array from a named buffer.
+
+        Arguments:
+            name: str, the name of the buffer.
+            shape: tuple, the shape of the array.
+            dtype: numpy dtype (default float64) of the array.
+            order: 'C' (default) or 'F', the memory order of the array.
+
+        Returns:
+            an array of the requested shape, dtype and order. Its contents are
+            whatever was left in the buffer.
+
+        """
+
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape))
+        buf = self.buffers.get(name)
+
+        if (buf is None) or (buf.dtype != dtype) or (buf.size < size):
+            buf = np.empty(int(size * self.growth) + 1, dtype)
+            self.buffers[name] = buf
+
+        return buf[:size].reshape(shape, order=order)
+
+
+    def zeros (self, name, shape, dtype=np.float64, order='C'):
+        """ Get a zeroed array from a named buffer, see get(). """
+
+        array = self.get(name, shape, dtype, order)
+        array.fill(0)
+        return array
+
+
+    def nbytes (self):
+        """ Get the total size (bytes) of all of the buffers. """
+
+        return sum(b.nbytes for b in self.buffers.values())
+
+
+    def clear (self):
+        """ Free all of the buffers. """
+
+        self.buffers = {}
+
+
+    def __getstate__ (self):
+        """ Don't pickle the buffers. """
+
+        return {'growth': self.growth, 'buffers': {}}
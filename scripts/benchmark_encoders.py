@@ -0,0 +1,93 @@
+#! /usr/bin/env python
+
+# Imdescrip -- a collection of tools to extract descriptors from images.
+# Copyright (C) 2013 Daniel M. Steinberg (daniel.m.steinberg@gmail.com)
+#
+# This file is part of Imdescrip.
+#
+# Imdescrip is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Imdescrip is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Imdescrip. If not, see <http://www.gnu.org/licenses/>.
+
+""" Compare the speed and retrieval quality of the ScSPM patch encoders.
+
+    All encoders use the same (learned) dictionary. Dense SIFT is computed once
+    per image, and only the encoding, pooling and normalisation is timed.
+    Retrieval quality is measured as the overlap of each image's k nearest
+    neighbours (cosine similarity) with the neighbours found using OMP codes.
+"""
+
+import glob, os, time, copy
+import argparse
+import numpy as np
+from imdescrip.descriptors.ScSPM import ScSPM
+from imdescrip.utils import patch as pch, siftwrap as sw
+
+parser = argparse.ArgumentParser(description="Benchmark ScSPM encoders.",
+                        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("dicname", help="ScSPM dictionary model directory.")
+parser.add_argument("imagedir", help="Directory of test images.")
+parser.add_argument("extension", help="Image file extension (eg. 'png').")
+parser.add_argument("--nimages", help="Maximum number of images to use.",
+                    type=int, default=200)
+parser.add_argument("--knn", help="Number of neighbours for retrieval "
+                    "overlap.", type=int, default=10)
+args = parser.parse_args()
+
+filelist = sorted(glob.glob(os.path.join(args.imagedir, '*.' +
+                  args.extension)))[:args.nimages]
+desc = ScSPM.load(args.dicname)
+
+# Get the SIFT patches once
+print("Extracting SIFT from {0} images...".format(len(filelist)))
+sift = []
+for f in filelist:
+    img = pch.imread_resize(f, desc.maxdim)
+    sift.append((sw.DSIFT_patches(img, desc.psize, desc.pstride), img.shape))
+
+# Encode and pool with each encoder
+feas, times = {}, {}
+for encoder in ScSPM.ENCODERS:
+    edesc = copy.copy(desc)
+    edesc.encoder = encoder
+    if (encoder == 'aomp') and (edesc.atomcentres is None):
+        edesc.build_index()
+
+    fea = []
+    start = time.time()
+    for (patches, cx, cy), imshape in sift:
+        codes = edesc.encode(patches)
+        f = pch.pyramid_pooling(codes, cx, cy, imshape, edesc.levels)
+        fea.append(f / np.sqrt((f**2).sum() + 1e-10))
+    times[encoder] = time.time() - start
+    feas[encoder] = np.array(fea)
+
+
+def neighbours (F, k):
+    """ Get the k nearest neighbours (cosine) of each row of F. """
+
+    S = F.dot(F.T)
+    np.fill_diagonal(S, -np.inf)
+    return np.argsort(-S, axis=1)[:, :k]
+
+
+knn = min(args.knn, len(filelist) - 1)
+ompnn = neighbours(feas['omp'], knn)
+
+print("\n{0:>8} {1:>12} {2:>10} {3:>12}".format("encoder", "ms/image",
+      "speedup", "overlap@{0}".format(knn)))
+for encoder in ScSPM.ENCODERS:
+    enn = neighbours(feas[encoder], knn)
+    overlap = np.mean([len(np.intersect1d(a, b)) for a, b in zip(ompnn, enn)])
+    print("{0:>8} {1:>12.2f} {2:>10.2f} {3:>12.3f}".format(encoder,
+          1000 * times[encoder] / len(filelist), times['omp'] / times[encoder],
+          overlap / knn))
@@ -0,0 +1,116 @@
+#! /usr/bin/env python
+
+# Imdescrip -- a collection of tools to extract descriptors from images.
+# Copyright (C) 2013 Daniel M. Steinberg (daniel.m.steinberg@gmail.com)
+#
+# This file is part of Imdescrip.
+#
+# Imdescrip is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Imdescrip is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Imdescrip. If not, see <http://www.gnu.org/licenses/>.
+
+""" Compare the speed and accuracy of approximate ('aomp') and exhaustive OMP.
+
+    The exhaustive codes are from batch OMP ('bomp', the same codes as SPAMs
+    OMP), and SPAMs OMP is also timed if it is installed. For each number of
+    probes, the 'aomp' encoding time is reported, with the fraction of the
+    exhaustive atoms (support) that are found, the mean patch reconstruction
+    error relative to exhaustive OMP, and the cosine similarity of the image
+    descriptors. Dense SIFT is computed once per image.
+"""
+
+import glob, os, time, copy
+import argparse
+import numpy as np
+from imdescrip.descriptors.ScSPM import ScSPM
+from imdescrip.utils import patch as pch, siftwrap as sw
+
+parser = argparse.ArgumentParser(description="Benchmark the atom index.",
+                        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("dicname", help="ScSPM dictionary model directory.")
+parser.add_argument("imagedir", help="Directory of test images.")
+parser.add_argument("extension", help="Image file extension (eg. 'png').")
+parser.add_argument("--nimages", help="Maximum number of images to use.",
+                    type=int, default=50)
+parser.add_argument("--nclusters", help="Number of atom clusters (default "
+                    "sqrt(dsize)).", type=int, default=None)
+parser.add_argument("--probes", help="Numbers of probes to try.", type=int,
+                    nargs='+', default=[1, 2, 4, 8, 16])
+args = parser.parse_args()
+
+filelist = sorted(glob.glob(os.path.join(args.imagedir, '*.' +
+                  args.extension)))[:args.nimages]
+desc = ScSPM.load(args.dicname)
+dic = np.asarray(desc.dic)
+
+start = time.time()
+desc.build_index(args.nclusters)
+print("Built an index of {0} atoms in {1} clusters in {2:.2f}s.".format(
+      desc.dsize, desc.atomcentres.shape[1], time.time() - start))
+
+# Get the SIFT patches once
+print("Extracting SIFT from {0} images...".format(len(filelist)))
+sift = []
+for f in filelist:
+    img = pch.imread_resize(f, desc.maxdim)
+    sift.append((sw.DSIFT_patches(img, desc.psize, desc.pstride), img.shape))
+
+
+def encode (encoder, probes=None):
+    """ Encode (and pool) all images, returns codes, descriptors and time. """
+
+    edesc = copy.copy(desc)
+    edesc.encoder = encoder
+    if probes is not None:
+        edesc.probes = probes
+    edesc.gram() # Not timed, this is cached once per dictionary
+
+    codes, feas = [], []
+    start = time.time()
+    for (patches, cx, cy), imshape in sift:
+        codes.append(edesc.encode(patches))
+        f = pch.pyramid_pooling(codes[-1], cx, cy, imshape, edesc.levels)
+        feas.append(f / np.sqrt((f**2).sum() + 1e-10))
+    return codes, np.array(feas), time.time() - start
+
+
+def recon_error (codes):
+    """ The mean patch reconstruction error of all images' codes. """
+
+    err = [np.sqrt(((np.float64(p) - c.dot(dic.T))**2)
+           .sum(axis=1)) for ((p, _, _), _), c in zip(sift, codes)]
+    return np.concatenate(err).mean()
+
+
+exact, efeas, etime = encode('bomp')
+eerr = recon_error(exact)
+esupport = [c != 0 for c in exact]
+
+print("\n{0:>10} {1:>10} {2:>9} {3:>9} {4:>10} {5:>9}".format("encoder", 
+      "ms/image", "speedup", "support", "rel error", "cosine"))
+try:
+    _, _, otime = encode('omp')
+    print("{0:>10} {1:>10.2f} {2:>9.2f}".format("omp", 1000 * otime /
+          len(filelist), etime / otime))
+except ImportError:
+    pass
+print("{0:>10} {1:>10.2f} {2:>9.2f} {3:>9.3f} {4:>10.3f} {5:>9.3f}".format(
+      "bomp", 1000 * etime / len(filelist), 1., 1., 1., 1.))
+
+for probes in args.probes:
+    codes, feas, atime = encode('aomp', probes)
+    support = sum(((c != 0) & s).sum() for c, s in zip(codes, esupport)) \
+                / float(sum(s.sum() for s in esupport))
+    print("{0:>10} {1:>10.2f} {2:>9.2f} {3:>9.3f} {4:>10.3f} {5:>9.3f}".format(
+          "aomp/{0}".format(probes), 1000 * atime / len(filelist),
+          etime / atime, support, recon_error(codes) / eerr,
+          (feas * efeas).sum(axis=1).mean()))
@@ -0,0 +1,88 @@
+#! /usr/bin/env python
+
+# Imdescrip -- a collection of tools to extract descriptors from images.
+# Copyright (C) 2013 Daniel M. Steinberg (daniel.m.steinberg@gmail.com)
+#
+# This file is part of Imdescrip.
+#
+# Imdescrip is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Imdescrip is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Imdescrip. If not, see <http://www.gnu.org/licenses/>.
+
+""" Find the best split of the cores into processes and threads.
+
+    Descriptors are extracted from the same images with extract_smp() for each
+    split of the cores into (processes x threads per process), and with the
+    low-latency mode (one process using all of the cores). The throughput
+    (images per second) and the latency (seconds per image) are reported.
+"""
+
+import glob, os, time, shutil, tempfile
+import argparse
+from imdescrip.descriptors.ScSPM import ScSPM
+from imdescrip.extractor import extract_smp, extract_batch
+from imdescrip.utils.threads import available_cores
+
+parser = argparse.ArgumentParser(description="Benchmark process/thread "
+                        "splits.", 
+                        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("dicname", help="ScSPM dictionary model directory.")
+parser.add_argument("imagedir", help="Directory of test images.")
+parser.add_argument("extension", help="Image file extension (eg. 'png').")
+parser.add_argument("--nimages", help="Maximum number of images to use.",
+                    type=int, default=200)
+parser.add_argument("--encoder", help="The ScSPM encoder to use.",
+                    choices=ScSPM.ENCODERS, default=None)
+parser.add_argument("--pin", help="Pin workers to cores.", action="store_true")
+args = parser.parse_args()
+
+filelist = sorted(glob.glob(os.path.join(args.imagedir, '*.' +
+                  args.extension)))[:args.nimages]
+desc = ScSPM.load(args.dicname)
+if args.encoder is not None:
+    desc.encoder = args.encoder
+
+ncores = len(available_cores())
+splits = [(ncores // t, t) for t in range(1, ncores + 1) if ncores % t == 0]
+print("{0} images, {1} cores.".format(len(filelist), ncores))
+
+
+def run (extractor, **kwargs):
+    """ Time an extractor on all of the images in a fresh directory. """
+
+    savedir = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        extractor(filelist, savedir, desc, **kwargs)
+        return time.time() - start
+    finally:
+        shutil.rmtree(savedir)
+
+
+results = []
+for njobs, threads in splits:
+    elapsed = run(extract_smp, njobs=njobs, threads=threads, pin=args.pin)
+    results.append(("{0} x {1}".format(njobs, threads), elapsed, 
+                    elapsed * njobs))
+
+# Low latency, one process with all of the threads
+elapsed = run(extract_batch, threads=ncores)
+results.append(("low-latency 1 x {0}".format(ncores), elapsed, elapsed))
+
+print("\n{0:>22} {1:>10} {2:>14}".format("processes x threads", "images/s",
+      "s/image"))
+for name, elapsed, latency in results:
+    print("{0:>22} {1:>10.2f} {2:>14.3f}".format(name, len(filelist) / elapsed,
+          latency / len(filelist)))
+
+best = min(results[:-1], key=lambda r: r[1])
+print("\nBest throughput: {0} (processes x threads).".format(best[0]))
@@ -19,8 +19,7 @@
 # along with Imdescrip. If not, see <http://www.gnu.org/licenses/>.
 
 import glob, sys
-import cPickle as pk
-from imdescrip.extractor import extract_smp
+from imdescrip.extractor import extract_smp, extract_shards
 from imdescrip.descriptors.ScSPM import ScSPM
 
 
@@ -42,11 +41,15 @@ desc = ScSPM(dsize=512, compress_dim=None)
 desc.learn_dictionary(filelist, npatches=200000, niter=5000)
 
 # Save the dictionary
-with open('ScSPM.p', 'wb') as f:
-    pk.dump(desc, f, protocol=2)
+desc.save('ScSPM')
 
-# OR Load a pre-learned dictionary 
-#with open('ScSPM.p', 'rb') as f:
-    #desc = pk.load(f)
+# OR Load a pre-learned dictionary (memory mapped, so shared between workers)
+#desc = ScSPM.load('ScSPM')
 
-extract_smp(filelist, savdir, desc, verbose=True) 
+extract_smp(filelist, savdir, desc, verbose=True)
+
+# OR read the images from shards (tar/zip archives of many images), which is
+# much faster than loose files on shared storage
+#shardlist = glob.glob(imgdir + '*.tar')
+#desc.learn_dictionary(shardlist, npatches=200000, niter=5000)
+#extract_shards(shardlist, savdir, desc, verbose=True) 
@@ -0,0 +1,53 @@
+#! /usr/bin/env python
+
+# Imdescrip -- a collection of tools to extract descriptors from images.
+# Copyright (C) 2013 Daniel M. Steinberg (daniel.m.steinberg@gmail.com)
+#
+# This file is part of Imdescrip.
+#
+# Imdescrip is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Imdescrip is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Imdescrip. If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+from imdescrip.descriptors.ScSPM import ScSPM
+
+parser = argparse.ArgumentParser(description="Learn a PCA compression for a "
+                        "ScSPM dictionary, from (uncompressed) descriptors it "
+                        "has extracted.",
+                        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("dicname", help="Name and path of the dictionary model "
+                    "directory, the compression is saved to it.")
+parser.add_argument("feadir", help="Directory of extracted descriptors.")
+parser.add_argument("--ndims", help="Number of dimensions to compress "
+                    "descriptors to.", type=int, default=512)
+parser.add_argument("--batchsize", help="Number of descriptors to fit at "
+                    "once.", type=int, default=1000)
+parser.add_argument("--maxfiles", help="Maximum number of descriptors to use.",
+                    type=int, default=None)
+parser.add_argument("--whiten", help="Scale the compressed descriptors to unit "
+                    "variance.", action="store_true")
+parser.add_argument("--outname", help="Save the model to this directory "
+                    "instead of dicname.", default=None)
+args = parser.parse_args()
+
+desc = ScSPM.load(args.dicname, mmap=False)
+kept = desc.learn_compression(args.feadir, ncomponents=args.ndims, 
+                              batchsize=args.batchsize, whiten=args.whiten,
+                              maxfiles=args.maxfiles)
+print "{0:.1%} of the descriptor variance kept in {1} dimensions." \
+        .format(kept, args.ndims)
+
+outname = args.outname or args.dicname
+desc.save(outname)
+
+print "Done! Dictionary object saved to {0}.".format(outname)
@@ -18,24 +18,47 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with Imdescrip. If not, see <http://www.gnu.org/licenses/>.
 
-import glob, sys, os
-import cPickle as pk
+import glob, sys, os, json
 import argparse
-from imdescrip.extractor import extract_smp
 from imdescrip.descriptors.ScSPM import ScSPM
+from imdescrip.utils import memprofile
 
 parser = argparse.ArgumentParser(description="Create a ScSPM dictionary.",
                         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument("imagedir", help="Directory of training images.")
 parser.add_argument("extension", help="Image file extension (eg. 'png').")
-parser.add_argument("--dicname", help="Name and path of dictionary file to " 
-                    "save.", default="ScSPM.p")
+parser.add_argument("--dicname", help="Name and path of dictionary model "
+                    "directory to save.", default="ScSPM")
 parser.add_argument("--nbases", help="Number of dictionary bases.", type=int, 
                     default=512)
 parser.add_argument("--dcompress", help="Number of dimensions to compress "
                     "features to.", type=int, default=None)
 parser.add_argument("--npatches", help="Number of image patches to use to learn"
                     " dictionary.", type=int, default=200000)
+parser.add_argument("--sampling", help="Training patch sampling, 'grid' or "
+                    "'diverse' (fewer, less redundant patches).", 
+                    choices=['grid', 'diverse'], default='grid')
+parser.add_argument("--update", help="Update (warm-start) the existing "
+                    "dictionary model dicname with these images, instead of "
+                    "learning a new dictionary.", action="store_true")
+parser.add_argument("--niter", help="Number of dictionary learning "
+                    "iterations (default 5000, or 200 with --update).", 
+                    type=int, default=None)
+parser.add_argument("--checkpoint", help="Learn in segments, saving the "
+                    "dictionary to this model directory after each, and "
+                    "resume from it if it exists. Learning stops early when "
+                    "the held-out objective stops improving.", default=None)
+parser.add_argument("--segment", help="Number of iterations per checkpointed "
+                    "segment (default niter / 10).", type=int, default=None)
+parser.add_argument("--siftcache", help="Directory of a cache of the images' "
+                    "SIFT descriptors, they are only computed for images not "
+                    "already in it.", default=None)
+parser.add_argument("--patchfile", help="Temporary file to memory map the "
+                    "training patches to, for more patches than fit in "
+                    "memory.", default=None)
+parser.add_argument("--memprofile", help="Write a (JSON) profile of the peak "
+                    "memory of each stage of learning to this file.", 
+                    default=None)
 args = parser.parse_args()
 
 # Make a list of images
@@ -47,13 +70,33 @@ if nimages == 0:
     print "Quiting..."
     sys.exit(1)
 
-# Train a dictionary
-desc = ScSPM(dsize=args.nbases, compress_dim=args.dcompress)
-desc.learn_dictionary(filelist, npatches=args.npatches, niter=5000)
+if args.memprofile is not None:
+    profiler = memprofile.enable()
+
+# Train, or update, a dictionary
+if args.update:
+    desc = ScSPM.load(args.dicname, mmap=False)
+    desc.use_sift_cache(args.siftcache)
+    drift = desc.update_dictionary(filelist, npatches=args.npatches,
+                                   niter=args.niter or 200, 
+                                   sampling=args.sampling)
+    if drift['changed'] > 0:
+        print "{0} atoms changed, consider re-extracting stored features." \
+                .format(drift['changed'])
+else:
+    desc = ScSPM(dsize=args.nbases, compress_dim=args.dcompress)
+    desc.use_sift_cache(args.siftcache)
+    desc.learn_dictionary(filelist, npatches=args.npatches, 
+                          niter=args.niter or 5000, sampling=args.sampling,
+                          segment=args.segment, checkpoint=args.checkpoint,
+                          patchfile=args.patchfile)
 
 # Save the dictionary
-with open(args.dicname, 'wb') as f:
-    pk.dump(desc, f, protocol=2)
+desc.save(args.dicname)
+
+if args.memprofile is not None:
+    with open(args.memprofile, 'w') as f:
+        json.dump(profiler.summary(), f, indent=2, sort_keys=True)
 
 print "Done! Dictionary object saved to {0}.".format(args.dicname)
 
@@ -0,0 +1,92 @@
+#! /usr/bin/env python
+
+# Imdescrip -- a collection of tools to extract descriptors from images.
+# Copyright (C) 2013 Daniel M. Steinberg (daniel.m.steinberg@gmail.com)
+#
+# This file is part of Imdescrip.
+#
+# Imdescrip is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Imdescrip is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Imdescrip. If not, see <http://www.gnu.org/licenses/>.
+
+""" Validate skipping the encoding of flat patches (ScSPM flat_threshold).
+
+    For each threshold, the fraction of patches skipped, the encoding (and
+    pooling) time, and the fidelity of the descriptors compared with encoding
+    every patch are reported. Fidelity is the cosine similarity of each image's
+    descriptor with its full descriptor. Dense SIFT is computed once per image.
+"""
+
+import glob, os, time
+import argparse
+import numpy as np
+from imdescrip.descriptors.ScSPM import ScSPM
+from imdescrip.utils import patch as pch, siftwrap as sw
+
+parser = argparse.ArgumentParser(description="Validate flat patch skipping.",
+                        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("dicname", help="ScSPM dictionary model directory.")
+parser.add_argument("imagedir", help="Directory of test images.")
+parser.add_argument("extension", help="Image file extension (eg. 'png').")
+parser.add_argument("--nimages", help="Maximum number of images to use.",
+                    type=int, default=200)
+parser.add_argument("--thresholds", help="Flat thresholds to try (default, "
+                    "quantiles of the patch norms).", type=float, nargs='+',
+                    default=None)
+args = parser.parse_args()
+
+filelist = sorted(glob.glob(os.path.join(args.imagedir, '*.' +
+                  args.extension)))[:args.nimages]
+desc = ScSPM.load(args.dicname)
+
+# Get the SIFT patches (and their norms) once
+print("Extracting SIFT from {0} images...".format(len(filelist)))
+sift = []
+for f in filelist:
+    img = pch.imread_resize(f, desc.maxdim)
+    sift.append((sw.DSIFT_patches(img, desc.psize, desc.pstride, norms=True),
+                 img.shape))
+
+allnorms = np.concatenate([s[0][3] for s in sift])
+print("Patch norm quantiles (10, 25, 50, 75, 90%): {0}".format(
+      np.percentile(allnorms, [10, 25, 50, 75, 90]).round(2)))
+thresholds = args.thresholds
+if thresholds is None:
+    thresholds = list(np.percentile(allnorms, [10, 25, 50]))
+
+
+def descriptors (threshold):
+    """ Encode and pool all images, returns descriptors, time, fraction. """
+
+    desc.flat_threshold = threshold
+    feas, skipped = [], 0
+    start = time.time()
+    for (patches, cx, cy, norms), imshape in sift:
+        codes = desc.encode(patches, norms=norms)
+        skipped += desc.last_stats['skipped']
+        f = pch.pyramid_pooling(codes, cx, cy, imshape, desc.levels)
+        feas.append(f / np.sqrt((f**2).sum() + 1e-10))
+    return np.array(feas), time.time() - start, float(skipped) / len(allnorms)
+
+
+full, ftime, _ = descriptors(None)
+
+print("\n{0:>10} {1:>9} {2:>10} {3:>9} {4:>12}".format("threshold", 
+      "skipped", "ms/image", "speedup", "min/mean cos"))
+print("{0:>10} {1:>9.1%} {2:>10.2f} {3:>9.2f} {4:>12}".format("None", 0., 
+      1000 * ftime / len(filelist), 1., "1.000/1.000"))
+for thresh in thresholds:
+    feas, etime, frac = descriptors(thresh)
+    cos = (feas * full).sum(axis=1)
+    print("{0:>10.2f} {1:>9.1%} {2:>10.2f} {3:>9.2f} {4:>12}".format(thresh,
+          frac, 1000 * etime / len(filelist), ftime / etime,
+          "{0:.3f}/{1:.3f}".format(cos.min(), cos.mean())))